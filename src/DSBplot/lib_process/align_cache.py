@@ -0,0 +1,139 @@
+import json
+import time
+import hashlib
+import sqlite3
+
+import DSBplot.utils.file_utils as file_utils
+import DSBplot.utils.log_utils as log_utils
+import DSBplot.utils.sam_utils as sam_utils
+
+PARAMS = {
+  '--align_cache': {
+    'type': str,
+    'help': (
+      'SQLite database file for caching the alignments of read sequences between runs.' +
+      ' Alignments are keyed by the reference sequence, the aligner and its arguments,' +
+      ' and the read sequence, so only read sequences not seen in previous runs are aligned.' +
+      ' The file is created if it does not exist and may be shared by concurrent runs.' +
+      ' Since the alignments are cached by sequence, a cached Bowtie 2 alignment may' +
+      ' have been scored with the base qualities of a read from another run.'
+    ),
+    'dest': 'align_cache_file',
+  },
+  '--align_cache_size': {
+    'type': int,
+    'default': 10000000,
+    'help': (
+      'Maximum number of alignments in the alignment cache.' +
+      ' When exceeded, the least recently used alignments are removed.'
+    ),
+    'dest': 'align_cache_size',
+  },
+}
+
+QUERY_CHUNK_SIZE = 500 # Number of sequences per lookup query (SQLite limits the number of variables)
+TIMEOUT = 600 # Seconds to wait for a lock held by a concurrent run
+
+def get_namespace(ref_seq, aligner, aligner_args):
+  """
+    Get the key identifying the reference sequence and the aligner settings
+    of the cached alignments.
+  """
+  data = json.dumps([ref_seq, aligner, aligner_args])
+  return hashlib.sha256(data.encode('ascii')).hexdigest()
+
+class AlignmentCache:
+  """
+    On-disk cache of the alignments of unique read sequences
+    (see unique_reads.align_library() for the form of the alignments).
+
+    The alignments of all experiments are stored in one table whose key is
+    (namespace, seq), where the namespace identifies the reference sequence
+    and aligner settings (see get_namespace()). Each entry records when it was
+    last used, and the least recently used entries are removed once the table
+    has more than max_size entries.
+  """
+  def __init__(self, file, namespace, max_size):
+    self.file = file
+    self.namespace = namespace
+    self.max_size = max_size
+    file_utils.make_parent_dir(file)
+    self.connection = sqlite3.connect(file, timeout=TIMEOUT)
+    with self.connection:
+      self.connection.execute(
+        'CREATE TABLE IF NOT EXISTS alignments (' +
+        ' namespace TEXT NOT NULL,' +
+        ' seq TEXT NOT NULL,' +
+        ' flag INTEGER NOT NULL,' +
+        ' pos INTEGER NOT NULL,' +
+        ' cigar TEXT NOT NULL,' +
+        ' tags TEXT NOT NULL,' +
+        ' last_used REAL NOT NULL,' +
+        ' PRIMARY KEY (namespace, seq)' +
+        ')'
+      )
+      self.connection.execute(
+        'CREATE INDEX IF NOT EXISTS alignments_last_used ON alignments (last_used)'
+      )
+    log_utils.log_input('Alignment cache: ' + file)
+
+  def lookup(self, seq_list):
+    """
+      Get the cached alignments of the sequences.
+      The sequences found are marked as used.
+
+      Returns
+      -------
+      A dictionary mapping each sequence found in the cache to its alignment.
+    """
+    alignments = {}
+    for i in range(0, len(seq_list), QUERY_CHUNK_SIZE):
+      chunk = seq_list[i : i + QUERY_CHUNK_SIZE]
+      rows = self.connection.execute(
+        'SELECT seq, flag, pos, cigar, tags FROM alignments' +
+        ' WHERE namespace = ? AND seq IN (' + ','.join('?' * len(chunk)) + ')',
+        [self.namespace] + chunk,
+      )
+      for seq, flag, pos, cigar, tags in rows:
+        if flag & sam_utils.FLAG_UNALIGNED:
+          alignments[seq] = None
+        else:
+          alignments[seq] = (flag, pos, cigar, tags.split('\t'))
+    if len(alignments) > 0:
+      now = time.time()
+      with self.connection:
+        self.connection.executemany(
+          'UPDATE alignments SET last_used = ? WHERE namespace = ? AND seq = ?',
+          [(now, self.namespace, seq) for seq in alignments],
+        )
+    return alignments
+
+  def store(self, alignments):
+    """
+      Add alignments to the cache and remove the least recently used
+      entries if the cache is too large.
+    """
+    now = time.time()
+    rows = []
+    for seq, alignment in alignments.items():
+      if alignment is None:
+        rows.append((self.namespace, seq, sam_utils.FLAG_UNALIGNED, 0, '*', '', now))
+      else:
+        flag, pos, cigar, tags = alignment
+        rows.append((self.namespace, seq, flag, pos, cigar, '\t'.join(tags), now))
+    with self.connection:
+      self.connection.executemany(
+        'INSERT OR REPLACE INTO alignments VALUES (?, ?, ?, ?, ?, ?, ?)',
+        rows,
+      )
+      num_entries = self.connection.execute('SELECT COUNT(*) FROM alignments').fetchone()[0]
+      if num_entries > self.max_size:
+        self.connection.execute(
+          'DELETE FROM alignments WHERE rowid IN' +
+          ' (SELECT rowid FROM alignments ORDER BY last_used LIMIT ?)',
+          [num_entries - self.max_size],
+        )
+        log_utils.log(f'Alignment cache: removed {num_entries - self.max_size} entries.')
+
+  def close(self):
+    self.connection.close()
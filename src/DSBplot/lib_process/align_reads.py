@@ -0,0 +1,601 @@
+import os
+import gzip
+import shutil
+import shlex
+import hashlib
+import tempfile
+import threading
+import subprocess
+import concurrent.futures
+
+import DSBplot.utils.constants as constants
+import DSBplot.utils.file_names as file_names
+import DSBplot.utils.file_utils as file_utils
+import DSBplot.utils.log_utils as log_utils
+import DSBplot.utils.sam_utils as sam_utils
+import DSBplot.lib_process.unique_reads as unique_reads
+
+PARAMS = {
+  '--aligner': {
+    'type': str,
+    'choices': ['bowtie2', 'builtin'],
+    'default': 'bowtie2',
+    'help': (
+      'Aligner to use.' +
+      ' "bowtie2" runs Bowtie 2 on each library.' +
+      ' "builtin" uses an in-process aligner that aligns the unique reads of each library' +
+      ' with the scoring of the Bowtie 2 end-to-end mode defaults' +
+      ' (no index is built and Bowtie 2 need not be installed).' +
+      ' The built-in aligner always finds an optimal alignment, so it may occasionally' +
+      ' differ from Bowtie 2, whose search is heuristic.' +
+      ' The Bowtie 2 arguments ("--bt2") and "--bt2_cache" are ignored by the built-in aligner.'
+    ),
+    'dest': 'aligner',
+  },
+  '--threads': {
+    'type': int,
+    'default': 1,
+    'help': (
+      'Total number of threads to use for alignment.' +
+      ' The threads are split between the number of libraries aligned concurrently' +
+      ' and the number of threads given to each Bowtie 2 process (Bowtie 2 flag "-p").' +
+      ' If "-p" or "--threads" is given in the Bowtie 2 arguments, that value is used' +
+      ' for each Bowtie 2 process instead and THREADS only limits the number of' +
+      ' libraries aligned concurrently.'
+    ),
+    'dest': 'threads',
+  },
+  '--bt2_cache': {
+    'type': str,
+    'help': (
+      'Directory for caching Bowtie 2 indexes between runs.' +
+      ' Indexes are keyed by a hash of the reference sequence so that all experiments' +
+      ' using the same reference sequence share a single index, which is built only once.' +
+      ' The directory may be shared by concurrent runs.' +
+      ' If omitted, the index is rebuilt in the OUTPUT directory on every run.'
+    ),
+    'dest': 'bowtie2_cache',
+  },
+  '--collapse': {
+    'type': int,
+    'choices': [0, 1],
+    'default': 0,
+    'help': (
+      'Enable (1) or disable (0) collapsing identical reads before alignment.' +
+      ' If enabled, only the unique read sequences in each library are aligned and each' +
+      ' SAM record stores the number of reads it represents in its QNAME' +
+      ' (see the README), which is used by stage "1_filter".' +
+      ' Each unique sequence is aligned with the base qualities of its first occurrence,' +
+      ' so the output of stage "1_filter" is the same as without collapsing.'
+    ),
+    'dest': 'collapse',
+  },
+  '--stream': {
+    'type': int,
+    'choices': [0, 1],
+    'default': 0,
+    'help': (
+      'Enable (1) or disable (0) streaming the Bowtie 2 output directly into stage "1_filter".' +
+      ' If enabled, stages "0_align" and "1_filter" must be run in the same command;' +
+      ' the reads are filtered while the alignment is still running and no SAM files are written' +
+      ' (unless "--stream_sam 1" is used). The libraries are aligned one at a time' +
+      ' using all THREADS.'
+    ),
+    'dest': 'stream',
+  },
+  '--stream_sam': {
+    'type': int,
+    'choices': [0, 1],
+    'default': 0,
+    'help': (
+      'If streaming with "--stream 1", enable (1) or disable (0) also writing the' +
+      ' alignments of each library to a gzip-compressed SAM file.'
+    ),
+    'dest': 'stream_sam',
+  },
+}
+
+def get_bowtie2_input_flag(input_file):
+  """
+    Get the Bowtie 2 flag for the format of the input reads file.
+    FASTQ files use "-q", FASTA files use "-f", and all other files use "-r".
+    Compression extensions are ignored (e.g., ".fq.gz" uses "-q").
+  """
+  ext = file_utils.get_ext(input_file)
+  if ext in constants.FASTQ_EXT:
+    return '-q'
+  elif ext in constants.FASTA_EXT:
+    return '-f'
+  else:
+    return '-r'
+
+def is_bowtie2_readable(input_file):
+  """
+    Check if Bowtie 2 can read the input file itself.
+    Bowtie 2 reads uncompressed and gzip-compressed files. Files with other
+    compressions are decompressed by file_utils.open_text() and piped into
+    the standard input of Bowtie 2.
+  """
+  return file_utils.get_compression(input_file) in [None, 'gz', 'bgz']
+
+def feed_reads(input_file, stdin):
+  """
+    Write the decompressed input file into the standard input of Bowtie 2.
+  """
+  try:
+    with file_utils.open_text(input_file) as input:
+      for line in input:
+        stdin.write(line)
+  except BrokenPipeError:
+    pass # Bowtie 2 exited early, its return code reports the error
+  finally:
+    try:
+      stdin.close()
+    except BrokenPipeError:
+      pass
+
+def start_bowtie2(command, input_file, **popen_args):
+  """
+    Start a Bowtie 2 command made by get_bowtie2_command().
+    If Bowtie 2 cannot read the input file itself, a thread is started
+    that pipes the decompressed input into Bowtie 2.
+
+    Returns
+    -------
+    A tuple (process, feeder) with the subprocess.Popen object and
+    the feeder thread (or None).
+  """
+  if is_bowtie2_readable(input_file):
+    return subprocess.Popen(command, **popen_args), None
+  popen_args = {'text': True, **popen_args}
+  process = subprocess.Popen(command, stdin=subprocess.PIPE, **popen_args)
+  feeder = threading.Thread(target=feed_reads, args=(input_file, process.stdin), daemon=True)
+  feeder.start()
+  return process, feeder
+
+def split_bowtie2_args(bowtie2_args):
+  """
+    Split the user given Bowtie 2 arguments into a list of tokens.
+    Each argument may itself contain multiple space-separated tokens.
+  """
+  return shlex.split(' '.join(bowtie2_args))
+
+def has_threads_arg(bowtie2_args):
+  return any(
+    (x in ['-p', '--threads']) or x.startswith('--threads=')
+    for x in bowtie2_args
+  )
+
+def get_threads_arg(bowtie2_args):
+  """
+    Get the value of the last "-p"/"--threads" argument as given by the user
+    (see has_threads_arg()).
+  """
+  value = None
+  for i, x in enumerate(bowtie2_args):
+    if (x in ['-p', '--threads']) and (i + 1 < len(bowtie2_args)):
+      value = bowtie2_args[i + 1]
+    elif x.startswith('--threads='):
+      value = x[len('--threads='):]
+  return value
+
+def remove_threads_args(bowtie2_args):
+  """
+    Remove the Bowtie 2 arguments that only affect the threads used
+    (and not the alignments), e.g., for comparing the arguments of runs.
+  """
+  result = []
+  skip = False
+  for x in bowtie2_args:
+    if skip:
+      skip = False
+    elif x in ['-p', '--threads']:
+      skip = True
+    elif not (x.startswith('--threads=') or (x == '--reorder')):
+      result.append(x)
+  return result
+
+def get_thread_split(num_threads, num_jobs):
+  """
+    Split a thread budget between concurrent jobs.
+    The split that minimizes the expected wall time (number of rounds of jobs
+    divided by the threads per job) is chosen, preferring more concurrent
+    jobs on ties since separate processes scale better than threads.
+
+    Parameters
+    ----------
+    num_threads : total number of threads available.
+    num_jobs    : number of jobs to run.
+
+    Returns
+    -------
+    A tuple (num_parallel, job_threads) :
+      num_parallel : number of jobs to run concurrently.
+      job_threads  : number of threads to give each job.
+  """
+  num_threads = max(1, num_threads)
+  num_jobs = max(1, num_jobs)
+  best = None
+  for num_parallel in range(1, min(num_threads, num_jobs) + 1):
+    job_threads = num_threads // num_parallel
+    num_rounds = -(-num_jobs // num_parallel) # ceiling division
+    cost = num_rounds / job_threads
+    if (best is None) or (cost <= best[0]):
+      best = (cost, num_parallel, job_threads)
+  return best[1], best[2]
+
+def get_ref_seq_key(ref_seq):
+  """
+    Get the key identifying a reference sequence in the Bowtie 2 index cache.
+  """
+  return hashlib.sha256(ref_seq.encode('ascii')).hexdigest()
+
+def run_bowtie2_build(ref_seq_file, bowtie2_index_file):
+  command = ['bowtie2-build-s', ref_seq_file, bowtie2_index_file, '--quiet']
+  if subprocess.run(command).returncode != 0:
+    raise Exception('Bowtie 2 build failed.')
+
+def build_bowtie2_index(ref_seq_file, output, bowtie2_cache):
+  """
+    Build the Bowtie 2 index for the reference sequence.
+
+    If bowtie2_cache is None, the index is rebuilt in the output directory.
+    Otherwise, the index is looked up in the cache directory by the hash of
+    the reference sequence and is only built if it is not present.
+    The index is built in a temporary directory that is renamed to its final
+    location once complete, so concurrent runs never see a partial index.
+    If two runs build the same index at the same time, the one that finishes
+    last discards its copy.
+
+    Parameters
+    ----------
+    ref_seq_file  : reference sequence file.
+    output        : the output directory of the experiment.
+    bowtie2_cache : the cache directory or None.
+
+    Returns
+    -------
+    The Bowtie 2 index prefix to use for alignment.
+  """
+  if bowtie2_cache is None:
+    bowtie2_index_file = file_names.bowtie2_index(output)
+    # Existing Bowtie 2 index files must be overwritten.
+    # For some reason, Bowtie 2 does not overwrite the index file if it already exists.
+    file_utils.make_parent_dir(bowtie2_index_file, overwrite=True)
+    log_utils.log_output('Bowtie2 index file: ' + bowtie2_index_file)
+    run_bowtie2_build(ref_seq_file, bowtie2_index_file)
+    return bowtie2_index_file
+
+  key = get_ref_seq_key(file_utils.read_seq(ref_seq_file))
+  bowtie2_index_file = file_names.bowtie2_index_cache(bowtie2_cache, key)
+  bowtie2_index_dir = os.path.dirname(bowtie2_index_file)
+  if os.path.isdir(bowtie2_index_dir):
+    log_utils.log_input('Bowtie2 index file (cached): ' + bowtie2_index_file)
+    return bowtie2_index_file
+
+  file_utils.make_dir(bowtie2_cache)
+  temp_dir = tempfile.mkdtemp(prefix=key + '.', suffix='.tmp', dir=bowtie2_cache)
+  try:
+    run_bowtie2_build(
+      ref_seq_file,
+      os.path.join(temp_dir, os.path.basename(bowtie2_index_file)),
+    )
+    try:
+      os.rename(temp_dir, bowtie2_index_dir)
+    except OSError:
+      # Another run finished building the same index first.
+      if not os.path.isdir(bowtie2_index_dir):
+        raise
+  finally:
+    if os.path.isdir(temp_dir):
+      shutil.rmtree(temp_dir)
+  log_utils.log_output('Bowtie2 index file (cached): ' + bowtie2_index_file)
+  return bowtie2_index_file
+
+def collapse_reads(input_file, output_file):
+  """
+    Collapse identical reads into a FASTQ file of the unique sequences
+    (see unique_reads.count_unique_reads() and unique_reads.write_collapsed_reads()).
+
+    Parameters
+    ----------
+    input_file  : FASTQ, FASTA, or text file of reads (see file_utils.iter_reads()).
+    output_file : output FASTQ file.
+
+    Returns
+    -------
+    A tuple (num_reads, num_unique) :
+      num_reads  : the total number of reads in the input.
+      num_unique : the number of unique sequences written.
+  """
+  seq_count, seq_qual = unique_reads.count_unique_reads(input_file)
+  unique_reads.write_collapsed_reads(seq_count, seq_qual, output_file)
+  return sum(seq_count.values()), len(seq_count)
+
+def get_bowtie2_command(
+  input_file,
+  sam_file,
+  bowtie2_index_file,
+  bowtie2_args,
+  job_threads,
+):
+  """
+    Get the Bowtie 2 alignment command as a list of arguments.
+    If multiple threads are used "--reorder" is added so the SAM records
+    are output in the same order as the input reads.
+    If sam_file is None the SAM records are written to the standard output.
+    If Bowtie 2 cannot read the input file itself (see is_bowtie2_readable())
+    the reads are read from the standard input.
+  """
+  command = ['bowtie2-align-s', '--no-hd', get_bowtie2_input_flag(input_file)]
+  command += bowtie2_args
+  if not has_threads_arg(bowtie2_args):
+    if job_threads > 1:
+      command += ['-p', str(job_threads), '--reorder']
+  elif '--reorder' not in bowtie2_args:
+    command += ['--reorder']
+  command += ['-x', bowtie2_index_file]
+  command += [input_file if is_bowtie2_readable(input_file) else '-']
+  if sam_file is not None:
+    command += ['-S', sam_file]
+  command += ['--quiet']
+  return command
+
+def align_unique_reads(seq_qual, bowtie2_index_file, bowtie2_args, threads):
+  """
+    Align unique read sequences with Bowtie 2
+    (see unique_reads.align_library() for the form of the alignments).
+    The reads are written to a temporary FASTQ file (FASTA if they have no
+    qualities) named by their index.
+
+    Parameters
+    ----------
+    seq_qual           : dictionary mapping each read sequence to its quality
+      string or None (see unique_reads.count_unique_reads()).
+    bowtie2_index_file : Bowtie 2 index prefix.
+    bowtie2_args       : list of additional arguments for Bowtie 2.
+    threads            : number of threads for Bowtie 2.
+
+    Returns
+    -------
+    A dictionary mapping each sequence to its alignment.
+  """
+  bowtie2_args = split_bowtie2_args(bowtie2_args)
+  seq_list = list(seq_qual.keys())
+  fastq = all(seq_qual[x] is not None for x in seq_list)
+  with tempfile.TemporaryDirectory() as temp_dir:
+    reads_file = os.path.join(temp_dir, 'reads.fq' if fastq else 'reads.fa')
+    with open(reads_file, 'w') as output:
+      for index, seq in enumerate(seq_list):
+        if fastq:
+          output.write(f'@{index}\n{seq}\n+\n{seq_qual[seq]}\n')
+        else:
+          output.write(f'>{index}\n{seq}\n')
+    command = get_bowtie2_command(
+      input_file = reads_file,
+      sam_file = None,
+      bowtie2_index_file = bowtie2_index_file,
+      bowtie2_args = bowtie2_args,
+      job_threads = max(1, threads),
+    )
+    log_utils.log('Bowtie 2 command: ' + ' '.join(command))
+    alignments = {}
+    with subprocess.Popen(command, stdout=subprocess.PIPE, text=True) as process:
+      for line in process.stdout:
+        if line.startswith('@'):
+          continue
+        fields = line.rstrip('\n').split('\t')
+        seq = seq_list[int(fields[0])]
+        flag = int(fields[1])
+        if flag & sam_utils.FLAG_UNALIGNED:
+          alignments[seq] = None
+        else:
+          alignments[seq] = (flag, int(fields[3]), fields[5], fields[11:])
+    if process.returncode != 0:
+      raise Exception('Bowtie 2 alignment failed.')
+  if len(alignments) != len(seq_list):
+    raise Exception('Bowtie 2 did not output an alignment for every read.')
+  return alignments
+
+def align_library(
+  input_file,
+  sam_file,
+  bowtie2_index_file,
+  bowtie2_args,
+  job_threads,
+  collapsed_file,
+):
+  """
+    Align a single library with Bowtie 2.
+    If collapsed_file is not None, the reads are first collapsed into
+    this file and only the unique sequences are aligned.
+  """
+  if collapsed_file is not None:
+    num_reads, num_unique = collapse_reads(input_file, collapsed_file)
+    log_utils.log(f'Collapsed {input_file}: {num_unique} unique / {num_reads} reads.')
+    input_file = collapsed_file
+  command = get_bowtie2_command(
+    input_file = input_file,
+    sam_file = sam_file,
+    bowtie2_index_file = bowtie2_index_file,
+    bowtie2_args = bowtie2_args,
+    job_threads = job_threads,
+  )
+  log_utils.log('Bowtie 2 command: ' + ' '.join(command))
+  process, feeder = start_bowtie2(command, input_file)
+  return_code = process.wait()
+  if feeder is not None:
+    feeder.join()
+  if return_code != 0:
+    raise Exception('Bowtie 2 alignment failed.')
+
+def align_libraries(
+  input_list,
+  sam_list,
+  bowtie2_index_file,
+  bowtie2_args,
+  threads,
+  collapsed_list = None,
+):
+  """
+    Align each input library with Bowtie 2, running libraries concurrently.
+
+    Parameters
+    ----------
+    input_list         : input reads files.
+    sam_list           : output SAM files, one for each input file.
+    bowtie2_index_file : Bowtie 2 index prefix.
+    bowtie2_args       : list of additional arguments for Bowtie 2.
+    threads            : total number of threads to use.
+    collapsed_list     : if not None, the FASTQ files to collapse the reads
+      of each input file into before alignment.
+  """
+  bowtie2_args = split_bowtie2_args(bowtie2_args)
+  num_parallel, job_threads = get_thread_split(threads, len(input_list))
+  threads_each = job_threads
+  if has_threads_arg(bowtie2_args):
+    # Bowtie 2 uses the given "-p" value instead of job_threads (see get_bowtie2_command())
+    num_parallel = min(max(1, threads), len(input_list))
+    threads_each = get_threads_arg(bowtie2_args)
+  if collapsed_list is None:
+    collapsed_list = [None] * len(input_list)
+  log_utils.log(
+    f'Aligning {len(input_list)} libraries: {num_parallel} concurrent,' +
+    f' {threads_each} threads each.'
+  )
+  with concurrent.futures.ThreadPoolExecutor(max_workers=num_parallel) as executor:
+    futures = [
+      executor.submit(
+        align_library,
+        input_file = input_list[i],
+        sam_file = sam_list[i],
+        bowtie2_index_file = bowtie2_index_file,
+        bowtie2_args = bowtie2_args,
+        job_threads = job_threads,
+        collapsed_file = collapsed_list[i],
+      )
+      for i in range(len(input_list))
+    ]
+    for future in futures:
+      future.result()
+
+class Bowtie2Stream:
+  """
+    Stream the SAM records of a Bowtie 2 alignment without writing a SAM file.
+
+    This is a context manager. Entering it starts Bowtie 2 and returns an
+    iterator over the SAM lines written by Bowtie 2. Exiting it waits for
+    Bowtie 2 to finish and raises an exception if the alignment failed.
+    If tee_file is not None, the SAM lines are also written to this file
+    with gzip compression.
+  """
+  def __init__(
+    self,
+    input_file,
+    bowtie2_index_file,
+    bowtie2_args,
+    job_threads,
+    collapsed_file = None,
+    tee_file = None,
+  ):
+    self.input_file = input_file
+    self.bowtie2_index_file = bowtie2_index_file
+    self.bowtie2_args = bowtie2_args
+    self.job_threads = job_threads
+    self.collapsed_file = collapsed_file
+    self.tee_file = tee_file
+    self.process = None
+    self.feeder = None
+    self.tee = None
+
+  def __str__(self):
+    return 'Bowtie 2 stream: ' + self.input_file
+
+  def tee_lines(self, lines):
+    for line in lines:
+      self.tee.write(line)
+      yield line
+
+  def __enter__(self):
+    input_file = self.input_file
+    if self.collapsed_file is not None:
+      num_reads, num_unique = collapse_reads(input_file, self.collapsed_file)
+      log_utils.log(f'Collapsed {input_file}: {num_unique} unique / {num_reads} reads.')
+      input_file = self.collapsed_file
+    command = get_bowtie2_command(
+      input_file = input_file,
+      sam_file = None,
+      bowtie2_index_file = self.bowtie2_index_file,
+      bowtie2_args = self.bowtie2_args,
+      job_threads = self.job_threads,
+    )
+    log_utils.log('Bowtie 2 command: ' + ' '.join(command))
+    self.process, self.feeder = start_bowtie2(
+      command,
+      input_file,
+      stdout = subprocess.PIPE,
+      text = True,
+      bufsize = 1 << 20,
+    )
+    lines = self.process.stdout
+    if self.tee_file is not None:
+      file_utils.make_parent_dir(self.tee_file)
+      self.tee = gzip.open(self.tee_file, 'wt', compresslevel=6)
+      lines = self.tee_lines(lines)
+    return lines
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is not None:
+      self.process.kill()
+    self.process.stdout.close()
+    return_code = self.process.wait()
+    if self.feeder is not None:
+      self.feeder.join()
+    if self.tee is not None:
+      self.tee.close()
+      log_utils.log_output(self.tee_file)
+    if (exc_type is None) and (return_code != 0):
+      raise Exception('Bowtie 2 alignment failed.')
+    return False
+
+def stream_libraries(
+  input_list,
+  bowtie2_index_file,
+  bowtie2_args,
+  threads,
+  collapsed_list = None,
+  tee_list = None,
+):
+  """
+    Get a Bowtie2Stream for each input library.
+    The alignment of each library starts when its stream is entered, so the
+    libraries are aligned one at a time as they are filtered, each using all
+    the threads.
+
+    Parameters
+    ----------
+    input_list         : input reads files.
+    bowtie2_index_file : Bowtie 2 index prefix.
+    bowtie2_args       : list of additional arguments for Bowtie 2.
+    threads            : number of threads for each Bowtie 2 process.
+    collapsed_list     : if not None, the FASTQ files to collapse the reads
+      of each input file into before alignment.
+    tee_list           : if not None, the gzip-compressed SAM files to write the
+      alignments of each input file to.
+  """
+  bowtie2_args = split_bowtie2_args(bowtie2_args)
+  if collapsed_list is None:
+    collapsed_list = [None] * len(input_list)
+  if tee_list is None:
+    tee_list = [None] * len(input_list)
+  return [
+    Bowtie2Stream(
+      input_file = input_list[i],
+      bowtie2_index_file = bowtie2_index_file,
+      bowtie2_args = bowtie2_args,
+      job_threads = max(1, threads),
+      collapsed_file = collapsed_list[i],
+      tee_file = tee_list[i],
+    )
+    for i in range(len(input_list))
+  ]
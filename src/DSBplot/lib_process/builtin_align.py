@@ -0,0 +1,330 @@
+import concurrent.futures
+
+import numpy as np
+
+import DSBplot.utils.sam_utils as sam_utils
+
+# Scoring of the Bowtie 2 end-to-end mode defaults
+# (--mp 6,2 --np 1 --rdg 5,3 --rfg 5,3 --score-min L,-0.6,-0.6).
+MISMATCH_PENALTY_MAX = 6
+MISMATCH_PENALTY_MIN = 2
+N_PENALTY = 1
+GAP_OPEN_PENALTY = 5
+GAP_EXTEND_PENALTY = 3
+SCORE_MIN_CONST = -0.6
+SCORE_MIN_LINEAR = -0.6
+
+BATCH_SIZE = 256 # Number of reads aligned together in one vectorized batch
+NEG_INF = -(1 << 28) # Score of impossible cells
+
+# Bits of the traceback matrix
+TRACE_H_FROM_E = 1 # H comes from a deletion (E)
+TRACE_H0_FROM_F = 2 # H without deletions comes from an insertion (F)
+TRACE_E_EXTEND = 4 # E extends a deletion
+TRACE_F_EXTEND = 8 # F extends an insertion
+
+# States and operations of the traceback
+STATE_H = 0
+STATE_H0 = 1
+STATE_E = 2
+STATE_F = 3
+OP_NONE = 0
+OP_MATCH = 1
+OP_INS = 2
+OP_DEL = 3
+CIGAR_OPS = ['', 'M', 'I', 'D']
+
+def get_min_score(read_length):
+  """
+    Get the minimum score of a valid alignment (Bowtie 2 "--score-min").
+  """
+  return SCORE_MIN_CONST + SCORE_MIN_LINEAR * read_length
+
+def get_mismatch_penalties(qual_list):
+  """
+    Get the mismatch penalty of each read position from the base qualities,
+    as with Bowtie 2: MN + floor((MX - MN) * min(Q, 40) / 40).
+    Reads without qualities (None) get the maximum penalty.
+  """
+  penalties = []
+  for qual in qual_list:
+    if qual is None:
+      penalties.append(None)
+    else:
+      q = np.minimum(np.frombuffer(qual.encode('ascii'), dtype=np.uint8).astype(np.int32) - 33, 40)
+      penalties.append(
+        MISMATCH_PENALTY_MIN +
+        ((MISMATCH_PENALTY_MAX - MISMATCH_PENALTY_MIN) * q) // 40
+      )
+  return penalties
+
+def encode_seqs(seq_list):
+  """
+    Encode sequences of the same length as a 2D uint8 array of ASCII codes.
+  """
+  return np.frombuffer(
+    ''.join(seq_list).encode('ascii'),
+    dtype = np.uint8,
+  ).reshape(len(seq_list), -1)
+
+def get_cigar(ops):
+  """
+    Get the CIGAR string of a list of alignment operations.
+  """
+  cigar = ''
+  count = 0
+  for i in range(len(ops)):
+    count += 1
+    if (i == len(ops) - 1) or (ops[i + 1] != ops[i]):
+      cigar += str(count) + CIGAR_OPS[ops[i]]
+      count = 0
+  return cigar
+
+def align_batch(ref_seq, read_list, qual_list=None):
+  """
+    Align a batch of reads of the same length to the reference sequence.
+
+    The alignment is global on the read and local on the reference
+    (the read must be aligned end-to-end but may start and end anywhere on
+    the reference, as in the Bowtie 2 end-to-end mode) with affine gap
+    penalties. The dynamic programming is vectorized over the reads of the
+    batch and the reference positions; the deletions within a row are
+    computed with a prefix maximum so that no loop over the reference
+    positions is needed.
+
+    Parameters
+    ----------
+    ref_seq   : the reference sequence.
+    read_list : list of read sequences, all of the same length.
+    qual_list : list of the FASTQ quality strings of the reads (None for
+      reads without qualities), or None if no read has qualities.
+
+    Returns
+    -------
+    A list with a tuple (score, pos, cigar, num_sub, num_indel) for each read :
+      score     : alignment score (0 is a perfect match).
+      pos       : 1-based position of the first aligned reference nucleotide.
+      cigar     : the CIGAR string.
+      num_sub   : number of mismatches (Bowtie 2 XM tag).
+      num_indel : number of inserted and deleted nucleotides (Bowtie 2 XG tag).
+  """
+  num_reads = len(read_list)
+  read_length = len(read_list[0])
+  ref_length = len(ref_seq)
+  ref = encode_seqs([ref_seq])[0]
+  reads = encode_seqs(read_list)
+  ref_n = ref == ord('N')
+  reads_n = reads == ord('N')
+  mismatch = np.full((num_reads, read_length), MISMATCH_PENALTY_MAX, dtype=np.int32)
+  if qual_list is not None:
+    for k, penalties in enumerate(get_mismatch_penalties(qual_list)):
+      if penalties is not None:
+        mismatch[k] = penalties
+
+  gap_open = GAP_OPEN_PENALTY + GAP_EXTEND_PENALTY # Penalty of the first nucleotide of a gap
+  gap_extend = GAP_EXTEND_PENALTY
+  col_gap = gap_extend * np.arange(ref_length + 1, dtype=np.int32)
+
+  # Row 0: the read may start anywhere on the reference
+  h = np.zeros((num_reads, ref_length + 1), dtype=np.int32)
+  f = np.full((num_reads, ref_length + 1), NEG_INF, dtype=np.int32)
+  trace = np.zeros((read_length + 1, num_reads, ref_length + 1), dtype=np.uint8)
+
+  for i in range(1, read_length + 1):
+    read_i = reads[:, i - 1][:, None]
+    sub = np.where(
+      read_i == ref[None, :],
+      0,
+      np.where(reads_n[:, i - 1][:, None] | ref_n[None, :], -N_PENALTY, -mismatch[:, i - 1][:, None]),
+    )
+
+    # Insertion (read nucleotide against a gap)
+    f_open = h - gap_open
+    f_extend = f - gap_extend
+    f = np.maximum(f_open, f_extend)
+    trace_i = np.where(f_extend > f_open, TRACE_F_EXTEND, 0).astype(np.uint8)
+
+    # Match or mismatch
+    h0 = np.empty_like(h)
+    h0[:, 0] = f[:, 0] # Only insertions are possible in column 0
+    h0[:, 1:] = np.maximum(h[:, :-1] + sub, f[:, 1:])
+    trace_i[:, 1:] |= np.where(h[:, :-1] + sub >= f[:, 1:], 0, TRACE_H0_FROM_F).astype(np.uint8)
+    trace_i[:, 0] |= TRACE_H0_FROM_F
+
+    # Deletion (reference nucleotide against a gap):
+    #   E[j] = max(H0[j - 1] - open, E[j - 1] - extend)
+    #        = max_{k < j} (H0[k] + extend * k) - open + extend - extend * j
+    e = np.full_like(h, NEG_INF)
+    e[:, 1:] = (
+      np.maximum.accumulate(h0 + col_gap, axis=1)[:, :-1] -
+      gap_open + gap_extend - col_gap[1:]
+    )
+    e_open = h0[:, :-1] - gap_open
+    trace_i[:, 1:] |= np.where(e[:, 1:] > e_open, TRACE_E_EXTEND, 0).astype(np.uint8)
+
+    h = np.maximum(h0, e)
+    trace_i |= np.where(e > h0, TRACE_H_FROM_E, 0).astype(np.uint8)
+    trace[i] = trace_i
+
+  # The read may end anywhere on the reference
+  end = np.argmax(h[:, 1:], axis=1) + 1
+  score = h[np.arange(num_reads), end]
+
+  # Traceback, vectorized over the reads.
+  # The state transitions within a cell are applied in order so that every
+  # read that is not finished moves by exactly one operation per step.
+  row = np.full(num_reads, read_length)
+  col = end.copy()
+  state = np.full(num_reads, STATE_H)
+  ops = np.zeros((num_reads, read_length + ref_length), dtype=np.uint8)
+  read_index = np.arange(num_reads)
+  step = 0
+  while True:
+    active = row > 0
+    if not np.any(active):
+      break
+    t = trace[row, read_index, col]
+
+    is_h = active & (state == STATE_H)
+    to_e = is_h & ((t & TRACE_H_FROM_E) != 0)
+    state[to_e] = STATE_E
+    state[is_h & ~to_e] = STATE_H0
+
+    is_h0 = active & (state == STATE_H0)
+    to_f = is_h0 & ((t & TRACE_H0_FROM_F) != 0)
+    state[to_f] = STATE_F
+    is_diag = is_h0 & ~to_f
+    ops[is_diag, step] = OP_MATCH
+    row[is_diag] -= 1
+    col[is_diag] -= 1
+    state[is_diag] = STATE_H
+
+    is_e = active & (state == STATE_E)
+    ops[is_e, step] = OP_DEL
+    col[is_e] -= 1
+    state[is_e & ((t & TRACE_E_EXTEND) == 0)] = STATE_H0
+
+    is_f = active & (state == STATE_F)
+    ops[is_f, step] = OP_INS
+    row[is_f] -= 1
+    state[is_f & ((t & TRACE_F_EXTEND) == 0)] = STATE_H
+
+    step += 1
+
+  results = []
+  for k in range(num_reads):
+    read_ops = ops[k][ops[k] != OP_NONE][::-1]
+    pos = int(col[k]) + 1
+    num_sub = 0
+    num_indel = 0
+    ref_i = pos - 1
+    read_i = 0
+    read_seq = read_list[k]
+    for x in read_ops:
+      if x == OP_MATCH:
+        if read_seq[read_i] != ref_seq[ref_i]:
+          num_sub += 1
+        read_i += 1
+        ref_i += 1
+      elif x == OP_INS:
+        num_indel += 1
+        read_i += 1
+      else:
+        num_indel += 1
+        ref_i += 1
+    results.append((int(score[k]), pos, get_cigar(list(read_ops)), num_sub, num_indel))
+  return results
+
+def get_alignment_record(ref_seq, read_seq, score, pos, cigar, num_sub, num_indel, rc):
+  """
+    Get the alignment of a read in the form stored by align_unique_reads().
+    Unaligned reads (score below the Bowtie 2 minimum) are represented by None.
+  """
+  if (len(read_seq) == 0) or (score < get_min_score(len(read_seq))):
+    return None
+  num_open = cigar.count('I') + cigar.count('D')
+  return (
+    sam_utils.FLAG_RC if rc else 0,
+    pos,
+    cigar,
+    [
+      f'AS:i:{score}',
+      'XN:i:0',
+      f'XM:i:{num_sub}',
+      f'XO:i:{num_open}',
+      f'XG:i:{num_indel}',
+      f'NM:i:{num_sub + num_indel}',
+      'YT:Z:UU',
+    ],
+  )
+
+def align_batch_both_strands(ref_seq, read_list, qual_list):
+  """
+    Align a batch of reads of the same length on both strands and keep the
+    better alignment of each read (the forward strand on ties).
+    See get_alignment_record() for the form of the alignments.
+  """
+  if len(read_list[0]) == 0:
+    return [None] * len(read_list)
+  results = align_batch(
+    ref_seq,
+    read_list + [sam_utils.reverse_complement(x) for x in read_list],
+    qual_list + [None if x is None else x[::-1] for x in qual_list],
+  )
+  forward = results[:len(read_list)]
+  reverse = results[len(read_list):]
+  alignments = []
+  for i in range(len(read_list)):
+    if reverse[i][0] > forward[i][0]:
+      alignments.append(get_alignment_record(ref_seq, read_list[i], *reverse[i], True))
+    else:
+      alignments.append(get_alignment_record(ref_seq, read_list[i], *forward[i], False))
+  return alignments
+
+def align_unique_reads(ref_seq, seq_qual, threads):
+  """
+    Align unique read sequences to the reference sequence.
+    The reads are grouped into batches of the same length that are aligned
+    in parallel processes.
+
+    Parameters
+    ----------
+    ref_seq  : the reference sequence.
+    seq_qual : dictionary mapping each unique read sequence to the quality
+      string used for scoring its mismatches (or None).
+    threads  : number of processes to use.
+
+    Returns
+    -------
+    A dictionary mapping each read sequence to its alignment
+    (see unique_reads.align_library() for the form of the alignments).
+  """
+  seq_by_length = {}
+  for seq in seq_qual:
+    seq_by_length.setdefault(len(seq), []).append(seq)
+  batch_list = []
+  for length in sorted(seq_by_length):
+    seqs = seq_by_length[length]
+    for i in range(0, len(seqs), BATCH_SIZE):
+      batch_list.append(seqs[i : i + BATCH_SIZE])
+  qual_list = [[seq_qual[x] for x in batch] for batch in batch_list]
+
+  if (threads > 1) and (len(batch_list) > 1):
+    with concurrent.futures.ProcessPoolExecutor(max_workers=threads) as executor:
+      result_list = list(executor.map(
+        align_batch_both_strands,
+        [ref_seq] * len(batch_list),
+        batch_list,
+        qual_list,
+        chunksize = max(1, len(batch_list) // (4 * threads)),
+      ))
+  else:
+    result_list = [
+      align_batch_both_strands(ref_seq, batch_list[i], qual_list[i])
+      for i in range(len(batch_list))
+    ]
+
+  alignments = {}
+  for batch, results in zip(batch_list, result_list):
+    alignments.update(zip(batch, results))
+  return alignments
@@ -0,0 +1,78 @@
+import DSBplot.utils.sam_utils as sam_utils
+
+PARAMS = {
+  '--exact_ref': {
+    'type': int,
+    'choices': [0, 1],
+    'default': 0,
+    'help': (
+      'Enable (1) or disable (0) bypassing the alignment of reads that exactly match the' +
+      ' reference sequence (i.e., reads equal to a prefix of the reference sequence,' +
+      ' or whose reverse complement is).' +
+      ' These reads get a perfect alignment at position 1 without being aligned,' +
+      ' which is what Bowtie 2 finds for them, and stage "1_filter" accepts them without' +
+      ' realignment. Useful if most reads are wild-type.'
+    ),
+    'dest': 'exact_ref',
+  },
+}
+
+class ExactMatcher:
+  """
+    Recognizes the reads that are exact copies of the start of the reference
+    sequence (on either strand) with a hash set of the reference prefixes.
+  """
+  def __init__(self, ref_seq):
+    self.prefixes = set(ref_seq[:i] for i in range(1, len(ref_seq) + 1))
+
+  def get_alignment(self, read_seq):
+    """
+      Get the alignment of an exact read (see unique_reads.align_library()
+      for the form of the alignments) or None if the read is not exact.
+    """
+    if read_seq in self.prefixes:
+      flag = 0
+    elif sam_utils.reverse_complement(read_seq) in self.prefixes:
+      flag = sam_utils.FLAG_RC
+    else:
+      return None
+    return (
+      flag,
+      1,
+      str(len(read_seq)) + 'M',
+      [
+        'AS:i:0',
+        'XN:i:0',
+        'XM:i:0',
+        'XO:i:0',
+        'XG:i:0',
+        'NM:i:0',
+        'MD:Z:' + str(len(read_seq)),
+        'YT:Z:UU',
+      ],
+    )
+
+  def apply(self, seq_qual):
+    """
+      Get the alignments of the exact reads of a library.
+
+      Parameters
+      ----------
+      seq_qual : dictionary mapping each read sequence to its quality string
+        (see unique_reads.count_unique_reads()).
+
+      Returns
+      -------
+      A tuple (seq_qual_rest, alignments) :
+        seq_qual_rest : the part of seq_qual with the reads that are not exact.
+        alignments    : dictionary mapping each exact read to its alignment.
+    """
+    seq_qual_rest = {}
+    alignments = {}
+    for seq, qual in seq_qual.items():
+      alignment = self.get_alignment(seq)
+      if alignment is None:
+        seq_qual_rest[seq] = qual
+      else:
+        alignments[seq] = alignment
+    return seq_qual_rest, alignments
@@ -1,5 +1,15 @@
+import os
+import time
+import array
+import heapq
+import zlib
+import pickle
+import operator
+import itertools
 import argparse
-from collections import defaultdict
+import tempfile
+import concurrent.futures
+import numpy as np
 import pandas as pd
 
 import DSBplot.utils.constants as constants
@@ -7,11 +17,50 @@ import DSBplot.utils.file_names as file_names
 import DSBplot.utils.file_utils as file_utils
 import DSBplot.utils.common_utils as common_utils
 import DSBplot.utils.sam_utils as sam_utils
+import DSBplot.utils.bam_utils as bam_utils
 import DSBplot.utils.alignment_utils as alignment_utils
 import DSBplot.utils.log_utils as log_utils
+import DSBplot.utils.kmer_utils as kmer_utils
+import DSBplot.lib_process.read_table as read_table
 
 RANK_NA = 999999999 # For indicating the sequence did not appear in the library
 MAX_SUBST_INF = 999999999 # For indicating an infinite number of substitutions are allowed
+MIN_SHARD_SIZE = 1 << 20 # Minimum number of bytes of a shard of a SAM file (see get_shards())
+PARTITION_INDEX_BUFFER = 1 << 16 # Line numbers buffered per partition before writing (see partition_input())
+CLASSIFY_BATCH_SIZE = 10000 # Number of new sequences classified together (see classify_records())
+PARTITION_CHUNK_SIZE = 100000 # Rows per chunk of the partition row files and of the output tables
+
+# Debug categories of the accepted and rejected reads
+ACCEPTED_CATEGORIES = [
+  'ins_and_del_realign',
+  'ins_realign',
+  'del_realign',
+  'indel_other',
+  'no_indel',
+]
+REJECTED_CATEGORIES = [
+  'wrong_flag',
+  'unaligned',
+  'wrong_rc',
+  'pos_not_1',
+  'too_short',
+  'not_consec',
+  'not_touch',
+  'not_consec_and_not_touch',
+  'max_sub',
+]
+
+# Code paths timed for the metrics file (see write_metrics())
+TIMED_PATHS = [
+  'partition', # splitting the input files into partitions (see partition_input())
+  'parse', # reading and parsing the SAM records and counting the repeated sequences
+  'record_checks', # checks on the fields of the SAM records (see check_read_record())
+  'alignment', # reconstructing the alignments (see alignment_utils.get_alignment_batch())
+  'realignment', # realigning the in/dels (see get_realignment())
+  'alignment_checks', # checks on the alignments (see classify_alignment())
+  'merge', # merging the classified sequences into the read table (see merge_library())
+  'output', # ranking the reads and writing the read tables
+]
 
 def check_consecutive_indel(ins_pos, del_pos):
   if (len(ins_pos) == 0) and (len(del_pos) == 0): # no in/dels
@@ -41,6 +90,19 @@ def check_dsb_touches_indel(dsb_pos, ins_pos, del_pos):
     ((dsb_pos + 1) in del_pos) # deletion on right of DSB
   )
 
+def get_mismatch_prefix(seq_1, seq_2):
+  """
+    Get the list of the number of mismatches between the first i characters of
+    seq_1 and seq_2, for i from 0 to the length of the shorter sequence.
+  """
+  return [0] + list(itertools.accumulate(map(operator.ne, seq_1, seq_2)))
+
+def get_slice_index(seq_len, index):
+  """
+    Get the index in [0, seq_len] where seq[:index] ends for a sequence of length seq_len.
+  """
+  return slice(index).indices(seq_len)[1]
+
 def check_insertion_realign(
   ref_align,
   read_align,
@@ -73,13 +135,19 @@ def check_insertion_realign(
 
   ref_seq = alignment_utils.get_orig_seq(ref_align)
 
-  new_ref_align = ref_seq[:dsb_pos] + ('-' * num_ins) + ref_seq[dsb_pos:]
+  # Count the substitutions with the insertions at the DSB without making the
+  # new alignment. read_align has no gaps since there are no deletions.
+  ins_start = get_slice_index(len(ref_seq), dsb_pos)
+  new_num_sub = (
+    get_mismatch_prefix(ref_seq[:ins_start], read_align)[-1] +
+    get_mismatch_prefix(ref_seq[ins_start:], read_align[ins_start + num_ins:])[-1]
+  )
 
   # check that the number of substitutions has not increased
-  _, _, new_num_sub = alignment_utils.count_variations(new_ref_align, read_align)
   if new_num_sub > num_sub:
     return None, None
 
+  new_ref_align = ref_seq[:dsb_pos] + ('-' * num_ins) + ref_seq[dsb_pos:]
   return new_ref_align, read_align # read_align remains unchanged
 
 def check_deletion_realign(
@@ -115,26 +183,29 @@ def check_deletion_realign(
 
   read_seq = alignment_utils.get_orig_seq(read_align)
 
-  new_read_align = None
-  found_new = False
+  # With the deletions starting at read position i, the read is aligned to
+  # ref_align[:i] on the left and ref_align[i + num_del:] on the right
+  # (ref_align has no gaps since there are no insertions).
+  # The substitutions are counted for all i with the prefix sums of the
+  # mismatches on the left (mismatch_left) and on the right (mismatch_right).
+  mismatch_left = get_mismatch_prefix(ref_align, read_seq)
+  mismatch_right = get_mismatch_prefix(ref_align[num_del:], read_seq)
+
   # go through all possible ways of placing the deletions
   for del_start in range(dsb_pos - num_del, dsb_pos + 1):
-    new_read_align = read_seq[:del_start] + ('-' * num_del) + read_seq[del_start:]
-    _, _, new_num_sub = alignment_utils.count_variations(ref_align, new_read_align)
+    i = get_slice_index(len(read_seq), del_start)
+    new_num_sub = mismatch_left[i] + mismatch_right[-1] - mismatch_right[i]
     if new_num_sub <= num_sub: # make sure that the number of substutitions has not increased
-      found_new = True
-      break
+      new_read_align = read_seq[:del_start] + ('-' * num_del) + read_seq[del_start:]
+      return ref_align, new_read_align # ref_align remains unchanged
 
-  if not found_new:
-    return None, None
-
-  return ref_align, new_read_align # ref_align remains unchanged
+  return None, None
 
 PARAMS = {
   '-i': {
     'type': common_utils.check_file,
     'help': (
-      'Aligned SAM input file.' +
+      'Aligned SAM or BAM input file.' +
       ' Must be created with Bowtie2 (specific flags from Bowtie2 are used).' +
       ' Every read must be aligned with exactly the same reference sequence.' +
       ' Multiple files may be specified as long as they all use the same reference sequence.' +
@@ -176,6 +247,18 @@ PARAMS = {
     ),
     'dest': 'debug_file',
   },
+  '--metrics': {
+    'type': common_utils.check_file_output,
+    'help': (
+      'JSON file to output the metrics of the run.' +
+      ' Besides the counts of the debug categories, it has the wall time and CPU time' +
+      ' spent in each code path of the filter (parsing, record checks, alignment' +
+      ' reconstruction, realignment, alignment checks, merging, and output),' +
+      ' and the number of unique and repeated reads, for each library and in total.' +
+      ' If omitted, the metrics are not collected.'
+    ),
+    'dest': 'metrics_file',
+  },
   '--names': {
     'nargs': '+',
     'help': (
@@ -264,7 +347,42 @@ PARAMS = {
   '--quiet': {
     'help': 'If present, do not output verbose log messages.',
     'action': 'store_true',
-  }
+  },
+  '--collapsed': {
+    'help': (
+      'If present, each SAM record represents a collapsed read whose number' +
+      ' of occurrences is stored in the QNAME (output of "DSBplot-process" stage "0_align"' +
+      ' with "--collapse 1").'
+    ),
+    'action': 'store_true',
+  },
+  '--workers': {
+    'type': int,
+    'default': 1,
+    'help': (
+      'Number of worker processes for classifying the reads.' +
+      ' If greater than 1, each uncompressed SAM file is split into this many' +
+      ' byte-range shards which are classified concurrently.' +
+      ' The output is the same as with 1 worker.' +
+      ' Compressed, BAM, and streamed inputs are read by the main process.'
+    ),
+    'dest': 'workers',
+  },
+  '--partitions': {
+    'type': int,
+    'default': 0,
+    'help': (
+      'If greater than 1, filter out of core with this many on-disk partitions,' +
+      ' for libraries with more unique sequences than fit in memory.' +
+      ' The records are split into partitions by a hash of their sequence,' +
+      ' the partitions are classified one at a time (or concurrently with WORKERS),' +
+      ' and the results are merged into the same output as an in-memory run.' +
+      ' Memory use is roughly divided by the number of partitions, while' +
+      ' the partition files take about as much disk space as the input SAM files.' +
+      ' The partition files are written to a temporary directory next to the output files.'
+    ),
+    'dest': 'partitions',
+  },
 }
 
 def post_process_args(args):
@@ -298,14 +416,275 @@ def parse_args():
     parser.add_argument(name, **options)
   return post_process_args(vars(parser.parse_args()))
 
-def do_filter(
-  input_list,
-  output,
-  output_rejected,
-  debug_file,
-  library_names,
-  total_reads,
-  ref_seq_file,
+def check_read_record(
+  read_seq,
+  flag,
+  pos,
+  cigar,
+  min_length,
+  reverse_complement,
+  filter_tag = None,
+):
+  """
+    Do the checks of classify_read() that only need the SAM record.
+
+    Returns
+    -------
+    The return value of classify_read() if the read is rejected by these checks,
+    or None if its alignment must be examined (see check_gapless_alignment()
+    and check_read_alignment()).
+  """
+  flag_mask = sam_utils.FLAG_UNALIGNED | sam_utils.FLAG_RC # mask for expected flags
+  expected_rc_flag = sam_utils.FLAG_RC if reverse_complement else 0
+
+  if (flag & ~flag_mask) != 0:
+    # Unexpected flag bits are set
+    return 'wrong_flag', cigar, None
+
+  if flag & sam_utils.FLAG_UNALIGNED:
+    if filter_tag == sam_utils.FILTER_TAG_LENGTH:
+      # The read was not aligned because it is too short
+      return 'too_short', cigar, None
+    # The read did not align at all
+    return 'unaligned', cigar, None
+
+  if (flag & sam_utils.FLAG_RC) != expected_rc_flag:
+    # Wrong reverse-complement flag
+    return 'wrong_rc', cigar, None
+
+  if pos != 1:
+    return 'pos_not_1', cigar, None
+
+  if len(read_seq) < min_length:
+    return 'too_short', cigar, None
+
+  return None
+
+def check_gapless_alignment(
+  ref_seq,
+  read_seq,
+  cigar,
+  num_sub_sam,
+  num_indel_sam,
+  max_subst,
+):
+  """
+    Do the checks of classify_read() on a read that passed check_read_record()
+    and whose alignment has no gaps (CIGAR "<length>M" and XG 0), without
+    reconstructing the alignment. The read is aligned to the start of the
+    reference, so it is accepted as "no_indel" unless it has more than max_subst
+    substitutions. This includes the exact copies of the start of the reference
+    (e.g., from "--exact_ref 1" of stage "0_align"). The substitutions are taken
+    from the XM tag, and are only counted on the reference to check the tag
+    when max_subst is finite.
+
+    Returns
+    -------
+    The return value of classify_read(), or None if the alignment has gaps.
+  """
+  if (cigar != str(len(read_seq)) + 'M') or (int(num_indel_sam) != 0):
+    return None
+  num_sub = int(num_sub_sam)
+  if max_subst < MAX_SUBST_INF:
+    if sum(map(operator.ne, ref_seq, read_seq)) != num_sub:
+      raise Exception('Incorrect count of substitutions')
+    if num_sub > max_subst:
+      return 'max_sub', cigar, num_sub
+  return 'no_indel', cigar, num_sub
+
+def get_realignment(ref_align, read_align, ins_pos, del_pos, dsb_pos):
+  """
+    Try to realign the in/dels of an alignment to touch the DSB
+    (see check_insertion_realign() and check_deletion_realign()).
+    This does not depend on the filter settings.
+
+    Returns
+    -------
+    None if the alignment cannot be realigned. Otherwise a tuple
+    (insertion_realign, deletion_realign, cigar, ins_pos, del_pos, sub_pos)
+    with the realignment used and the CIGAR string and variation positions
+    of the new alignment.
+  """
+  num_ins = len(ins_pos)
+  num_del = len(del_pos)
+  insertion_realign = False
+  deletion_realign = False
+  # Note: The in/del realignments may fail to identify
+  # certain edge cases when Bowtie picks an alignment that reduces the
+  # number of substitutions by using mixed insertions and deletions, or
+  # by using in/dels that are not continguous. This is because the
+  # the realignments always try to reduce (or keep equal) the
+  # number of substitutions. This could potentially be solved by
+  # choosing different scoring parameters in Bowtie 2, (e.g., penalize
+  # gap-open more heavily) but this is not implemented currently.
+  if (num_ins > 0) and (num_del == 0):
+    new_ref_align, new_read_align = check_insertion_realign(
+      ref_align,
+      read_align,
+      dsb_pos,
+    )
+    if new_ref_align is not None:
+      ref_align = new_ref_align
+      read_align = new_read_align
+      insertion_realign = True
+
+  if (num_del > 0) and (num_ins == 0):
+    new_ref_align, new_read_align = check_deletion_realign(
+      ref_align,
+      read_align,
+      dsb_pos,
+    )
+    if new_ref_align is not None:
+      ref_align = new_ref_align
+      read_align = new_read_align
+      deletion_realign = True
+
+  if not (insertion_realign or deletion_realign):
+    return None
+  cigar = alignment_utils.get_cigar(ref_align, read_align)
+  ins_pos, del_pos, sub_pos = alignment_utils.get_var_pos(ref_align, read_align)
+  return insertion_realign, deletion_realign, cigar, ins_pos, del_pos, sub_pos
+
+def needs_realignment(ins_pos, del_pos, dsb_pos, consecutive, dsb_touch, realign):
+  """
+    Whether classify_alignment() uses the realignment of an alignment.
+  """
+  if (not realign) or ((len(ins_pos) == 0) and (len(del_pos) == 0)):
+    return False
+  pass_consec = (not consecutive) or check_consecutive_indel(ins_pos, del_pos)
+  pass_touch = (not dsb_touch) or check_dsb_touches_indel(dsb_pos, ins_pos, del_pos)
+  return not (pass_consec and pass_touch)
+
+def classify_alignment(
+  ins_pos,
+  del_pos,
+  sub_pos,
+  cigar,
+  num_sub_sam,
+  num_indel_sam,
+  realignment,
+  dsb_pos,
+  max_subst,
+  consecutive,
+  dsb_touch,
+  realign,
+):
+  """
+    Do the checks of classify_read() on the variation positions of the
+    alignment of a read that passed check_read_record().
+    realignment is the return value of get_realignment() for the alignment.
+    It is only used if needs_realignment() is true, and may be None otherwise.
+
+    Returns
+    -------
+    The return value of classify_read().
+  """
+  # XG is the number of gap-extends (aka in/dels).
+  # XM is number of substitutions/mismatches.
+  # Both should always be present for aligned reads.
+  num_indel_sam = int(num_indel_sam)
+  num_sub_sam = int(num_sub_sam)
+
+  num_ins = len(ins_pos)
+  num_del = len(del_pos)
+  num_sub = len(sub_pos)
+  if num_indel_sam != (num_ins + num_del):
+    raise Exception('Incorrect count of insertions and/or deletions')
+  if num_sub_sam != num_sub:
+    raise Exception('Incorrect count of substitutions')
+
+  if (num_ins > 0) or (num_del > 0):
+    pass_consec = (not consecutive) or check_consecutive_indel(ins_pos, del_pos)
+    pass_touch = (not dsb_touch) or check_dsb_touches_indel(dsb_pos, ins_pos, del_pos)
+    insertion_realign = False
+    deletion_realign = False
+    # We try realigning only when both consecutive and dsb_touch checks fail.
+    if realign and not (pass_consec and pass_touch) and (realignment is not None):
+      # if realignment used, do checks again
+      insertion_realign, deletion_realign, cigar, ins_pos, del_pos, sub_pos = realignment
+      num_sub = len(sub_pos)
+      pass_consec = check_consecutive_indel(ins_pos, del_pos)
+      pass_touch = check_dsb_touches_indel(dsb_pos, ins_pos, del_pos)
+
+    if pass_consec and pass_touch:
+      if insertion_realign and deletion_realign:
+        debug = 'ins_and_del_realign'
+      elif insertion_realign:
+        debug = 'ins_realign'
+      elif deletion_realign:
+        debug = 'del_realign'
+      else:
+        debug = 'indel_other'
+    else:
+      if (not pass_consec) and (not pass_touch):
+        return 'not_consec_and_not_touch', cigar, num_sub
+      elif not pass_consec:
+        return 'not_consec', cigar, num_sub
+      elif not pass_touch:
+        return 'not_touch', cigar, num_sub
+      else:
+        raise Exception('Impossible to reach.')
+  else:
+    debug = 'no_indel'
+
+  if num_sub > max_subst:
+    return 'max_sub', cigar, num_sub
+
+  return debug, cigar, num_sub
+
+def check_read_alignment(
+  ref_align,
+  read_align,
+  ins_pos,
+  del_pos,
+  sub_pos,
+  cigar,
+  num_sub_sam,
+  num_indel_sam,
+  dsb_pos,
+  max_subst,
+  consecutive,
+  dsb_touch,
+  realign,
+  timer = log_utils.NULL_PATH_TIMER,
+):
+  """
+    Do the checks of classify_read() on the alignment of a read that passed
+    check_read_record(). The variation positions are those of
+    alignment_utils.get_var_pos() on the alignment.
+    timer is the log_utils.PathTimer timing the realignment.
+
+    Returns
+    -------
+    The return value of classify_read().
+  """
+  realignment = None
+  if needs_realignment(ins_pos, del_pos, dsb_pos, consecutive, dsb_touch, realign):
+    with timer.path('realignment', 1):
+      realignment = get_realignment(ref_align, read_align, ins_pos, del_pos, dsb_pos)
+  return classify_alignment(
+    ins_pos = ins_pos,
+    del_pos = del_pos,
+    sub_pos = sub_pos,
+    cigar = cigar,
+    num_sub_sam = num_sub_sam,
+    num_indel_sam = num_indel_sam,
+    realignment = realignment,
+    dsb_pos = dsb_pos,
+    max_subst = max_subst,
+    consecutive = consecutive,
+    dsb_touch = dsb_touch,
+    realign = realign,
+  )
+
+def classify_read(
+  ref_seq,
+  read_seq,
+  flag,
+  pos,
+  cigar,
+  num_sub_sam,
+  num_indel_sam,
   dsb_pos,
   min_length,
   max_subst,
@@ -313,439 +692,1492 @@ def do_filter(
   consecutive,
   dsb_touch,
   realign,
-  quiet,
+  filter_tag = None,
 ):
-  # read reference sequence from fasta file
-  ref_seq = file_utils.read_seq(ref_seq_file)
-  log_utils.log_input(ref_seq_file)
+  """
+    Classify a single aligned read as accepted or rejected.
 
-  if library_names is None:
-    library_names = [file_names.get_file_name(x) for x in input_list]
-  
-  # For logging
-  header = [0] * len(input_list)
-  rejected_repeat = [0] * len(input_list)
-  rejected_wrong_flag = [0] * len(input_list)
-  rejected_unaligned = [0] * len(input_list)
-  rejected_wrong_rc = [0] * len(input_list)
-  rejected_pos_not_1 = [0] * len(input_list)
-  rejected_max_sub = [0] * len(input_list)
-  rejected_not_consec = [0] * len(input_list)
-  rejected_not_touch = [0] * len(input_list)
-  rejected_not_consec_and_not_touch = [0] * len(input_list)
-  rejected_min_len = [0] * len(input_list)
-  accepted_repeat = [0] * len(input_list)
-  accepted_del_realign = [0] * len(input_list)
-  accepted_ins_realign = [0] * len(input_list)
-  accepted_ins_and_del_realign = [0] * len(input_list)
-  accepted_indel_other = [0] * len(input_list)
-  accepted_no_indel = [0] * len(input_list)
-
-  # Common variables
-  read_accepted = set()
-  read_rejected = set()
-  read_flag = {}
-  read_unaligned = {}
-  read_cigar_old = {}
-  read_cigar_new = {}
-  read_num_sub = {}
-  read_debug = {}
-
-  # Variables for each input file
-  read_count_accepted = [defaultdict(lambda: 0) for _ in input_list]
-  read_count_rejected = [defaultdict(lambda: 0) for _ in input_list]
-  read_rank = [None for _ in input_list]
-  total_lines = [0] * len(input_list)
-  total_reads_1 = [0] * len(input_list)
+    Parameters
+    ----------
+    ref_seq       : the reference sequence.
+    read_seq      : the read sequence (SAM SEQ field).
+    flag          : the SAM FLAG field as an integer.
+    pos           : the SAM POS field as an integer.
+    cigar         : the SAM CIGAR field.
+    num_sub_sam   : the value of the SAM XM tag (number of mismatches).
+    num_indel_sam : the value of the SAM XG tag (number of gap extensions).
+      Both tags are only used if the read is aligned.
+    filter_tag    : the value of the SAM YF tag (reason the read was filtered
+      out before alignment) or None.
+    The remaining parameters are the filter settings (see PARAMS).
 
-  flag_mask = sam_utils.FLAG_UNALIGNED | sam_utils.FLAG_RC # mask for expected flags
-  expected_rc_flag = sam_utils.FLAG_RC if reverse_complement else 0
+    Returns
+    -------
+    A tuple (debug, cigar, num_sub) :
+      debug   : the debug category of the read, one of ACCEPTED_CATEGORIES or
+        REJECTED_CATEGORIES.
+      cigar   : the CIGAR string after realignment (or the original CIGAR if the
+        read was rejected before realignment).
+      num_sub : the number of substitutions in the alignment or None if the
+        read was rejected before the alignment was examined.
+  """
+  result = check_read_record(
+    read_seq = read_seq,
+    flag = flag,
+    pos = pos,
+    cigar = cigar,
+    min_length = min_length,
+    reverse_complement = reverse_complement,
+    filter_tag = filter_tag,
+  )
+  if result is not None:
+    return result
 
-  for i in range(len(input_list)): # Loop over input files
-    total_lines[i] = file_utils.count_lines(input_list[i])
+  result = check_gapless_alignment(
+    ref_seq = ref_seq,
+    read_seq = read_seq,
+    cigar = cigar,
+    num_sub_sam = num_sub_sam,
+    num_indel_sam = num_indel_sam,
+    max_subst = max_subst,
+  )
+  if result is not None:
+    return result
 
-    with open(input_list[i], 'r') as in_h:
-      log_utils.log_input(input_list[i])
-      for line_num, line in enumerate(in_h, 1): # Filter reads
-        if (line_num % 100000) == 1:
-          if not quiet:
-            log_utils.log(f"Progress: {i}: {line_num} / {total_lines[i]}")
+  ref_align, read_align = alignment_utils.get_alignment(ref_seq, read_seq, 1, cigar)
+  ins_pos, del_pos, sub_pos = alignment_utils.get_var_pos(ref_align, read_align)
+  return check_read_alignment(
+    ref_align = ref_align,
+    read_align = read_align,
+    ins_pos = ins_pos,
+    del_pos = del_pos,
+    sub_pos = sub_pos,
+    cigar = cigar,
+    num_sub_sam = num_sub_sam,
+    num_indel_sam = num_indel_sam,
+    dsb_pos = dsb_pos,
+    max_subst = max_subst,
+    consecutive = consecutive,
+    dsb_touch = dsb_touch,
+    realign = realign,
+  )
 
-        if line.startswith('@'): # header line of SAM
-          header[i] += 1
-          continue
+def classify_reads(
+  ref_seq,
+  records,
+  dsb_pos,
+  min_length,
+  max_subst,
+  reverse_complement,
+  consecutive,
+  dsb_touch,
+  realign,
+  timer = log_utils.NULL_PATH_TIMER,
+):
+  """
+    Batch version of classify_read(). The alignments of the reads that
+    pass check_read_record() and have gaps (see check_gapless_alignment())
+    are reconstructed together with alignment_utils.get_alignment_batch().
+
+    Parameters
+    ----------
+    ref_seq : the reference sequence.
+    records : list of tuples (read_seq, flag, pos, cigar, num_sub_sam,
+      num_indel_sam, filter_tag) with the arguments of classify_read().
+    timer   : log_utils.PathTimer timing the code paths (see TIMED_PATHS).
+    The remaining parameters are the filter settings (see PARAMS).
+
+    Returns
+    -------
+    A list of the return values of classify_read() for the records.
+  """
+  results = [None] * len(records)
+  aligned = []
+  with timer.path('record_checks', len(records)):
+    for i, (read_seq, flag, pos, cigar, num_sub_sam, num_indel_sam, filter_tag) in enumerate(records):
+      results[i] = check_read_record(
+        read_seq = read_seq,
+        flag = flag,
+        pos = pos,
+        cigar = cigar,
+        min_length = min_length,
+        reverse_complement = reverse_complement,
+        filter_tag = filter_tag,
+      )
+      if results[i] is None:
+        results[i] = check_gapless_alignment(
+          ref_seq = ref_seq,
+          read_seq = read_seq,
+          cigar = cigar,
+          num_sub_sam = num_sub_sam,
+          num_indel_sam = num_indel_sam,
+          max_subst = max_subst,
+        )
+      if results[i] is None:
+        aligned.append(i)
+  if len(aligned) == 0:
+    return results
 
-        total_reads_1[i] += 1
+  with timer.path('alignment', len(aligned)):
+    ref_align, read_align, offsets = alignment_utils.get_alignment_batch(
+      ref_seq,
+      [records[i][0] for i in aligned],
+      [records[i][3] for i in aligned],
+    )
+    ins_pos, del_pos, sub_pos = alignment_utils.get_var_pos_batch(ref_align, read_align, offsets)
+    ref_align = alignment_utils.split_seqs(ref_align, offsets)
+    read_align = alignment_utils.split_seqs(read_align, offsets)
+  with timer.path('alignment_checks', len(aligned)):
+    for j, i in enumerate(aligned):
+      _, _, _, cigar, num_sub_sam, num_indel_sam, _ = records[i]
+      results[i] = check_read_alignment(
+        ref_align = ref_align[j],
+        read_align = read_align[j],
+        ins_pos = ins_pos[j],
+        del_pos = del_pos[j],
+        sub_pos = sub_pos[j],
+        cigar = cigar,
+        num_sub_sam = num_sub_sam,
+        num_indel_sam = num_indel_sam,
+        dsb_pos = dsb_pos,
+        max_subst = max_subst,
+        consecutive = consecutive,
+        dsb_touch = dsb_touch,
+        realign = realign,
+        timer = timer,
+      )
+  return results
 
-        fields = line.rstrip().split('\t')
-        mandatory, optional = sam_utils.parse_sam_fields(fields)
-        read_seq = mandatory['SEQ']
-        cigar = mandatory['CIGAR']
+def open_input(input):
+  """
+    Open an input of the filter for reading its SAM lines as bytes.
+    The input is either a SAM file name (which may be compressed, see
+    file_utils.open_binary()), a BAM file name, or an object that is used as a
+    context manager to get an iterator over SAM lines
+    (e.g., align_reads.Bowtie2Stream), which are encoded if they are strings.
+  """
+  if isinstance(input, str):
+    if file_utils.get_ext(input) == 'bam':
+      return bam_utils.BamReader(input, binary=True)
+    return file_utils.open_binary(input)
+  return EncodedStream(input)
 
-        if read_seq in read_accepted:
-          read_count_accepted[i][read_seq] += 1
-          accepted_repeat[i] += 1
-          continue
-        elif read_seq in read_rejected:
-          read_count_rejected[i][read_seq] += 1
-          rejected_repeat[i] += 1
-          continue
-        
-        read_cigar_old[read_seq] = cigar
-        read_flag[read_seq] = int(mandatory['FLAG'])
-        read_unaligned[read_seq] = bool(int(mandatory['FLAG']) & sam_utils.FLAG_UNALIGNED)
-
-        if (int(mandatory['FLAG']) & ~flag_mask) != 0:
-          # Unexpected flag bits are set
-          read_rejected.add(read_seq)
-          read_debug[read_seq] = 'wrong_flag'
-          rejected_wrong_flag[i] += 1
-          read_count_rejected[i][read_seq] = 1
-          continue
+class EncodedStream:
+  """
+    Context manager wrapping a stream of SAM lines as strings
+    (e.g., align_reads.Bowtie2Stream) to iterate over them as bytes.
+  """
+  def __init__(self, stream):
+    self.stream = stream
+    self.lines = None
 
-        if int(mandatory['FLAG']) & sam_utils.FLAG_UNALIGNED:
-          # The read did not align at all
-          read_rejected.add(read_seq)
-          read_debug[read_seq] = 'unaligned'
-          rejected_unaligned[i] += 1
-          read_count_rejected[i][read_seq] = 1
-          continue
+  def __iter__(self):
+    for line in self.lines:
+      yield line.encode()
 
-        if (int(mandatory['FLAG']) & sam_utils.FLAG_RC) != expected_rc_flag:
-          # Wrong reverse-complement flag
-          read_rejected.add(read_seq)
-          read_debug[read_seq] = 'wrong_rc'
-          rejected_wrong_rc[i] += 1
-          read_count_rejected[i][read_seq] = 1
-
-        if int(mandatory['POS']) != 1:
-          read_rejected.add(read_seq)
-          read_debug[read_seq] = 'pos_not_1'
-          rejected_pos_not_1[i] += 1
-          read_count_rejected[i][read_seq] = 1
-          continue
+  def __enter__(self):
+    self.lines = self.stream.__enter__()
+    return self
 
-        if len(read_seq) < min_length:
-          read_rejected.add(read_seq)
-          read_debug[read_seq] = 'too_short'
-          rejected_min_len[i] += 1
-          read_count_rejected[i][read_seq] = 1
-          continue
+  def __exit__(self, exc_type, exc_value, traceback):
+    return self.stream.__exit__(exc_type, exc_value, traceback)
+
+def is_shardable(input):
+  """
+    Whether the input can be split into shards (see get_shards()).
+    Only uncompressed SAM files can, since the shards are read by seeking
+    to byte offsets.
+  """
+  return (
+    isinstance(input, str) and
+    (file_utils.get_ext(input) == 'sam') and
+    (file_utils.get_compression(input) is None)
+  )
+
+def get_shards(file, num_shards):
+  """
+    Split a SAM file into at most num_shards byte ranges that start and end
+    on line boundaries. Files smaller than MIN_SHARD_SIZE per shard are split
+    into fewer shards.
+
+    Returns
+    -------
+    A list of tuples (start, end) of byte offsets covering the file in order.
+  """
+  size = os.path.getsize(file)
+  num_shards = max(1, min(num_shards, size // MIN_SHARD_SIZE))
+  bounds = [0]
+  with open(file, 'rb') as input:
+    for k in range(1, num_shards):
+      # Move to the start of the first line at or after the offset
+      input.seek(max((k * size) // num_shards - 1, 0))
+      input.readline()
+      offset = input.tell()
+      if bounds[-1] < offset < size:
+        bounds.append(offset)
+  bounds.append(size)
+  return list(zip(bounds[:-1], bounds[1:]))
+
+def iter_shard_lines(file, start, end):
+  """
+    Iterate over the lines of a shard of a SAM file as bytes (see get_shards()).
+  """
+  with open(file, 'rb') as input:
+    input.seek(start)
+    offset = start
+    while offset < end:
+      line = input.readline()
+      if len(line) == 0:
+        break
+      offset += len(line)
+      yield line
+
+def classify_records(
+  lines,
+  ref_seq,
+  classify_args,
+  collapsed,
+  progress = None,
+  known = None,
+  classify = None,
+  timer = log_utils.NULL_PATH_TIMER,
+):
+  """
+    Classify the unique read sequences of SAM lines with classify_reads().
+    Each sequence is classified by its first record.
+
+    Parameters
+    ----------
+    lines         : iterable of SAM lines as bytes (see open_input()).
+    ref_seq       : reference sequence.
+    classify_args : dictionary of the arguments dsb_pos, min_length, max_subst,
+      reverse_complement, consecutive, dsb_touch, and realign of classify_read().
+    collapsed     : whether the record counts are stored in the QNAMEs.
+    progress      : log_utils.ProgressLogger for the progress messages or None.
+    known         : container of the keys of the sequences that are already
+      classified (e.g., the ids of a read_table.ReadTable) or None. These
+      sequences are only counted and their flag, CIGAR, and classification are None.
+    classify      : function used instead of classify_reads() with the same
+      parameters, returning a tuple of 3 values for each record, or None.
+    timer         : log_utils.PathTimer timing the code paths (see TIMED_PATHS).
+      Only the paths of classify_reads() are timed if classify is not None.
+
+    Returns
+    -------
+    A tuple (header, reads) :
+      header : number of header lines.
+      reads  : dictionary mapping the key of each sequence (see
+        kmer_utils.pack_seq()), in the order of first occurrence, to a list
+        [count, line_num, flag, cigar_old, debug, cigar_new, num_sub],
+        where count is the total number of reads and the rest describes the
+        first record (line_num is its 1-based line number in lines, and
+        cigar_new and num_sub are None for rejected reads).
+  """
+  header = 0
+  reads = {}
+  new_reads = []
+  new_records = []
+  line_num = 0
+  with timer.path('parse'):
+    for line_num, line in enumerate(lines, 1):
+      if progress is not None:
+        progress.update(line_num)
+
+      if line.startswith(b'@'): # header line of SAM
+        header += 1
+        continue
+
+      qname, flag, pos, cigar, read_seq, rest = sam_utils.parse_filter_fields(line)
+
+      # Number of reads represented by this record
+      if collapsed:
+        count = sam_utils.get_collapsed_count(qname.decode())
+      else:
+        count = 1
+
+      key = kmer_utils.pack_seq(read_seq)
+      info = reads.get(key)
+      if info is not None:
+        info[0] += count
+        continue
+      if (known is not None) and (key in known):
+        reads[key] = [count, line_num, None, None, None, None, None]
+        continue
+
+      # Only the fields of the first record of each sequence are decoded.
+      # The new sequences are classified in batches.
+      flag = int(flag)
+      cigar = cigar.decode()
+      num_sub_sam, num_indel_sam, filter_tag = sam_utils.parse_filter_tags(rest)
+      info = [count, line_num, flag, cigar, None, None, None]
+      reads[key] = info
+      new_reads.append(info)
+      new_records.append(
+        (read_seq.decode(), flag, int(pos), cigar, num_sub_sam, num_indel_sam, filter_tag)
+      )
+      if len(new_records) == CLASSIFY_BATCH_SIZE:
+        classify_new_reads(new_reads, new_records, ref_seq, classify_args, classify, timer)
+        new_reads = []
+        new_records = []
+    classify_new_reads(new_reads, new_records, ref_seq, classify_args, classify, timer)
+  timer.add_items('parse', line_num - header)
+  return header, reads
+
+def classify_new_reads(
+  new_reads,
+  new_records,
+  ref_seq,
+  classify_args,
+  classify = None,
+  timer = log_utils.NULL_PATH_TIMER,
+):
+  """
+    Classify a batch of new sequences of classify_records() with classify_reads()
+    (or classify if it is not None) and store the results in their lists.
+  """
+  if classify is None:
+    results = classify_reads(ref_seq=ref_seq, records=new_records, timer=timer, **classify_args)
+  else:
+    results = classify(ref_seq=ref_seq, records=new_records, **classify_args)
+  for info, result in zip(new_reads, results):
+    info[4:] = result
+
+def filter_shard(file, start, end, ref_seq, classify_args, collapsed, classify=None, timed=False):
+  """
+    Classify the reads of a shard of a SAM file (see get_shards()).
+    Run in the worker processes of do_filter().
+    See classify_records() for the parameters.
+
+    Returns
+    -------
+    A tuple (result, timer) with the return value of classify_records() and
+    the log_utils.PathTimer of the shard (see log_utils.get_path_timer()).
+  """
+  timer = log_utils.get_path_timer(timed)
+  result = classify_records(
+    lines = iter_shard_lines(file, start, end),
+    ref_seq = ref_seq,
+    classify_args = classify_args,
+    collapsed = collapsed,
+    classify = classify,
+    timer = timer,
+  )
+  return result, timer
+
+def iter_shard_results(jobs, timer):
+  """
+    Iterate over the results of classify_records() of the filter_shard() jobs
+    of a file, adding their times to timer.
+  """
+  for job in jobs:
+    result, shard_timer = job.result()
+    timer.add(shard_timer)
+    yield result
+
+def iter_library_results(
+  input_list,
+  ref_seq,
+  classify_args,
+  collapsed,
+  workers,
+  quiet,
+  known,
+  classify = None,
+  timers = None,
+):
+  """
+    Classify the reads of the input files with classify_records(), one file
+    at a time. With more than one worker, the uncompressed SAM files are split
+    into shards that are classified concurrently in worker processes, and the
+    other inputs are read in this process when their turn comes.
+    See classify_records() for the parameters. timers is a list of the
+    log_utils.PathTimer of each input file, or None to not time them.
+
+    Yields
+    ------
+    For each input file in order, the iterable of the results of
+    classify_records() for the shards of the file, in order (see merge_library()).
+    The reads of file i are only classified after the results of the previous
+    files are used, so known may be updated with them.
+  """
+  if timers is None:
+    timers = [log_utils.NULL_PATH_TIMER] * len(input_list)
 
-        # XG is the number of gap-extends (aka in/dels). 
-        # XM is number of substitutions/mismatches.
-        # Both should always be present for aligned reads.
-        num_indel_sam = int(optional['XG']['VALUE'])
-        num_sub_sam = int(optional['XM']['VALUE'])
-
-        ref_align, read_align = alignment_utils.get_alignment(ref_seq, read_seq, 1, cigar)
-
-        ins_pos, del_pos, sub_pos = alignment_utils.get_var_pos(ref_align, read_align)
-        num_ins = len(ins_pos)
-        num_del = len(del_pos)
-        num_sub = len(sub_pos)
-        if num_indel_sam != (num_ins + num_del):
-          raise Exception('Incorrect count of insertions and/or deletions')
-        if num_sub_sam != num_sub:
-          raise Exception('Incorrect count of substitutions')
-
-        if (num_ins > 0) or (num_del > 0):
-          pass_consec = (not consecutive) or check_consecutive_indel(ins_pos, del_pos)
-          pass_touch = (not dsb_touch) or check_dsb_touches_indel(dsb_pos, ins_pos, del_pos)
-          insertion_realign = False
-          deletion_realign = False
-          # We try realigning only when both consecutive and dsb_touch checks fail.
-          if realign and not (pass_consec and pass_touch):
-            # Note: The in/del realignments may fail to identify
-            # certain edge cases when Bowtie picks an alignment that reduces the
-            # number of substitutions by using mixed insertions and deletions, or
-            # by using in/dels that are not continguous. This is because the
-            # the realignments always try to reduce (or keep equal) the
-            # number of substitutions. This could potentially be solved by
-            # choosing different scoring parameters in Bowtie 2, (e.g., penalize
-            # gap-open more heavily) but this is not implemented currently.
-            if (num_ins > 0) and (num_del == 0):
-              new_ref_align, new_read_align = check_insertion_realign(
-                ref_align,
-                read_align,
-                dsb_pos,
-              )
-              if new_ref_align is not None:
-                ref_align = new_ref_align
-                read_align = new_read_align
-                insertion_realign = True
-
-            if (num_del > 0) and (num_ins == 0):
-              new_ref_align, new_read_align = check_deletion_realign(
-                ref_align,
-                read_align,
-                dsb_pos,
-              )
-              if new_ref_align is not None:
-                ref_align = new_ref_align
-                read_align = new_read_align
-                deletion_realign = True
-            if insertion_realign or deletion_realign:
-              # if realignment used, recompute info and do checks again
-              cigar = alignment_utils.get_cigar(ref_align, read_align)
-              ins_pos, del_pos, sub_pos = alignment_utils.get_var_pos(ref_align, read_align)
-              num_ins = len(ins_pos)
-              num_del = len(del_pos)
-              num_sub = len(sub_pos)
-              pass_consec = check_consecutive_indel(ins_pos, del_pos)
-              pass_touch = check_dsb_touches_indel(dsb_pos, ins_pos, del_pos)
-
-          if pass_consec and pass_touch:
-            if insertion_realign and deletion_realign:
-              read_debug[read_seq] = 'ins_and_del_realign'
-              accepted_ins_and_del_realign[i] += 1
-            elif insertion_realign:
-              read_debug[read_seq] = 'ins_realign'
-              accepted_ins_realign[i] += 1
-            elif deletion_realign:
-              read_debug[read_seq] = 'del_realign'
-              accepted_del_realign[i] += 1
-            else:
-              read_debug[read_seq] = 'indel_other'
-              accepted_indel_other[i] += 1
+  # Submit the shards of the SAM files to the worker processes.
+  executor = None
+  shard_jobs = [None] * len(input_list)
+  if workers > 1:
+    executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    for i in range(len(input_list)):
+      if is_shardable(input_list[i]):
+        shard_jobs[i] = [
+          executor.submit(
+            filter_shard,
+            file = input_list[i],
+            start = start,
+            end = end,
+            ref_seq = ref_seq,
+            classify_args = classify_args,
+            collapsed = collapsed,
+            classify = classify,
+            timed = timers[i].enabled,
+          )
+          for start, end in get_shards(input_list[i], workers)
+        ]
+
+  try:
+    for i in range(len(input_list)): # Loop over input files
+      if shard_jobs[i] is None:
+        with open_input(input_list[i]) as in_h:
+          log_utils.log_input(input_list[i])
+          if quiet:
+            progress = None
           else:
-            if (not pass_consec) and (not pass_touch): 
-              read_debug[read_seq] = 'not_consec_and_not_touch'
-              rejected_not_consec_and_not_touch[i] += 1
-            elif not pass_consec:
-              read_debug[read_seq] = 'not_consec'
-              rejected_not_consec[i] += 1
-            elif not pass_touch:
-              read_debug[read_seq] = 'not_touch'
-              rejected_not_touch[i] += 1
-            else:
-              raise Exception('Impossible to reach.')
-            read_rejected.add(read_seq)
-            read_count_rejected[i][read_seq] = 1
-            continue
-        else:
-          read_debug[read_seq] = 'no_indel'
-          accepted_no_indel[i] += 1
-
-        if num_sub > max_subst:
-          read_rejected.add(read_seq)
-          read_debug[read_seq] = 'max_sub'
-          rejected_max_sub[i] += 1
-          read_count_rejected[i][read_seq] = 1
+            progress = log_utils.ProgressLogger(
+              name = str(i),
+              get_offset = lambda: file_utils.get_offset(in_h),
+              total_size = os.path.getsize(input_list[i]) if isinstance(input_list[i], str) else None,
+            )
+          shard_results = [
+            classify_records(
+              lines = in_h,
+              ref_seq = ref_seq,
+              classify_args = classify_args,
+              collapsed = collapsed,
+              progress = progress,
+              known = known,
+              classify = classify,
+              timer = timers[i],
+            )
+          ]
+      else:
+        log_utils.log_input(input_list[i])
+        shard_results = iter_shard_results(shard_jobs[i], timers[i])
+      yield shard_results
+    # End of loop over files
+  finally:
+    if executor is not None:
+      executor.shutdown(cancel_futures=True)
+
+def merge_library(
+  table,
+  library,
+  shard_results,
+  header,
+  total_reads,
+  accepted_repeat,
+  rejected_repeat,
+  debug_count,
+  index = None,
+  timer = log_utils.NULL_PATH_TIMER,
+):
+  """
+    Add the reads of the shards of an input file to the read table.
+    The shards are merged in file order, so that the first occurrence of
+    each sequence is the same as when reading the file from start to end.
+
+    Parameters
+    ----------
+    table           : read_table.ReadTable with the reads of the previous files.
+    library         : index of the library of the input file in the table.
+    shard_results   : iterable of the results of classify_records() for the
+      shards of the file, in order.
+    header, total_reads, accepted_repeat, rejected_repeat : lists of the
+      counters of each input file, which are incremented.
+    debug_count     : dictionary mapping each debug category to a list of
+      the number of new sequences of each input file, which are incremented.
+    index           : index of the input file in the counters (library by default).
+    timer           : log_utils.PathTimer timing the merge.
+
+    Returns
+    -------
+    The array of the ids of the sequences of the file in order of first occurrence
+    (see read_table.ReadTable.end_library()).
+  """
+  i = library if (index is None) else index
+  for shard_header, shard_reads in shard_results:
+    with timer.path('merge', len(shard_reads)):
+      header[i] += shard_header
+      for key, (count, _, flag, cigar, debug, cigar_new, num_sub) in shard_reads.items():
+        total_reads[i] += count
+        id = table.get_id(key)
+        if id is not None: # classified by an earlier shard or file
+          table.add_count(id, count)
+          if table.debug[id] < len(ACCEPTED_CATEGORIES):
+            accepted_repeat[i] += count
+          else:
+            rejected_repeat[i] += count
           continue
 
-        read_accepted.add(read_seq)
-        read_cigar_new[read_seq] = cigar
-        read_num_sub[read_seq] = num_sub
-        read_count_accepted[i][read_seq] = 1
-      # End of loop over reads
-    # End with statement
+        id = table.add(key, flag, cigar, debug, cigar_new, num_sub)
+        table.add_count(id, count)
+        debug_count[debug][i] += 1
+        if debug in ACCEPTED_CATEGORIES:
+          accepted_repeat[i] += count - 1
+        else:
+          rejected_repeat[i] += count - 1
+  ids, _ = table.end_library(library)
+  return ids
+
+def get_read_order(counts, seqs):
+  """
+    Get the order of the reads in the output tables: by decreasing maximum
+    count over the libraries, then by sequence (as common_utils.sort_by_count()).
+
+    Parameters
+    ----------
+    counts : array of shape (number of reads, number of libraries) of the read counts.
+    seqs   : list of the read sequences.
+
+    Returns
+    -------
+    The array of the indices of the reads in output order.
+  """
+  seq_order = np.array(sorted(range(len(seqs)), key=seqs.__getitem__), dtype=np.int64)
+  max_count = counts.max(axis=1)
+  return seq_order[np.argsort(-max_count[seq_order], kind='stable')]
+
+def get_rank_order(ids, accepted, counts):
+  """
+    Get the order of the reads of a library by rank: by decreasing count,
+    with ties ranked with the accepted reads first, each in order of first
+    occurrence in the library (as rank_partitions()).
+
+    Parameters
+    ----------
+    ids      : array of the ids of the reads of the library in order of first occurrence.
+    accepted : boolean array over all the ids of whether each read is accepted.
+    counts   : array over all the ids of the read counts in the library.
+
+    Returns
+    -------
+    The array of the ids in order of rank.
+  """
+  read_order = np.concatenate([ids[accepted[ids]], ids[~accepted[ids]]])
+  return read_order[np.argsort(-counts[read_order], kind='stable')]
 
-    if len(read_count_accepted[i]) == 0:
-      raise Exception('No reads captured. Check input file.')
+def make_read_data(columns, counts, ranks, seqs, total_reads, library_names):
+  """
+    Make the table of the accepted or rejected reads with the rows in the
+    given order. Each column is made once, in its final position.
+
+    Parameters
+    ----------
+    columns       : dictionary of the first columns of the table (before "freq_mean").
+    counts        : array of shape (number of reads, number of libraries) of the read counts.
+    ranks         : array of the same shape of the read ranks.
+    seqs          : list of the read sequences.
+    total_reads   : total number of reads of each library (for the frequencies).
+    library_names : names of the libraries.
+  """
+  freq = counts.T / np.array(total_reads, dtype=np.float64)[:, None]
+  # Sum the frequencies one library at a time, like pandas, so the
+  # means are rounded the same as by DataFrame.mean()
+  freq_sum = np.zeros(counts.shape[0], dtype=np.float64)
+  for i in range(len(library_names)):
+    freq_sum += freq[i]
+  data = {**columns, 'freq_mean': freq_sum / len(library_names)}
+  for i in range(len(library_names)):
+    data['freq_' + library_names[i]] = freq[i]
+  for i in range(len(library_names)):
+    data['count_' + library_names[i]] = counts[:, i]
+  for i in range(len(library_names)):
+    data['rank_' + library_names[i]] = ranks[:, i]
+  data['seq'] = seqs
+  return pd.DataFrame(data)
+
+def get_accepted_columns(table, ids):
+  """
+    Get the columns of make_read_data() for accepted reads of the read table.
+  """
+  return {
+    'debug': [table.get_debug(x) for x in ids],
+    'sub': np.frombuffer(table.num_sub, dtype=np.int64)[ids],
+    'cigar': [table.cigar_new[x] for x in ids],
+    'cigar_old': [table.cigar_old[x] for x in ids],
+  }
 
-    read_count = read_count_accepted[i].copy()
-    read_count.update(read_count_rejected[i])
-    read_count = sorted(read_count.items(), key=lambda x: x[1], reverse=True) # tuples (read_seq, count)
-    read_rank[i] = {read_seq : rank for rank, (read_seq, _) in enumerate(read_count, 1)} 
-  # End of loop over files
+def get_rejected_columns(table, ids):
+  """
+    Get the columns of make_read_data() for rejected reads of the read table.
+  """
+  flag = np.frombuffer(table.flag, dtype=np.int64)[ids]
+  return {
+    'debug': [table.get_debug(x) for x in ids],
+    'cigar_old': [table.cigar_old[x] for x in ids],
+    'unaligned': ((flag & sam_utils.FLAG_UNALIGNED) > 0).astype(int),
+  }
 
+def get_total_reads(total_reads, total_reads_1):
+  """
+    Get the total number of reads of each input file used for the frequencies:
+    the value in total_reads or, if it is None, the number of reads in the file.
+  """
   if total_reads is None:
-    total_reads = total_reads_1
-
-  # Makes sure the read data is in the same order for all samples
-  read_accepted = list(read_accepted)
-  read_rejected = list(read_rejected)
-
-  # Make the accepted read dataframe
-  data_list = []
-  for i in range(len(input_list)):
-    read_seq_list = list(read_count_accepted[i].keys())
-    data = pd.DataFrame({'seq': read_seq_list})
-    data['count_' + library_names[i]] = [read_count_accepted[i][read_seq] for read_seq in read_seq_list]
-    data['freq_' + library_names[i]] = data['count_' + library_names[i]] / total_reads[i]
-    data['rank_' + library_names[i]] = [read_rank[i][read_seq] for read_seq in read_seq_list]
-    data = data.set_index('seq').reindex(read_accepted)
-    data['count_' + library_names[i]] = data['count_' + library_names[i]].fillna(0).astype(int)
-    data['freq_' + library_names[i]] = data['freq_' + library_names[i]].fillna(0)
-    data['rank_' + library_names[i]] = data['rank_' + library_names[i]].fillna(RANK_NA).astype(int)
-    data_list.append(data)
-    if not quiet:
-      log_utils.log('Accepted reads: {} / {}'.format(len(read_count_accepted[i]), total_reads[i]))
-  data_common = pd.DataFrame({
-    'seq': read_accepted,
-    'debug': [read_debug[read_seq] for read_seq in read_accepted],
-    'sub': [read_num_sub[read_seq] for read_seq in read_accepted],
-    'cigar': [read_cigar_new[read_seq] for read_seq in read_accepted],
-    'cigar_old': [read_cigar_old[read_seq] for read_seq in read_accepted],
-  }).set_index('seq')
-  data_accepted = (
-    pd.concat([data_common] + data_list, join='outer', axis='columns')
-    .fillna(0)
-    .reset_index()
+    return total_reads_1
+  return [y if (x is None) else x for x, y in zip(total_reads, total_reads_1)]
+
+def read_previous_output(
+  output,
+  output_rejected,
+  debug_file,
+  library_names,
+  total_reads,
+  num_libraries,
+):
+  """
+    Read the output of a previous run of do_filter() to add new libraries to it
+    (see filter_in_memory()).
+
+    Parameters
+    ----------
+    output, output_rejected, debug_file : the output files of the previous run.
+    library_names : names of the libraries of the previous run.
+    total_reads   : total_reads parameter of the previous run.
+    num_libraries : number of libraries including the new ones.
+
+    Returns
+    -------
+    A dictionary with items:
+      "table"         : read_table.ReadTable with the reads of the previous run
+        and their counts in the previous libraries.
+      "ids"           : array of the ids of the reads.
+      "ranks"         : array of the ranks of the reads in the previous libraries.
+      "library_names" : library_names.
+      "total_reads"   : total reads of the previous libraries used for the frequencies.
+      "total_reads_1" : number of reads in the input files of the previous libraries.
+      "debug_data"    : the debug table of the previous run.
+  """
+  count_cols = ['count_' + x for x in library_names]
+  rank_cols = ['rank_' + x for x in library_names]
+
+  debug_data = file_utils.read_csv(debug_file)
+  log_utils.log_input(debug_file)
+  if not all(x in debug_data.columns for x in count_cols):
+    raise Exception(f'Libraries of the previous run are missing from {debug_file}.')
+  total_reads_1 = debug_data.loc[debug_data['debug'] == 'total_reads', count_cols].iloc[0].tolist()
+
+  table = read_table.ReadTable(ACCEPTED_CATEGORIES + REJECTED_CATEGORIES, num_libraries)
+  counts = []
+  ranks = []
+  for input in [output, output_rejected]:
+    data = file_utils.read_csv(input)
+    log_utils.log_input(input)
+    if not all(x in data.columns for x in count_cols + rank_cols):
+      raise Exception(f'Libraries of the previous run are missing from {input}.')
+    if input == output:
+      for seq, debug, cigar_old, cigar_new, num_sub in zip(
+        data['seq'], data['debug'], data['cigar_old'], data['cigar'], data['sub'],
+      ):
+        table.add(kmer_utils.pack_seq(seq), 0, cigar_old, debug, cigar_new, int(num_sub))
+    else:
+      for seq, debug, cigar_old, unaligned in zip(
+        data['seq'], data['debug'], data['cigar_old'], data['unaligned'],
+      ):
+        flag = sam_utils.FLAG_UNALIGNED if unaligned else 0
+        table.add(kmer_utils.pack_seq(seq), flag, cigar_old, debug, None, None)
+    counts.append(data[count_cols].to_numpy(dtype=np.int64))
+    ranks.append(data[rank_cols].to_numpy(dtype=np.int64))
+  if len(table.ids) != len(table):
+    raise Exception('Sequences repeated in the output of the previous run.')
+
+  ids = np.arange(len(table))
+  counts = np.concatenate(counts)
+  for i in range(len(library_names)):
+    table.set_counts(i, ids, counts[:, i])
+  return {
+    'table': table,
+    'ids': ids,
+    'ranks': np.concatenate(ranks),
+    'library_names': library_names,
+    'total_reads': get_total_reads(total_reads, total_reads_1),
+    'total_reads_1': total_reads_1,
+    'debug_data': debug_data,
+  }
+
+def filter_in_memory(
+  input_list,
+  output,
+  output_rejected,
+  library_names,
+  total_reads,
+  ref_seq,
+  classify_args,
+  collapsed,
+  workers,
+  quiet,
+  header,
+  total_reads_1,
+  accepted_repeat,
+  rejected_repeat,
+  debug_count,
+  timers,
+  timer,
+  previous = None,
+):
+  """
+    Classify the reads of all the input files in memory and write the
+    accepted and rejected read tables. See do_filter() for the parameters;
+    the counters header, total_reads_1, accepted_repeat, rejected_repeat, and
+    debug_count are incremented (see merge_library()).
+    The code paths of each input file are timed with its timer in timers,
+    and the output with timer (see log_utils.get_path_timer()).
+    If previous is not None, it is the output of a previous run (see
+    read_previous_output()) and the input files are added to it as new libraries.
+
+    Returns
+    -------
+    A tuple (total_accepted, total_rejected) of lists of the number of
+    accepted and rejected reads of each input file.
+  """
+  # Unique reads of all the input files
+  if previous is None:
+    num_prev = 0
+    table = read_table.ReadTable(ACCEPTED_CATEGORIES + REJECTED_CATEGORIES, len(input_list))
+  else:
+    num_prev = len(previous['library_names'])
+    table = previous['table']
+  library_ids = [None for _ in input_list] # ids in order of first occurrence in each file
+
+  library_results = iter_library_results(
+    input_list = input_list,
+    ref_seq = ref_seq,
+    classify_args = classify_args,
+    collapsed = collapsed,
+    workers = workers,
+    quiet = quiet,
+    known = table.ids,
+    timers = timers,
   )
-  for col in data_accepted.columns:
-    if col.startswith('count_'):
-      data_accepted[col] = data_accepted[col].astype(int)
-  data_accepted['sub'] = data_accepted['sub'].astype(int)
-  data_accepted['freq_mean'] = (
-    data_accepted[['freq_' + x for x in library_names]]
-    .mean(axis='columns')
+  try:
+    for i, shard_results in enumerate(library_results):
+      library_ids[i] = merge_library(
+        table = table,
+        library = num_prev + i,
+        shard_results = shard_results,
+        header = header,
+        total_reads = total_reads_1,
+        accepted_repeat = accepted_repeat,
+        rejected_repeat = rejected_repeat,
+        debug_count = debug_count,
+        index = i,
+        timer = timers[i],
+      )
+      if not (table.get_debug_codes()[library_ids[i]] < len(ACCEPTED_CATEGORIES)).any():
+        raise Exception('No reads captured. Check input file.')
+  finally:
+    library_results.close()
+
+  total_reads = get_total_reads(total_reads, total_reads_1)
+
+  if previous is not None:
+    # The previous libraries keep their ranks
+    for i in range(num_prev):
+      table.set_ranks(i, previous['ids'], previous['ranks'][:, i], RANK_NA)
+    library_names = previous['library_names'] + library_names
+    total_reads = previous['total_reads'] + total_reads
+
+  with timer.path('output', len(table)):
+    return write_read_tables(
+      table = table,
+      library_ids = library_ids,
+      output = output,
+      output_rejected = output_rejected,
+      library_names = library_names,
+      total_reads = total_reads,
+      quiet = quiet,
+      first_library = num_prev,
+    )
+
+def write_read_tables(
+  table,
+  library_ids,
+  output,
+  output_rejected,
+  library_names,
+  total_reads,
+  quiet,
+  first_library = 0,
+):
+  """
+    Rank the reads of the libraries and write the accepted and rejected
+    read tables.
+
+    Parameters
+    ----------
+    table           : read_table.ReadTable with the classified reads.
+    library_ids     : arrays of the ids of the reads of the libraries from
+      first_library on, in order of first occurrence (see merge_library()).
+      The libraries before first_library must already be ranked.
+    output, output_rejected : output files of the accepted and rejected reads.
+    library_names   : names of all the libraries.
+    total_reads     : total reads of all the libraries used for the frequencies.
+    quiet           : whether to not log the number of accepted reads.
+    first_library   : index of the first library of library_ids.
+
+    Returns
+    -------
+    A tuple (total_accepted, total_rejected) of lists of the number of
+    accepted and rejected reads of each library from first_library on.
+  """
+  accepted = table.get_debug_codes() < len(ACCEPTED_CATEGORIES)
+  counts = table.get_counts()
+
+  for i in range(len(library_ids)):
+    read_order = get_rank_order(library_ids[i], accepted, counts[:, first_library + i])
+    table.set_ranks(first_library + i, read_order, np.arange(1, len(read_order) + 1), RANK_NA)
+
+  # Make and write the accepted and rejected read tables one at a time.
+  # The rows are made in output order so the tables need no sorting.
+  for read_mask, get_columns, output_file in [
+    (accepted, get_accepted_columns, output),
+    (~accepted, get_rejected_columns, output_rejected),
+  ]:
+    ids = np.flatnonzero(read_mask)
+    seqs = [table.get_seq(x) for x in ids]
+    order = get_read_order(counts[ids], seqs)
+    ids = ids[order]
+    data = make_read_data(
+      columns = get_columns(table, ids),
+      counts = counts[ids],
+      ranks = table.ranks[ids],
+      seqs = [seqs[k] for k in order],
+      total_reads = total_reads,
+      library_names = library_names,
+    )
+    del seqs
+    if (output_file == output) and (not quiet):
+      for i in range(first_library, len(library_names)):
+        log_utils.log('Accepted reads: {} / {}'.format(np.count_nonzero(counts[ids, i]), total_reads[i]))
+    file_utils.write_csv(data, output_file)
+    del data
+
+  log_utils.log_output(output)
+  log_utils.log_output(output_rejected)
+
+  return (
+    counts[accepted, first_library:].sum(axis=0).tolist(),
+    counts[~accepted, first_library:].sum(axis=0).tolist(),
   )
-  data_accepted = data_accepted[
-    ['debug', 'sub', 'cigar', 'cigar_old'] +
-    ['freq_mean'] +
-    ['freq_' + x for x in library_names] +
-    ['count_' + x for x in library_names] +
-    ['rank_' + x for x in library_names] +
-    ['seq']
+
+ACCEPTED_COLUMNS = ['debug', 'sub', 'cigar', 'cigar_old'] # see get_accepted_columns()
+REJECTED_COLUMNS = ['debug', 'cigar_old', 'unaligned'] # see get_rejected_columns()
+
+def get_partition_file(dir, partition, name):
+  return os.path.join(dir, str(partition) + '_' + name)
+
+def partition_input(input, library, dir, num_partitions, progress=None):
+  """
+    Split the SAM records of an input file into partitions by a hash of their
+    sequence (phase 1 of filter_partitioned()), so that all the records of
+    a sequence are in the same partition.
+    The records of partition p are written in order to the file
+    "<p>_<library>.sam" and their line numbers in the input to the file
+    "<p>_<library>.idx" (as int64).
+
+    Returns
+    -------
+    The number of header lines.
+  """
+  header = 0
+  outputs = [
+    open(get_partition_file(dir, p, f'{library}.sam'), 'wb')
+    for p in range(num_partitions)
   ]
-  data_accepted = common_utils.sort_by_count(
-    data_accepted,
-    ['count_' + x for x in library_names],
-    ['seq'],
-  )
+  index_files = [get_partition_file(dir, p, f'{library}.idx') for p in range(num_partitions)]
+  indices = [array.array('q') for _ in range(num_partitions)]
+  try:
+    with open_input(input) as in_h:
+      if progress is not None:
+        progress.get_offset = lambda: file_utils.get_offset(in_h)
+      for line_num, line in enumerate(in_h, 1):
+        if progress is not None:
+          progress.update(line_num)
+        if line.startswith(b'@'): # header line of SAM
+          header += 1
+          continue
+        if not line.endswith(b'\n'):
+          line += b'\n'
+        p = zlib.crc32(sam_utils.parse_filter_fields(line)[4]) % num_partitions
+        outputs[p].write(line)
+        indices[p].append(line_num)
+        if len(indices[p]) >= PARTITION_INDEX_BUFFER:
+          with open(index_files[p], 'ab') as index_out:
+            indices[p].tofile(index_out)
+          indices[p] = array.array('q')
+  finally:
+    for output in outputs:
+      output.close()
+  for p in range(num_partitions):
+    with open(index_files[p], 'ab') as index_out:
+      indices[p].tofile(index_out)
+  return header
 
-  # Make the rejected read data
-  data_list = []
-  for i in range(len(input_list)):
-    read_seq_list = list(read_count_rejected[i].keys())
-    data = pd.DataFrame({'seq': read_seq_list})
-    data['count_' + library_names[i]] = [read_count_rejected[i][read_seq] for read_seq in read_seq_list]
-    data['freq_' + library_names[i]] = data['count_' + library_names[i]] / total_reads[i]
-    data['rank_' + library_names[i]] = [read_rank[i][read_seq] for read_seq in read_seq_list]
-    data = data.set_index('seq').reindex(read_rejected)
-    data['count_' + library_names[i]] = data['count_' + library_names[i]].fillna(0).astype(int)
-    data['freq_' + library_names[i]] = data['freq_' + library_names[i]].fillna(0)
-    data['rank_' + library_names[i]] = data['rank_' + library_names[i]].fillna(RANK_NA).astype(int)
-    data_list.append(data)
-  data_common = pd.DataFrame({
-    'seq': read_rejected,
-    'debug': [read_debug[read_seq] for read_seq in read_rejected],
-    'cigar_old': [read_cigar_old[read_seq] for read_seq in read_rejected],
-    'unaligned': [read_unaligned[read_seq] for read_seq in read_rejected],
-  }).set_index('seq')
-  data_rejected = (
-    pd.concat([data_common] + data_list, join='outer', axis='columns')
-    .fillna(0)
-    .reset_index()
-  )
-  for col in data_rejected.columns:
-    if col.startswith('count_'):
-      data_rejected[col] = data_rejected[col].astype(int)
-  data_rejected['unaligned'] = data_rejected['unaligned'].astype(int)
-  data_rejected['freq_mean'] = (
-    data_rejected[['freq_' + x for x in library_names]]
-    .mean(axis='columns')
-  )
-  data_rejected = data_rejected[
-    ['debug', 'cigar_old', 'unaligned'] +
-    ['freq_mean'] +
-    ['freq_' + x for x in library_names] +
-    ['count_' + x for x in library_names] +
-    ['rank_' + x for x in library_names] +
-    ['seq']
+def write_partition_reads(dir, partition, kind, table, ids, first_line, get_columns):
+  """
+    Write the accepted or rejected reads of a partition in the order of the
+    output tables (see common_utils.sort_by_count()) to the files:
+      "<partition>_<kind>.rows"  : chunks of PARTITION_CHUNK_SIZE rows pickled one
+        after the other, each a tuple (columns, seqs) (see make_read_data()).
+      "<partition>_<kind>.counts.npy" : the read counts (rows x libraries).
+      "<partition>_<kind>.first.npy"  : the line number of the first occurrence
+        of each read in each library, or -1 (for ranking the reads).
+
+    Parameters
+    ----------
+    kind        : "accepted" or "rejected".
+    table       : read_table.ReadTable of the partition.
+    ids         : array of the ids of the reads to write.
+    first_line  : array of the first line numbers of all the reads of the table.
+    get_columns : get_accepted_columns() or get_rejected_columns().
+  """
+  seqs = [table.get_seq(x) for x in ids]
+  counts = table.get_counts()[ids]
+  order = get_read_order(counts, seqs)
+  ids = ids[order]
+  seqs = [seqs[k] for k in order]
+  np.save(get_partition_file(dir, partition, kind + '.counts.npy'), counts[order])
+  np.save(get_partition_file(dir, partition, kind + '.first.npy'), first_line[ids])
+  with open(get_partition_file(dir, partition, kind + '.rows'), 'wb') as output:
+    for start in range(0, len(ids), PARTITION_CHUNK_SIZE):
+      end = start + PARTITION_CHUNK_SIZE
+      pickle.dump((get_columns(table, ids[start:end]), seqs[start:end]), output)
+
+def classify_partition(
+  dir,
+  partition,
+  num_libraries,
+  ref_seq,
+  classify_args,
+  collapsed,
+  timed = False,
+):
+  """
+    Classify the reads of a partition (phase 2 of filter_partitioned())
+    and write them with write_partition_reads(). The partition files
+    written by partition_input() are removed.
+    Run in the worker processes of filter_partitioned() if there are several workers.
+
+    Returns
+    -------
+    A dictionary of the counters of each input file in the partition:
+    "total_reads", "accepted_repeat", "rejected_repeat", "debug_count"
+    (see merge_library()), "total_accepted", "total_rejected" (number of
+    accepted/rejected reads), and "num_accepted" (number of accepted sequences).
+    It also has "timers", the timer of each input file, and "timer", the
+    timer of the output of the partition (see log_utils.get_path_timer()).
+  """
+  timers = [log_utils.get_path_timer(timed) for _ in range(num_libraries)]
+  timer = log_utils.get_path_timer(timed)
+  counters = {
+    'header': [0] * num_libraries,
+    'total_reads': [0] * num_libraries,
+    'accepted_repeat': [0] * num_libraries,
+    'rejected_repeat': [0] * num_libraries,
+    'debug_count': {x: [0] * num_libraries for x in ACCEPTED_CATEGORIES + REJECTED_CATEGORIES},
+  }
+  table = read_table.ReadTable(ACCEPTED_CATEGORIES + REJECTED_CATEGORIES, num_libraries)
+  library_first_line = []
+  for i in range(num_libraries):
+    sam_file = get_partition_file(dir, partition, f'{i}.sam')
+    index_file = get_partition_file(dir, partition, f'{i}.idx')
+    line_index = np.fromfile(index_file, dtype=np.int64)
+    with open(sam_file, 'rb', buffering=file_utils.READ_BUFFER_SIZE) as input:
+      result = classify_records(
+        lines = input,
+        ref_seq = ref_seq,
+        classify_args = classify_args,
+        collapsed = collapsed,
+        known = table.ids,
+        timer = timers[i],
+      )
+    os.remove(sam_file)
+    os.remove(index_file)
+    ids = merge_library(
+      table = table,
+      library = i,
+      shard_results = [result],
+      header = counters['header'],
+      total_reads = counters['total_reads'],
+      accepted_repeat = counters['accepted_repeat'],
+      rejected_repeat = counters['rejected_repeat'],
+      debug_count = counters['debug_count'],
+      timer = timers[i],
+    )
+    # Line numbers in the partition file -> line numbers in the input
+    line_num = np.fromiter((x[1] for x in result[1].values()), dtype=np.int64, count=len(result[1]))
+    library_first_line.append((ids, line_index[line_num - 1]))
+
+  first_line = np.full((len(table), num_libraries), -1, dtype=np.int64)
+  for i, (ids, library_first) in enumerate(library_first_line):
+    first_line[ids, i] = library_first
+
+  with timer.path('output', len(table)):
+    accepted = table.get_debug_codes() < len(ACCEPTED_CATEGORIES)
+    counts = table.get_counts()
+    write_partition_reads(
+      dir, partition, 'accepted', table, np.flatnonzero(accepted), first_line, get_accepted_columns
+    )
+    write_partition_reads(
+      dir, partition, 'rejected', table, np.flatnonzero(~accepted), first_line, get_rejected_columns
+    )
+  counters['total_accepted'] = counts[accepted].sum(axis=0).tolist()
+  counters['total_rejected'] = counts[~accepted].sum(axis=0).tolist()
+  counters['num_accepted'] = np.count_nonzero(counts[accepted], axis=0).tolist()
+  counters['timers'] = timers
+  counters['timer'] = timer
+  return counters
+
+def rank_partitions(dir, num_partitions, num_libraries):
+  """
+    Rank the reads of all the partitions in each library (phase 3 of
+    filter_partitioned()) and write the ranks of the reads of each partition,
+    in the same order as the rows, to the file "<partition>_<kind>.ranks.npy".
+    The ranks are the same as in filter_in_memory(): by decreasing count, with
+    ties ranked with the accepted reads first, each in order of first occurrence.
+  """
+  parts = [(p, kind) for p in range(num_partitions) for kind in ['accepted', 'rejected']]
+  counts = [np.load(get_partition_file(dir, p, kind + '.counts.npy'), mmap_mode='r') for p, kind in parts]
+  first_line = [np.load(get_partition_file(dir, p, kind + '.first.npy'), mmap_mode='r') for p, kind in parts]
+  rejected = np.concatenate([np.full(len(x), kind == 'rejected') for x, (_, kind) in zip(counts, parts)])
+  offsets = np.cumsum([0] + [len(x) for x in counts])
+  ranks = [
+    np.lib.format.open_memmap(
+      get_partition_file(dir, p, kind + '.ranks.npy'),
+      mode = 'w+',
+      dtype = np.int64,
+      shape = (len(x), num_libraries),
+    )
+    for x, (p, kind) in zip(counts, parts)
   ]
-  data_rejected = common_utils.sort_by_count(
-    data_rejected,
-    ['count_' + x for x in library_names],
-    ['seq'],
+  for i in range(num_libraries):
+    count_i = np.concatenate([x[:, i] for x in counts])
+    first_line_i = np.concatenate([x[:, i] for x in first_line])
+    present = np.flatnonzero(count_i > 0)
+    order = present[np.lexsort((first_line_i[present], rejected[present], -count_i[present]))]
+    rank_i = np.full(len(count_i), RANK_NA, dtype=np.int64)
+    rank_i[order] = np.arange(1, len(order) + 1)
+    for k in range(len(parts)):
+      ranks[k][:, i] = rank_i[offsets[k] : offsets[k + 1]]
+  for x in ranks:
+    x.flush()
+
+def iter_partition_reads(dir, partition, kind):
+  """
+    Iterate over the rows written by write_partition_reads() and rank_partitions().
+
+    Yields
+    ------
+    Tuples (key, values, counts, ranks), where key is the sort key of the row
+    in the output table, values is the tuple of the values of the columns,
+    and counts and ranks are arrays over the libraries.
+  """
+  counts = np.load(get_partition_file(dir, partition, kind + '.counts.npy'), mmap_mode='r')
+  ranks = np.load(get_partition_file(dir, partition, kind + '.ranks.npy'), mmap_mode='r')
+  row = 0
+  with open(get_partition_file(dir, partition, kind + '.rows'), 'rb') as input:
+    while True:
+      try:
+        columns, seqs = pickle.load(input)
+      except EOFError:
+        break
+      for values, seq in zip(zip(*columns.values()), seqs):
+        yield (-counts[row].max(), seq), values, counts[row], ranks[row]
+        row += 1
+
+def write_partitioned_output(
+  dir,
+  num_partitions,
+  kind,
+  column_names,
+  output,
+  total_reads,
+  library_names,
+):
+  """
+    Merge the sorted reads of the partitions into an output table
+    (phase 4 of filter_partitioned()), written in chunks of PARTITION_CHUNK_SIZE rows.
+  """
+  rows = heapq.merge(
+    *[iter_partition_reads(dir, p, kind) for p in range(num_partitions)],
+    key = lambda x: x[0],
   )
+  file_utils.make_parent_dir(output)
+  with open(output, 'w', newline='') as out:
+    chunk = []
+    is_first = True
+    for row in rows:
+      chunk.append(row)
+      if len(chunk) == PARTITION_CHUNK_SIZE:
+        write_partitioned_chunk(chunk, column_names, out, total_reads, library_names, is_first)
+        chunk = []
+        is_first = False
+    if (len(chunk) > 0) or is_first:
+      write_partitioned_chunk(chunk, column_names, out, total_reads, library_names, is_first)
+
+def write_partitioned_chunk(chunk, column_names, out, total_reads, library_names, header):
+  data = make_read_data(
+    columns = {name: [x[1][j] for x in chunk] for j, name in enumerate(column_names)},
+    counts = np.array([x[2] for x in chunk], dtype=np.int64).reshape(len(chunk), len(library_names)),
+    ranks = np.array([x[3] for x in chunk], dtype=np.int64).reshape(len(chunk), len(library_names)),
+    seqs = [x[0][1] for x in chunk],
+    total_reads = total_reads,
+    library_names = library_names,
+  )
+  file_utils.write_csv(data, out, header=header)
+
+def filter_partitioned(
+  input_list,
+  output,
+  output_rejected,
+  library_names,
+  total_reads,
+  ref_seq,
+  classify_args,
+  collapsed,
+  workers,
+  quiet,
+  header,
+  total_reads_1,
+  accepted_repeat,
+  rejected_repeat,
+  debug_count,
+  num_partitions,
+  timers,
+  timer,
+):
+  """
+    Out-of-core version of filter_in_memory() with the same parameters and output.
+    The reads are processed in phases:
+      1. the records of each input file are split into num_partitions
+        partition files by a hash of their sequence (partition_input());
+      2. each partition is classified in memory, the first occurrence of each
+        sequence being the same as in the input files (classify_partition());
+      3. the reads are ranked in each library (rank_partitions());
+      4. the sorted reads of the partitions are merged into the output tables
+        (write_partitioned_output()).
+    Only one partition is held in memory at a time (or one per worker).
+  """
+  file_utils.make_parent_dir(output)
+  with tempfile.TemporaryDirectory(
+    prefix = 'filter_partitions_',
+    dir = os.path.dirname(os.path.abspath(output)),
+  ) as dir:
+    for i in range(len(input_list)):
+      log_utils.log_input(input_list[i])
+      if quiet:
+        progress = None
+      else:
+        progress = log_utils.ProgressLogger(
+          name = str(i),
+          total_size = os.path.getsize(input_list[i]) if isinstance(input_list[i], str) else None,
+        )
+      with timers[i].path('partition'):
+        header[i] += partition_input(input_list[i], i, dir, num_partitions, progress)
+
+    classify_args = {
+      'dir': dir,
+      'num_libraries': len(input_list),
+      'ref_seq': ref_seq,
+      'classify_args': classify_args,
+      'collapsed': collapsed,
+      'timed': timer.enabled,
+    }
+    if workers > 1:
+      with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        jobs = [
+          executor.submit(classify_partition, partition=p, **classify_args)
+          for p in range(num_partitions)
+        ]
+        partition_counters = [job.result() for job in jobs]
+    else:
+      partition_counters = []
+      for p in range(num_partitions):
+        if not quiet:
+          log_utils.log(f'Partition: {p + 1} / {num_partitions}')
+        partition_counters.append(classify_partition(partition=p, **classify_args))
+
+    count_accepted = [0] * len(input_list)
+    count_rejected = [0] * len(input_list)
+    num_accepted = [0] * len(input_list)
+    for counters in partition_counters:
+      for i in range(len(input_list)):
+        total_reads_1[i] += counters['total_reads'][i]
+        accepted_repeat[i] += counters['accepted_repeat'][i]
+        rejected_repeat[i] += counters['rejected_repeat'][i]
+        count_accepted[i] += counters['total_accepted'][i]
+        count_rejected[i] += counters['total_rejected'][i]
+        num_accepted[i] += counters['num_accepted'][i]
+        for x in debug_count:
+          debug_count[x][i] += counters['debug_count'][x][i]
+        timers[i].add(counters['timers'][i])
+      timer.add(counters['timer'])
+    for i in range(len(input_list)):
+      if num_accepted[i] == 0:
+        raise Exception('No reads captured. Check input file.')
 
-  file_utils.write_csv(data_accepted, output)
-  file_utils.write_csv(data_rejected, output_rejected)
+    total_reads = get_total_reads(total_reads, total_reads_1)
+
+    with timer.path('output'):
+      rank_partitions(dir, num_partitions, len(input_list))
+      write_partitioned_output(
+        dir, num_partitions, 'accepted', ACCEPTED_COLUMNS, output, total_reads, library_names
+      )
+      if not quiet:
+        for i in range(len(input_list)):
+          log_utils.log('Accepted reads: {} / {}'.format(num_accepted[i], total_reads[i]))
+      write_partitioned_output(
+        dir, num_partitions, 'rejected', REJECTED_COLUMNS, output_rejected, total_reads, library_names
+      )
   log_utils.log_output(output)
   log_utils.log_output(output_rejected)
+  return count_accepted, count_rejected
 
-  accepted_new = [0] * len(input_list)
-  rejected_new = [0] * len(input_list)
-  total_accepted = [0] * len(input_list)
-  total_rejected = [0] * len(input_list)
-
-  for i in range(len(input_list)):
-    accepted_new[i] = (
-      accepted_del_realign[i] +
-      accepted_ins_realign[i] +
-      accepted_ins_and_del_realign[i] +
-      accepted_indel_other[i] +
-      accepted_no_indel[i]
+def do_filter(
+  input_list,
+  output,
+  output_rejected,
+  debug_file,
+  library_names,
+  total_reads,
+  ref_seq_file,
+  dsb_pos,
+  min_length,
+  max_subst,
+  reverse_complement,
+  consecutive,
+  dsb_touch,
+  realign,
+  quiet,
+  collapsed = False,
+  workers = 1,
+  partitions = 0,
+  prev_library_names = None,
+  prev_total_reads = None,
+  metrics_file = None,
+):
+  """
+    Filter the reads of the input files and write the output tables.
+    See PARAMS for the parameters.
+    If prev_library_names is not None, the input files are added as new libraries
+    to the output of a previous run with the libraries prev_library_names and
+    the parameter total_reads prev_total_reads. The reads already in the output
+    keep their classification, so the result is the same as running all the
+    libraries together with the new ones last.
+  """
+  start_wall_time = time.perf_counter()
+  start_cpu_time = time.process_time()
+
+  # read reference sequence from fasta file
+  ref_seq = file_utils.read_seq(ref_seq_file)
+  log_utils.log_input(ref_seq_file)
+
+  if library_names is None:
+    library_names = [file_names.get_file_name(x) for x in input_list]
+
+  previous = None
+  if prev_library_names is not None:
+    if partitions > 1:
+      raise Exception('Libraries cannot be added to a previous output with PARTITIONS > 1.')
+    if (debug_file is None) or (not debug_file.endswith('.csv')):
+      raise Exception('Libraries can only be added to a previous output with a CSV debug file.')
+    previous = read_previous_output(
+      output = output,
+      output_rejected = output_rejected,
+      debug_file = debug_file,
+      library_names = prev_library_names,
+      total_reads = prev_total_reads,
+      num_libraries = len(prev_library_names) + len(input_list),
     )
-    total_accepted[i] = accepted_new[i] + accepted_repeat[i]
+  
+  # For logging
+  header = [0] * len(input_list)
+  accepted_repeat = [0] * len(input_list)
+  rejected_repeat = [0] * len(input_list)
+  debug_count = {x: [0] * len(input_list) for x in ACCEPTED_CATEGORIES + REJECTED_CATEGORIES}
+
+  total_reads_1 = [0] * len(input_list)
+
+  # For the metrics file
+  timers = [log_utils.get_path_timer(metrics_file is not None) for _ in input_list]
+  timer = log_utils.get_path_timer(metrics_file is not None)
 
-    rejected_new[i] = (
-      rejected_wrong_flag[i] +
-      rejected_unaligned[i] +
-      rejected_wrong_rc[i] +
-      rejected_pos_not_1[i] +
-      rejected_min_len[i] +
-      rejected_max_sub[i] +
-      rejected_not_consec[i] +
-      rejected_not_touch[i] +
-      rejected_not_consec_and_not_touch[i]
+  classify_args = {
+    'dsb_pos': dsb_pos,
+    'min_length': min_length,
+    'max_subst': max_subst,
+    'reverse_complement': reverse_complement,
+    'consecutive': consecutive,
+    'dsb_touch': dsb_touch,
+    'realign': realign,
+  }
+
+  filter_args = {
+    'input_list': input_list,
+    'output': output,
+    'output_rejected': output_rejected,
+    'library_names': library_names,
+    'total_reads': total_reads,
+    'ref_seq': ref_seq,
+    'classify_args': classify_args,
+    'collapsed': collapsed,
+    'workers': workers,
+    'quiet': quiet,
+    'header': header,
+    'total_reads_1': total_reads_1,
+    'accepted_repeat': accepted_repeat,
+    'rejected_repeat': rejected_repeat,
+    'debug_count': debug_count,
+    'timers': timers,
+    'timer': timer,
+  }
+  if partitions > 1:
+    count_accepted, count_rejected = filter_partitioned(num_partitions=partitions, **filter_args)
+  else:
+    count_accepted, count_rejected = filter_in_memory(previous=previous, **filter_args)
+
+  debug_rows = get_debug_rows(
+    header = header,
+    total_reads_1 = total_reads_1,
+    accepted_repeat = accepted_repeat,
+    rejected_repeat = rejected_repeat,
+    debug_count = debug_count,
+    count_accepted = count_accepted,
+    count_rejected = count_rejected,
+  )
+  write_debug(
+    debug_file = debug_file,
+    debug_rows = debug_rows,
+    library_names = library_names,
+    quiet = quiet,
+    previous = previous,
+  )
+  if metrics_file is not None:
+    write_metrics(
+      metrics_file = metrics_file,
+      debug_rows = debug_rows,
+      library_names = library_names,
+      timers = timers,
+      timer = timer,
+      wall_time = time.perf_counter() - start_wall_time,
+      cpu_time = time.process_time() - start_cpu_time,
+      workers = workers,
+      partitions = partitions,
     )
+
+def get_debug_rows(
+  header,
+  total_reads_1,
+  accepted_repeat,
+  rejected_repeat,
+  debug_count,
+  count_accepted,
+  count_rejected,
+):
+  """
+    Get the rows of the debug table from the counters of do_filter()
+    (see merge_library()) and check that they add up to the total reads
+    and to the numbers of accepted and rejected reads in the output tables
+    (count_accepted and count_rejected).
+
+    Returns
+    -------
+    A dictionary mapping the name of each row of the debug table to the list
+    of its values for the input files.
+  """
+  num_libraries = len(header)
+  accepted_new = [0] * num_libraries
+  rejected_new = [0] * num_libraries
+  total_accepted = [0] * num_libraries
+  total_rejected = [0] * num_libraries
+
+  for i in range(num_libraries):
+    accepted_new[i] = sum(debug_count[x][i] for x in ACCEPTED_CATEGORIES)
+    total_accepted[i] = accepted_new[i] + accepted_repeat[i]
+
+    rejected_new[i] = sum(debug_count[x][i] for x in REJECTED_CATEGORIES)
     total_rejected[i] = rejected_new[i] + rejected_repeat[i]
 
     if (total_rejected[i] + total_accepted[i]) != total_reads_1[i]:
       raise Exception("accepted + rejected != total")
 
-    if total_accepted[i] != sum(read_count_accepted[i].values()):
+    if total_accepted[i] != count_accepted[i]:
       raise Exception("Total accepted not summing")
     
-    if total_rejected[i] != sum(read_count_rejected[i].values()):
+    if total_rejected[i] != count_rejected[i]:
       raise Exception("Total rejected not summing")
 
-  debug_data = pd.DataFrame({
+  return {
     'header': header,
     'total_reads': total_reads_1,
     'total_accepted': total_accepted,
     'accepted_new': accepted_new,
     'accepted_repeat': accepted_repeat,
-    'accepted_deletion_realign': accepted_del_realign,
-    'accepted_insertion_realign': accepted_ins_realign,
-    'accepted_insertion_and_deletion_realign': accepted_ins_and_del_realign,
-    'accepted_indel_other': accepted_indel_other,
-    'accepted_no_indel': accepted_no_indel,
+    'accepted_deletion_realign': debug_count['del_realign'],
+    'accepted_insertion_realign': debug_count['ins_realign'],
+    'accepted_insertion_and_deletion_realign': debug_count['ins_and_del_realign'],
+    'accepted_indel_other': debug_count['indel_other'],
+    'accepted_no_indel': debug_count['no_indel'],
     'total_rejected': total_rejected,
     'rejected_new': rejected_new,
     'rejected_repeat': rejected_repeat,
-    'rejected_wrong_flag': rejected_wrong_flag,
-    'rejected_unaligned': rejected_unaligned,
-    'rejected_wrong_rc': rejected_wrong_rc,
-    'rejected_pos_not_1': rejected_pos_not_1,
-    'rejected_min_len': rejected_min_len,
-    'rejected_not_consec': rejected_not_consec,
-    'rejected_not_touch': rejected_not_touch,
-    'rejected_not_consec_and_not_touch': rejected_not_consec_and_not_touch,
-    'rejected_max_sub': rejected_max_sub,
-  }).T.rename_axis('debug')
+    'rejected_wrong_flag': debug_count['wrong_flag'],
+    'rejected_unaligned': debug_count['unaligned'],
+    'rejected_wrong_rc': debug_count['wrong_rc'],
+    'rejected_pos_not_1': debug_count['pos_not_1'],
+    'rejected_min_len': debug_count['too_short'],
+    'rejected_not_consec': debug_count['not_consec'],
+    'rejected_not_touch': debug_count['not_touch'],
+    'rejected_not_consec_and_not_touch': debug_count['not_consec_and_not_touch'],
+    'rejected_max_sub': debug_count['max_sub'],
+  }
+
+def write_debug(debug_file, debug_rows, library_names, quiet, previous=None):
+  """
+    Write the debug table (see get_debug_rows()) to debug_file as a CSV
+    table or as text, depending on the extension, or log it if debug_file is None.
+    If previous is not None, the rows are added to the debug table of the
+    previous run (see read_previous_output()).
+  """
+  debug_data = pd.DataFrame(debug_rows).T.rename_axis('debug')
   debug_data.columns = ['count_' + x for x in library_names]
-  debug_data[['freq_' + x for x in library_names]] = (
-    debug_data[['count_' + x for x in library_names]].divide(total_reads_1, axis='columns')
+  debug_names = library_names
+  debug_total_reads = debug_rows['total_reads']
+  if previous is not None:
+    debug_names = previous['library_names'] + library_names
+    debug_total_reads = previous['total_reads_1'] + debug_rows['total_reads']
+    prev_debug_data = previous['debug_data'].set_index('debug')
+    debug_data = pd.concat(
+      [prev_debug_data[['count_' + x for x in previous['library_names']]], debug_data],
+      axis = 'columns',
+    )
+  debug_data[['freq_' + x for x in debug_names]] = (
+    debug_data[['count_' + x for x in debug_names]].divide(debug_total_reads, axis='columns')
   )
   debug_data = debug_data.reset_index()
   debug_lines = [
-    f'Header lines: ' + ', '.join([str(x) for x in header]),
-    f'Total reads: ' + ', '.join([str(x) for x in total_reads_1]),
-    f'    Accepted: '  + ', '.join([str(x) for x in total_accepted]),
-    f'        Repeat: ' + ', '.join([str(x) for x in accepted_repeat]),
-    f'        New: '  + ', '.join([str(x) for x in accepted_new]),
-    f'            Insertion realignment: ' + ', '.join([str(x) for x in accepted_ins_realign]),
-    f'            Deletion realignment: ' + ', '.join([str(x) for x in accepted_del_realign]),
-    f'            Insertion and deletion realignment: ' + ', '.join([str(x) for x in accepted_ins_and_del_realign]),
-    f'            In/del other: ' + ', '.join([str(x) for x in accepted_indel_other]),
-    f'            No in/del: ' + ', '.join([str(x) for x in accepted_no_indel]),
-    f'    Rejected: ' + ', '.join([str(x) for x in total_rejected]),
-    f'        Repeat: ' + ', '.join([str(x) for x in rejected_repeat]),
-    f'        New: ' + ', '.join([str(x) for x in rejected_new]),
-    f'            Wrong flag: ' + ', '.join([str(x) for x in rejected_wrong_flag]),
-    f'            Unaligned: ' + ', '.join([str(x) for x in rejected_unaligned]),
-    f'            Wrong RC flag: ' + ', '.join([str(x) for x in rejected_wrong_rc]),
-    f'            POS != 1: ' + ', '.join([str(x) for x in rejected_pos_not_1]),
-    f'            Min length: ' + ', '.join([str(x) for x in rejected_min_len]),
-    f'            Not consecutive: ' + ', '.join([str(x) for x in rejected_not_consec]),
-    f'            DSB not touch: ' + ', '.join([str(x) for x in rejected_not_touch]),
-    f'            Not consecutive and DSB not touch: ' + ', '.join([str(x) for x in rejected_not_consec_and_not_touch]),
-    f'            Max substitutions: ' + ', '.join([str(x) for x in rejected_max_sub]),
+    f'Header lines: ' + ', '.join([str(x) for x in debug_rows['header']]),
+    f'Total reads: ' + ', '.join([str(x) for x in debug_rows['total_reads']]),
+    f'    Accepted: '  + ', '.join([str(x) for x in debug_rows['total_accepted']]),
+    f'        Repeat: ' + ', '.join([str(x) for x in debug_rows['accepted_repeat']]),
+    f'        New: '  + ', '.join([str(x) for x in debug_rows['accepted_new']]),
+    f'            Insertion realignment: ' + ', '.join([str(x) for x in debug_rows['accepted_insertion_realign']]),
+    f'            Deletion realignment: ' + ', '.join([str(x) for x in debug_rows['accepted_deletion_realign']]),
+    f'            Insertion and deletion realignment: ' + ', '.join([str(x) for x in debug_rows['accepted_insertion_and_deletion_realign']]),
+    f'            In/del other: ' + ', '.join([str(x) for x in debug_rows['accepted_indel_other']]),
+    f'            No in/del: ' + ', '.join([str(x) for x in debug_rows['accepted_no_indel']]),
+    f'    Rejected: ' + ', '.join([str(x) for x in debug_rows['total_rejected']]),
+    f'        Repeat: ' + ', '.join([str(x) for x in debug_rows['rejected_repeat']]),
+    f'        New: ' + ', '.join([str(x) for x in debug_rows['rejected_new']]),
+    f'            Wrong flag: ' + ', '.join([str(x) for x in debug_rows['rejected_wrong_flag']]),
+    f'            Unaligned: ' + ', '.join([str(x) for x in debug_rows['rejected_unaligned']]),
+    f'            Wrong RC flag: ' + ', '.join([str(x) for x in debug_rows['rejected_wrong_rc']]),
+    f'            POS != 1: ' + ', '.join([str(x) for x in debug_rows['rejected_pos_not_1']]),
+    f'            Min length: ' + ', '.join([str(x) for x in debug_rows['rejected_min_len']]),
+    f'            Not consecutive: ' + ', '.join([str(x) for x in debug_rows['rejected_not_consec']]),
+    f'            DSB not touch: ' + ', '.join([str(x) for x in debug_rows['rejected_not_touch']]),
+    f'            Not consecutive and DSB not touch: ' + ', '.join([str(x) for x in debug_rows['rejected_not_consec_and_not_touch']]),
+    f'            Max substitutions: ' + ', '.join([str(x) for x in debug_rows['rejected_max_sub']]),
   ]
 
   if (debug_file is None) and not quiet:
@@ -761,6 +2193,77 @@ def do_filter(
           debug_out.write(l + '\n')
     log_utils.log_output(debug_file)
 
+def get_read_metrics(total_reads, unique_reads, repeat_reads):
+  return {
+    'total_reads': total_reads,
+    'unique_reads': unique_reads,
+    'repeat_reads': repeat_reads,
+    'unique_rate': (unique_reads / total_reads) if (total_reads > 0) else 0,
+    'repeat_rate': (repeat_reads / total_reads) if (total_reads > 0) else 0,
+  }
+
+def write_metrics(
+  metrics_file,
+  debug_rows,
+  library_names,
+  timers,
+  timer,
+  wall_time,
+  cpu_time,
+  workers,
+  partitions,
+):
+  """
+    Write the metrics of the run to metrics_file as JSON.
+
+    The unique reads of a library are the reads whose sequence is classified
+    in the library (its first occurrence), and the repeat reads are the rest,
+    which get the classification of an earlier read. The times of the code paths
+    (see TIMED_PATHS) are summed over the worker processes, so with several
+    workers they can add up to more than the wall time of the run. The total
+    CPU time is only of the main process. The time spent waiting for the
+    workers is not in any path.
+
+    Parameters
+    ----------
+    metrics_file  : the output file.
+    debug_rows    : the rows of the debug table (see get_debug_rows()).
+    library_names : names of the libraries of the run.
+    timers        : log_utils.PathTimer of each library.
+    timer         : log_utils.PathTimer of the code paths common to all the libraries.
+    wall_time, cpu_time : total wall time and CPU time of the run in seconds.
+    workers, partitions : the parameters of the run (see PARAMS).
+  """
+  total_timer = log_utils.PathTimer()
+  for x in timers + [timer]:
+    total_timer.add(x)
+  libraries = {}
+  for i, name in enumerate(library_names):
+    libraries[name] = {
+      **get_read_metrics(
+        total_reads = debug_rows['total_reads'][i],
+        unique_reads = debug_rows['accepted_new'][i] + debug_rows['rejected_new'][i],
+        repeat_reads = debug_rows['accepted_repeat'][i] + debug_rows['rejected_repeat'][i],
+      ),
+      'debug': {x: debug_rows[x][i] for x in debug_rows},
+      'paths': timers[i].to_dict(TIMED_PATHS),
+    }
+  metrics = {
+    'wall_time': wall_time,
+    'cpu_time': cpu_time,
+    'workers': workers,
+    'partitions': partitions,
+    **get_read_metrics(
+      total_reads = sum(x['total_reads'] for x in libraries.values()),
+      unique_reads = sum(x['unique_reads'] for x in libraries.values()),
+      repeat_reads = sum(x['repeat_reads'] for x in libraries.values()),
+    ),
+    'paths': total_timer.to_dict(TIMED_PATHS),
+    'libraries': libraries,
+  }
+  file_utils.write_json(metrics, metrics_file)
+  log_utils.log_output(metrics_file)
+
 def main(
   input_list,
   output,
@@ -776,6 +2279,12 @@ def main(
   dsb_touch,
   realign,
   quiet,
+  collapsed = False,
+  workers = 1,
+  partitions = 0,
+  prev_library_names = None,
+  prev_total_reads = None,
+  metrics_file = None,
 ):
   do_filter(
     input_list = input_list,
@@ -793,6 +2302,12 @@ def main(
     dsb_touch = dsb_touch,
     realign = realign,
     quiet = quiet,
+    collapsed = collapsed,
+    workers = workers,
+    partitions = partitions,
+    prev_library_names = prev_library_names,
+    prev_total_reads = prev_total_reads,
+    metrics_file = metrics_file,
   )
 
 if __name__ == '__main__':
@@ -0,0 +1,466 @@
+import array
+import itertools
+import numpy as np
+
+import DSBplot.utils.file_names as file_names
+import DSBplot.utils.file_utils as file_utils
+import DSBplot.utils.alignment_utils as alignment_utils
+import DSBplot.utils.log_utils as log_utils
+import DSBplot.lib_process.read_table as read_table
+import DSBplot.lib_process.filter_reads as filter_reads
+
+# Parameters of filter_reads.PARAMS that can be swept, mapped to their dest
+SWEEP_PARAMS = {
+  'min_len': 'min_length',
+  'max_sub': 'max_subst',
+  'consec': 'consecutive',
+  'touch': 'dsb_touch',
+  'realign': 'realign',
+}
+
+PARAMS = {
+  '--sweep': {
+    'type': str,
+    'nargs': '+',
+    'help': (
+      'Filter the reads with every combination of the given values of the filter' +
+      ' parameters in a single pass over the input.' +
+      ' Each value has the form PARAM=VALUE,VALUE,... where PARAM is one of ' +
+      ', '.join(f'"{x}"' for x in SWEEP_PARAMS) +
+      ' (e.g., "--sweep min_len=70,80 max_sub=2,-1 realign=0,1").' +
+      ' The parameters that are not swept keep their single value.' +
+      ' The output for the single values is written as usual, and the output for each' +
+      ' combination is written to the subdirectory "sweep/<combination>" of the' +
+      ' output directory (e.g., "sweep/min_len_70_max_sub_2_consec_1_touch_1_realign_0"),' +
+      ' which can be used as the output directory of the later stages.' +
+      ' The features of each unique read that the filter checks' +
+      ' are computed only once for all the combinations.'
+    ),
+    'metavar': 'SWEEP',
+    'dest': 'sweep',
+  },
+}
+
+def parse_sweep(sweep):
+  """
+    Parse the values of "--sweep" (see PARAMS).
+
+    Returns
+    -------
+    A dictionary mapping the dest of each swept parameter to the list of its values.
+  """
+  values = {}
+  for x in sweep:
+    name, sep, value_str = x.partition('=')
+    if (sep == '') or (name not in SWEEP_PARAMS):
+      raise Exception(
+        f'Invalid SWEEP value "{x}". Must have the form PARAM=VALUE,VALUE,... with PARAM one of: ' +
+        ', '.join(SWEEP_PARAMS) + '.'
+      )
+    if SWEEP_PARAMS[name] in values:
+      raise Exception(f'SWEEP parameter "{name}" is given more than once.')
+    try:
+      param_values = [int(y) for y in value_str.split(',')]
+    except ValueError:
+      raise Exception(f'Invalid SWEEP value "{x}". The values must be integers.')
+    choices = filter_reads.PARAMS['--' + name].get('choices')
+    if (choices is not None) and any((y not in choices) for y in param_values):
+      raise Exception(f'Invalid SWEEP value "{x}". The values must be in: {choices}.')
+    values[SWEEP_PARAMS[name]] = param_values
+  return values
+
+def post_process_args(args):
+  args = args.copy()
+  if args.get('sweep') is not None:
+    args['sweep'] = parse_sweep(args['sweep'])
+  return args
+
+def get_sweep_name(settings):
+  """
+    Get the name of the subdirectory of a combination of filter settings.
+  """
+  values = []
+  for name, dest in SWEEP_PARAMS.items():
+    value = settings[dest]
+    if (dest == 'max_subst') and (value == filter_reads.MAX_SUBST_INF):
+      value = -1
+    values.append(f'{name}_{int(value)}')
+  return '_'.join(values)
+
+def get_sweep_settings(
+  sweep,
+  dsb_pos,
+  min_length,
+  max_subst,
+  consecutive,
+  dsb_touch,
+  realign,
+):
+  """
+    Get the combinations of the filter settings of a sweep.
+
+    Parameters
+    ----------
+    sweep : the values of each swept parameter (see parse_sweep()).
+    The remaining parameters are the single values of the filter settings,
+    which are used for the parameters that are not swept.
+
+    Returns
+    -------
+    A list of tuples (name, settings) with the name of each distinct
+    combination (see get_sweep_name()) and a dictionary of its settings
+    min_length, max_subst, consecutive, dsb_touch, and realign
+    (post-processed as by filter_reads.post_process_args()).
+  """
+  single = {
+    'min_length': min_length,
+    'max_subst': max_subst,
+    'consecutive': consecutive,
+    'dsb_touch': dsb_touch,
+    'realign': realign,
+  }
+  dests = list(SWEEP_PARAMS.values())
+  settings_list = {}
+  for values in itertools.product(*[sweep.get(x, [single[x]]) for x in dests]):
+    settings = filter_reads.post_process_args({'dsb_pos': dsb_pos, **dict(zip(dests, values))})
+    del settings['dsb_pos']
+    settings_list.setdefault(get_sweep_name(settings), settings)
+  return list(settings_list.items())
+
+def get_read_features(ref_seq, records, dsb_pos, reverse_complement):
+  """
+    Get the features of reads that the filter checks, which do not depend on
+    the settings of SWEEP_PARAMS. This is used with
+    filter_reads.classify_records() instead of filter_reads.classify_reads().
+
+    Parameters
+    ----------
+    ref_seq : the reference sequence.
+    records : list of tuples (read_seq, flag, pos, cigar, num_sub_sam,
+      num_indel_sam, filter_tag) with the arguments of filter_reads.classify_read().
+    dsb_pos, reverse_complement : the filter settings (see filter_reads.PARAMS).
+
+    Returns
+    -------
+    A list of tuples (record_result, read_length, alignment) for the records:
+      record_result : the return value of filter_reads.check_read_record() with
+        no minimum length.
+      read_length   : the length of the read.
+      alignment     : None if record_result is not None, otherwise a tuple
+        (ins_pos, del_pos, sub_pos, cigar, num_sub_sam, num_indel_sam, realignment)
+        with the positional arguments of filter_reads.classify_alignment().
+        realignment is None unless the realignment may be used with some settings.
+  """
+  features = [None] * len(records)
+  aligned = []
+  for i, (read_seq, flag, pos, cigar, _, _, filter_tag) in enumerate(records):
+    record_result = filter_reads.check_read_record(
+      read_seq = read_seq,
+      flag = flag,
+      pos = pos,
+      cigar = cigar,
+      min_length = 0,
+      reverse_complement = reverse_complement,
+      filter_tag = filter_tag,
+    )
+    features[i] = (record_result, len(read_seq), None)
+    if record_result is None:
+      aligned.append(i)
+  if len(aligned) == 0:
+    return features
+
+  ref_align, read_align, offsets = alignment_utils.get_alignment_batch(
+    ref_seq,
+    [records[i][0] for i in aligned],
+    [records[i][3] for i in aligned],
+  )
+  ins_pos, del_pos, sub_pos = alignment_utils.get_var_pos_batch(ref_align, read_align, offsets)
+  ref_align = alignment_utils.split_seqs(ref_align, offsets)
+  read_align = alignment_utils.split_seqs(read_align, offsets)
+  for j, i in enumerate(aligned):
+    _, _, _, cigar, num_sub_sam, num_indel_sam, _ = records[i]
+    realignment = None
+    # With both checks enabled, the realignment is needed for any settings that use it
+    if filter_reads.needs_realignment(ins_pos[j], del_pos[j], dsb_pos, True, True, True):
+      realignment = filter_reads.get_realignment(
+        ref_align[j],
+        read_align[j],
+        ins_pos[j],
+        del_pos[j],
+        dsb_pos,
+      )
+    features[i] = (
+      None,
+      features[i][1],
+      (ins_pos[j], del_pos[j], sub_pos[j], cigar, num_sub_sam, num_indel_sam, realignment),
+    )
+  return features
+
+def classify_features(
+  features,
+  cigars,
+  dsb_pos,
+  min_length,
+  max_subst,
+  consecutive,
+  dsb_touch,
+  realign,
+):
+  """
+    Classify reads from their features (see get_read_features()) with a
+    combination of filter settings.
+
+    Parameters
+    ----------
+    features : list of the features of the reads.
+    cigars   : list of the CIGAR strings of the reads.
+    The remaining parameters are the filter settings (see filter_reads.PARAMS).
+
+    Returns
+    -------
+    A list of the return values of filter_reads.classify_read() for the reads.
+  """
+  results = []
+  for (record_result, read_length, alignment), cigar in zip(features, cigars):
+    if record_result is not None:
+      results.append(record_result)
+    elif read_length < min_length:
+      results.append(('too_short', cigar, None))
+    else:
+      results.append(
+        filter_reads.classify_alignment(
+          *alignment,
+          dsb_pos = dsb_pos,
+          max_subst = max_subst,
+          consecutive = consecutive,
+          dsb_touch = dsb_touch,
+          realign = realign,
+        )
+      )
+  return results
+
+def merge_library_features(
+  table,
+  features,
+  first_library,
+  library,
+  shard_results,
+  header,
+  total_reads,
+):
+  """
+    Add the reads of the shards of an input file to the read table, as
+    filter_reads.merge_library() but without classifying them.
+    The features of the new sequences (see get_read_features()) are appended
+    to features and the index of their first library to first_library.
+    The counters header and total_reads are incremented.
+
+    Returns
+    -------
+    The array of the ids of the sequences of the file in order of first occurrence.
+  """
+  for shard_header, shard_reads in shard_results:
+    header[library] += shard_header
+    for key, (count, _, flag, cigar, *read_features) in shard_reads.items():
+      total_reads[library] += count
+      id = table.get_id(key)
+      if id is None:
+        id = table.add(key, flag, cigar, None, None, None)
+        features.append(read_features)
+        first_library.append(library)
+      table.add_count(id, count)
+  ids, _ = table.end_library(library)
+  return ids
+
+def get_repeat_counts(table, first_library):
+  """
+    Get the counters accepted_repeat, rejected_repeat, and debug_count of
+    filter_reads.merge_library() from the classification of the read table.
+    The sequences are new in their first library and repeats afterwards.
+  """
+  codes = table.get_debug_codes().astype(np.int64)
+  first_library = np.frombuffer(first_library, dtype=np.int64)
+  counts = table.get_counts()
+  num_categories = len(table.categories)
+  num_accepted = len(filter_reads.ACCEPTED_CATEGORIES)
+  new_counts = np.bincount(
+    first_library * num_categories + codes,
+    minlength = table.num_libraries * num_categories,
+  ).reshape(table.num_libraries, num_categories)
+  accepted = codes < num_accepted
+  accepted_repeat = counts[accepted].sum(axis=0) - new_counts[:, :num_accepted].sum(axis=1)
+  rejected_repeat = counts[~accepted].sum(axis=0) - new_counts[:, num_accepted:].sum(axis=1)
+  debug_count = {x: new_counts[:, k].tolist() for k, x in enumerate(table.categories)}
+  return accepted_repeat.tolist(), rejected_repeat.tolist(), debug_count
+
+def do_sweep(
+  input_list,
+  library_names,
+  total_reads,
+  ref_seq_file,
+  dsb_pos,
+  reverse_complement,
+  quiet,
+  settings_list,
+  collapsed = False,
+  workers = 1,
+):
+  """
+    Filter the reads of the input files with several combinations of the
+    filter settings, reading the input files once. The features of each unique
+    read are computed once (see get_read_features()) and classified with each
+    combination. The output is the same as running filter_reads.do_filter()
+    with each combination.
+
+    Parameters
+    ----------
+    settings_list : list of dictionaries with the output files output,
+      output_rejected, and debug_file, and the settings min_length, max_subst,
+      consecutive, dsb_touch, and realign of each combination.
+    The remaining parameters are as in filter_reads.do_filter().
+  """
+  ref_seq = file_utils.read_seq(ref_seq_file)
+  log_utils.log_input(ref_seq_file)
+
+  if library_names is None:
+    library_names = [file_names.get_file_name(x) for x in input_list]
+
+  table = read_table.ReadTable(
+    filter_reads.ACCEPTED_CATEGORIES + filter_reads.REJECTED_CATEGORIES,
+    len(input_list),
+  )
+  features = []
+  first_library = array.array('q')
+  header = [0] * len(input_list)
+  total_reads_1 = [0] * len(input_list)
+  library_ids = [None for _ in input_list]
+
+  library_results = filter_reads.iter_library_results(
+    input_list = input_list,
+    ref_seq = ref_seq,
+    classify_args = {'dsb_pos': dsb_pos, 'reverse_complement': reverse_complement},
+    collapsed = collapsed,
+    workers = workers,
+    quiet = quiet,
+    known = table.ids,
+    classify = get_read_features,
+  )
+  try:
+    for i, shard_results in enumerate(library_results):
+      library_ids[i] = merge_library_features(
+        table = table,
+        features = features,
+        first_library = first_library,
+        library = i,
+        shard_results = shard_results,
+        header = header,
+        total_reads = total_reads_1,
+      )
+  finally:
+    library_results.close()
+
+  total_reads = filter_reads.get_total_reads(total_reads, total_reads_1)
+
+  for settings in settings_list:
+    if not quiet:
+      log_utils.log(
+        'Filter settings: ' +
+        ', '.join(f'{x} = {settings[x]}' for x in SWEEP_PARAMS.values())
+      )
+    results = classify_features(
+      features = features,
+      cigars = table.cigar_old,
+      dsb_pos = dsb_pos,
+      min_length = settings['min_length'],
+      max_subst = settings['max_subst'],
+      consecutive = settings['consecutive'],
+      dsb_touch = settings['dsb_touch'],
+      realign = settings['realign'],
+    )
+    table.set_classification(*zip(*results))
+    del results
+
+    accepted = table.get_debug_codes() < len(filter_reads.ACCEPTED_CATEGORIES)
+    for ids in library_ids:
+      if not accepted[ids].any():
+        raise Exception('No reads captured. Check input file.')
+
+    accepted_repeat, rejected_repeat, debug_count = get_repeat_counts(table, first_library)
+    count_accepted, count_rejected = filter_reads.write_read_tables(
+      table = table,
+      library_ids = library_ids,
+      output = settings['output'],
+      output_rejected = settings['output_rejected'],
+      library_names = library_names,
+      total_reads = total_reads,
+      quiet = quiet,
+    )
+    debug_rows = filter_reads.get_debug_rows(
+      header = header,
+      total_reads_1 = total_reads_1,
+      accepted_repeat = accepted_repeat,
+      rejected_repeat = rejected_repeat,
+      debug_count = debug_count,
+      count_accepted = count_accepted,
+      count_rejected = count_rejected,
+    )
+    filter_reads.write_debug(
+      debug_file = settings['debug_file'],
+      debug_rows = debug_rows,
+      library_names = library_names,
+      quiet = quiet,
+    )
+
+def main(
+  input_list,
+  output,
+  debug_file,
+  ref_seq_file,
+  library_names,
+  total_reads,
+  dsb_pos,
+  min_length,
+  max_subst,
+  reverse_complement,
+  consecutive,
+  dsb_touch,
+  realign,
+  quiet,
+  sweep_list,
+  collapsed = False,
+  workers = 1,
+):
+  """
+    Run filter_reads.main() with the settings of the parameters and with each
+    combination of settings in sweep_list in one pass (see do_sweep()).
+    sweep_list is a list of dictionaries with the parameters output,
+    debug_file, min_length, max_subst, consecutive, dsb_touch, and realign
+    of each combination.
+  """
+  settings_list = []
+  for args in [
+    {
+      'output': output,
+      'debug_file': debug_file,
+      'min_length': min_length,
+      'max_subst': max_subst,
+      'consecutive': consecutive,
+      'dsb_touch': dsb_touch,
+      'realign': realign,
+    }
+  ] + sweep_list:
+    settings = {x: args[x] for x in ['debug_file'] + list(SWEEP_PARAMS.values())}
+    settings['output'], settings['output_rejected'] = args['output']
+    settings_list.append(settings)
+  do_sweep(
+    input_list = input_list,
+    library_names = library_names,
+    total_reads = total_reads,
+    ref_seq_file = ref_seq_file,
+    dsb_pos = dsb_pos,
+    reverse_complement = reverse_complement,
+    quiet = quiet,
+    settings_list = settings_list,
+    collapsed = collapsed,
+    workers = workers,
+  )
@@ -40,20 +40,21 @@ def split_seqs_into_variations(window_data):
   variation_data = variation_data[['ref_align', 'read_align'] + value_cols]
 
   # Separate into individual variations
-  new_data = []
-  for row in variation_data.to_dict('records'):
-    num_var = sum(alignment_utils.count_variations(row['ref_align'], row['read_align']))
-    if num_var > 0:
-      for var in alignment_utils.get_variation_info(row['ref_align'], row['read_align']):
-        new_data.append({
-          **{k: row[k] for k in value_cols},
-          'num_var': num_var,
-          'var_pos': var[0],
-          'var_type': var[1],
-          'var_letter': var[2],
-        })
-  if len(new_data) > 0:
-    variation_data = pd.DataFrame.from_records(new_data)
+  ref_align, read_align, offsets = alignment_utils.join_alignments(
+    list(variation_data['ref_align']),
+    list(variation_data['read_align']),
+  )
+  num_ins, num_del, num_sub = alignment_utils.count_variations_batch(ref_align, read_align, offsets)
+  num_var = num_ins + num_del + num_sub
+  index, var_pos, var_type, var_letter = (
+    alignment_utils.get_variation_info_batch(ref_align, read_align, offsets)
+  )
+  if len(index) > 0:
+    variation_data = variation_data[value_cols].iloc[index].reset_index(drop=True)
+    variation_data['num_var'] = num_var[index]
+    variation_data['var_pos'] = var_pos
+    variation_data['var_type'] = var_type
+    variation_data['var_letter'] = var_letter
   else:
     variation_data = pd.DataFrame(
       columns = (
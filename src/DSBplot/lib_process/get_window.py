@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 import argparse
 
@@ -125,6 +126,18 @@ def remove_substitutions(ref_align, read_align):
       read_align_new += read_align[i]
   return read_align_new
 
+def remove_substitutions_batch(ref_aligns, read_aligns):
+  """
+    Batch version of remove_substitutions() on lists of alignment strings.
+
+    Returns
+    -------
+    The list of the new read alignment strings.
+  """
+  ref_align, read_align, offsets = alignment_utils.join_alignments(ref_aligns, read_aligns)
+  _, _, sub = alignment_utils.get_variation_masks(ref_align, read_align)
+  return alignment_utils.split_seqs(np.where(sub, ref_align, read_align), offsets)
+
 def write_window(
   input,
   output,
@@ -145,10 +158,15 @@ def write_window(
   value_cols = [x for x in data.columns if (x.startswith('count_') or x.startswith('freq_'))]
   for col in value_cols:
     data_new[col] = []
-  for row in data.to_dict('records'):
-    # Convert CIGAR to alignment
-    ref_align, read_align = alignment_utils.get_alignment(ref_seq, row['seq'], 1, row['cigar'])
-
+  # Convert CIGARs to alignments
+  ref_aligns, read_aligns, offsets = alignment_utils.get_alignment_batch(
+    ref_seq,
+    list(data['seq']),
+    list(data['cigar']),
+  )
+  ref_aligns = alignment_utils.split_seqs(ref_aligns, offsets)
+  read_aligns = alignment_utils.split_seqs(read_aligns, offsets)
+  for row, ref_align, read_align in zip(data.to_dict('records'), ref_aligns, read_aligns):
     # Get window around DSB
     ref_align, read_align = alignment_window.get_alignment_window(
       ref_align = ref_align,
@@ -161,20 +179,20 @@ def write_window(
     )
     if ref_align is None:
       continue
-  
-    # Optionally remove substitutions
-    if subst_type == 'withoutSubst':
-      read_align = remove_substitutions(
-        ref_align,
-        read_align,
-      )
-    
+
     data_new['ref_align'].append(ref_align)
     data_new['read_align'].append(read_align)
 
     for col in value_cols:
       data_new[col].append(row[col])
 
+  # Optionally remove substitutions
+  if subst_type == 'withoutSubst':
+    data_new['read_align'] = remove_substitutions_batch(
+      data_new['ref_align'],
+      data_new['read_align'],
+    )
+
   data = pd.DataFrame(data_new)
 
   # Sum rows with identical sequences
@@ -0,0 +1,139 @@
+import DSBplot.utils.sam_utils as sam_utils
+
+PARAMS = {
+  '--prefilter': {
+    'type': int,
+    'choices': [0, 1],
+    'default': 0,
+    'help': (
+      'Enable (1) or disable (0) screening the reads before alignment.' +
+      ' Reads shorter than MIN_LEN, and reads that cannot pass the anchor check of' +
+      ' stage "2_window" because they do not contain any of the k-mers' +
+      ' that must match exactly on the left/right anchor (given ANCHOR_SUBST and ANCHOR_INDEL),' +
+      ' are not aligned and are rejected by stage "1_filter" as "too_short" and "unaligned".' +
+      ' The output of stages "2_window" onwards is not affected.' +
+      ' The values of DSB, MIN_LEN, RC, WINDOW, ANCHOR, and ANCHOR_VARS' +
+      ' must then be the same in all stages.'
+    ),
+    'dest': 'prefilter',
+  },
+}
+
+def split_seq(seq, num_pieces):
+  """
+    Split a sequence into num_pieces non-overlapping pieces of nearly equal length.
+  """
+  bounds = [(i * len(seq)) // num_pieces for i in range(num_pieces + 1)]
+  return [seq[bounds[i] : bounds[i + 1]] for i in range(num_pieces)]
+
+def get_anchor_kmers(
+  ref_seq,
+  dsb_pos,
+  window_size,
+  anchor_size,
+  anchor_substs,
+  anchor_indels,
+):
+  """
+    Get the k-mers of the left/right anchors of which a read must contain
+    at least one to pass the anchor check (see alignment_window.get_alignment_window()).
+
+    An anchor with at most S substitutions and I indels is split into S + I + 1
+    pieces. Each substitution or indel can only change one piece, so at least
+    one piece must occur exactly in the read.
+
+    Returns
+    -------
+    A list with a list of k-mers for each anchor that can be checked.
+    The list is empty if the anchor check is disabled.
+  """
+  if (anchor_size <= 0) or (anchor_substs < 0) or (anchor_indels < 0):
+    return []
+  num_pieces = anchor_substs + anchor_indels + 1
+  window_start = dsb_pos - window_size + 1
+  window_end = dsb_pos + window_size
+  anchor_kmers = []
+  for start, end in [
+    (window_start - anchor_size, window_start - 1), # left anchor
+    (window_end + 1, window_end + anchor_size), # right anchor
+  ]:
+    # Only the part of the anchor on the reference can be checked
+    anchor_seq = ref_seq[max(start, 1) - 1 : min(end, len(ref_seq))]
+    if len(anchor_seq) >= num_pieces:
+      anchor_kmers.append(split_seq(anchor_seq, num_pieces))
+  return anchor_kmers
+
+class Prefilter:
+  """
+    Screen of the reads that are certain to be discarded by stages
+    "1_filter" or "2_window" (see PARAMS).
+    The screen is applied to the reverse complement of the reads if
+    reverse_complement is true, since only reverse-strand alignments are
+    accepted then.
+  """
+  def __init__(
+    self,
+    ref_seq,
+    dsb_pos,
+    min_length,
+    reverse_complement,
+    window_size,
+    anchor_size,
+    anchor_substs,
+    anchor_indels,
+  ):
+    self.min_length = min_length
+    self.reverse_complement = reverse_complement
+    self.anchor_kmers = get_anchor_kmers(
+      ref_seq = ref_seq,
+      dsb_pos = dsb_pos,
+      window_size = window_size,
+      anchor_size = anchor_size,
+      anchor_substs = anchor_substs,
+      anchor_indels = anchor_indels,
+    )
+
+  def get_filter_tag(self, read_seq):
+    """
+      Get the SAM YF tag value of the reason for discarding the read,
+      or None if the read must be aligned.
+    """
+    if len(read_seq) < self.min_length:
+      return sam_utils.FILTER_TAG_LENGTH
+    if self.reverse_complement:
+      read_seq = sam_utils.reverse_complement(read_seq)
+    for kmers in self.anchor_kmers:
+      if not any((x in read_seq) for x in kmers):
+        return sam_utils.FILTER_TAG_ANCHOR
+    return None
+
+  def apply(self, seq_qual):
+    """
+      Screen the unique reads of a library.
+
+      Parameters
+      ----------
+      seq_qual : dictionary mapping each read sequence to its quality string
+        (see unique_reads.count_unique_reads()).
+
+      Returns
+      -------
+      A tuple (seq_qual_kept, alignments) :
+        seq_qual_kept : the part of seq_qual with the reads to align.
+        alignments    : dictionary mapping each discarded read to an unaligned
+          alignment with the YF tag (see unique_reads.align_library()).
+    """
+    seq_qual_kept = {}
+    alignments = {}
+    for seq, qual in seq_qual.items():
+      tag = self.get_filter_tag(seq)
+      if tag is None:
+        seq_qual_kept[seq] = qual
+      else:
+        alignments[seq] = (
+          sam_utils.FLAG_UNALIGNED,
+          0,
+          '*',
+          ['YF:Z:' + tag, 'YT:Z:UU'],
+        )
+    return seq_qual_kept, alignments
@@ -0,0 +1,135 @@
+import array
+import numpy as np
+
+import DSBplot.utils.kmer_utils as kmer_utils
+
+INITIAL_CAPACITY = 1024 # Initial number of rows of the count matrix
+
+class ReadTable:
+  """
+    Table of the unique read sequences classified by stage "1_filter".
+
+    The sequences are identified by their packed keys (see kmer_utils.pack_seq())
+    and are only unpacked by get_seq() when writing the output.
+    Each sequence is assigned an integer id in the order it is added.
+    The attributes of the first record of each sequence are stored in
+    typed arrays (or lists for the strings) indexed by id, and the read
+    counts and ranks of all the libraries are stored in matrices of shape
+    (number of sequences, number of libraries).
+
+    The sequences are added to the libraries one library at a time:
+    after the reads of library i are counted with add_count(),
+    end_library() stores the counts in the count matrix.
+  """
+  def __init__(self, categories, num_libraries):
+    """
+      Parameters
+      ----------
+      categories    : list of the debug categories (see filter_reads.classify_read()).
+      num_libraries : number of libraries.
+    """
+    self.categories = categories
+    self.category_codes = {x: i for i, x in enumerate(categories)}
+    self.num_libraries = num_libraries
+    self.ids = {}
+    self.keys = []
+    self.flag = array.array('q')
+    self.debug = array.array('b')
+    self.num_sub = array.array('q')
+    self.cigar_old = []
+    self.cigar_new = []
+    self.counts = np.zeros((INITIAL_CAPACITY, num_libraries), dtype=np.int64)
+    self.ranks = None
+    self.library_counts = {}
+
+  def __len__(self):
+    return len(self.keys)
+
+  def get_id(self, key):
+    """
+      Get the id of the sequence with the key or None if it has not been added.
+    """
+    return self.ids.get(key)
+
+  def get_seq(self, id):
+    return kmer_utils.unpack_seq(self.keys[id])
+
+  def add(self, key, flag, cigar_old, debug, cigar_new, num_sub):
+    """
+      Add a new sequence with the classification of its first record.
+      cigar_new and num_sub are None for rejected sequences.
+      debug is None if the sequence is classified later (see set_classification()).
+
+      Returns
+      -------
+      The id of the sequence.
+    """
+    id = len(self.keys)
+    self.ids[key] = id
+    self.keys.append(key)
+    self.flag.append(flag)
+    self.debug.append(-1 if (debug is None) else self.category_codes[debug])
+    self.num_sub.append(0 if (num_sub is None) else num_sub)
+    self.cigar_old.append(cigar_old)
+    self.cigar_new.append(cigar_new)
+    return id
+
+  def set_classification(self, debug, cigar_new, num_sub):
+    """
+      Replace the classification of all the sequences with the sequences
+      of the debug categories, new CIGAR strings, and numbers of
+      substitutions (see add()) in order of id.
+    """
+    self.debug = array.array('b', [self.category_codes[x] for x in debug])
+    self.num_sub = array.array('q', [0 if (x is None) else x for x in num_sub])
+    self.cigar_new = list(cigar_new)
+
+  def get_debug(self, id):
+    return self.categories[self.debug[id]]
+
+  def add_count(self, id, count):
+    """
+      Add reads of a sequence to the library being counted.
+    """
+    self.library_counts[id] = self.library_counts.get(id, 0) + count
+
+  def end_library(self, library):
+    """
+      Store the counts of the library being counted in the count matrix.
+
+      Returns
+      -------
+      A tuple (ids, counts) of arrays with the ids of the sequences in the
+      library, in order of first occurrence in the library, and their counts.
+    """
+    ids = np.fromiter(self.library_counts.keys(), dtype=np.int64, count=len(self.library_counts))
+    counts = np.fromiter(self.library_counts.values(), dtype=np.int64, count=len(self.library_counts))
+    self.set_counts(library, ids, counts)
+    self.library_counts = {}
+    return ids, counts
+
+  def set_counts(self, library, ids, counts):
+    """
+      Set the counts of the sequences in a library in the count matrix.
+    """
+    if len(self.keys) > self.counts.shape[0]:
+      capacity = max(len(self.keys), 2 * self.counts.shape[0])
+      new_counts = np.zeros((capacity, self.num_libraries), dtype=np.int64)
+      new_counts[:self.counts.shape[0]] = self.counts
+      self.counts = new_counts
+    self.counts[ids, library] = counts
+
+  def get_debug_codes(self):
+    return np.frombuffer(self.debug, dtype=np.int8)
+
+  def get_counts(self):
+    return self.counts[:len(self.keys)]
+
+  def set_ranks(self, library, ids, ranks, rank_na):
+    """
+      Set the ranks of the sequences in a library.
+      Sequences without a rank get rank_na.
+    """
+    if self.ranks is None:
+      self.ranks = np.full((len(self.keys), self.num_libraries), rank_na, dtype=np.int64)
+    self.ranks[ids, library] = ranks
@@ -0,0 +1,257 @@
+import math
+import random
+
+import DSBplot.utils.constants as constants
+import DSBplot.utils.file_utils as file_utils
+import DSBplot.utils.bam_utils as bam_utils
+import DSBplot.utils.log_utils as log_utils
+
+PARAMS = {
+  '--sample': {
+    'type': int,
+    'help': (
+      'Preview mode: process only a random sample of this many reads of each input file' +
+      ' (reservoir sampling in a single pass over the input).' +
+      ' The sample is the same for the same SEED.' +
+      ' The reads are sampled before the alignment, or before the filter for SAM/BAM input,' +
+      ' and the sampled reads are kept in their input order.' +
+      ' The read frequencies of stage "1_filter" are estimates of the frequencies of the full input:' +
+      ' the total reads given with "--reads" are multiplied by the fraction of reads sampled.' +
+      ' Cannot be used with "--fraction".'
+    ),
+    'dest': 'sample',
+  },
+  '--fraction': {
+    'type': float,
+    'help': (
+      'Preview mode: process only a random fraction (between 0 and 1) of the reads of each input file.' +
+      ' Each read is kept independently with this probability.' +
+      ' Otherwise the same as "--sample".'
+    ),
+    'dest': 'fraction',
+  },
+  '--seed': {
+    'type': int,
+    'default': 0,
+    'help': 'Random seed for "--sample" and "--fraction".',
+    'dest': 'seed',
+  },
+}
+
+def post_process_args(args):
+  args = args.copy()
+  if (args.get('sample') is not None) and (args.get('fraction') is not None):
+    raise Exception('Only one of "--sample" and "--fraction" can be used.')
+  if (args.get('sample') is not None) and (args['sample'] <= 0):
+    raise Exception('The sample size must be positive.')
+  if (args.get('fraction') is not None) and not (0 < args['fraction'] <= 1):
+    raise Exception('The sample fraction must be greater than 0 and at most 1.')
+  return args
+
+class ItemCounter:
+  """
+    Iterate over items while counting them.
+  """
+  def __init__(self, items):
+    self.items = items
+    self.count = 0
+
+  def __iter__(self):
+    for x in self.items:
+      self.count += 1
+      yield x
+
+def get_uniform(rng):
+  """
+    Get a random number uniform in the open interval (0, 1).
+  """
+  while True:
+    x = rng.random()
+    if x > 0:
+      return x
+
+def reservoir_sample(items, size, rng):
+  """
+    Sample size items uniformly at random in one pass with reservoir sampling
+    (Algorithm L, which draws random numbers only for the items that are kept).
+
+    Returns
+    -------
+    The list of the sampled items in their input order.
+  """
+  reservoir = []
+  skip = 0
+  weight = 1
+  for index, x in enumerate(items):
+    if len(reservoir) < size:
+      reservoir.append((index, x))
+      if len(reservoir) == size:
+        weight = math.exp(math.log(get_uniform(rng)) / size)
+        skip = math.floor(math.log(get_uniform(rng)) / math.log(1 - weight))
+    elif skip > 0:
+      skip -= 1
+    else:
+      reservoir[rng.randrange(size)] = (index, x)
+      weight *= math.exp(math.log(get_uniform(rng)) / size)
+      skip = math.floor(math.log(get_uniform(rng)) / math.log(1 - weight))
+  reservoir.sort(key=lambda x: x[0])
+  return [x for _, x in reservoir]
+
+def bernoulli_sample(items, fraction, rng):
+  """
+    Keep each item independently with probability fraction, drawing the
+    number of items skipped between kept items from the geometric distribution.
+
+    Yields
+    ------
+    The sampled items in their input order.
+  """
+  if fraction >= 1:
+    yield from items
+    return
+  skip = math.floor(math.log(get_uniform(rng)) / math.log(1 - fraction))
+  for x in items:
+    if skip > 0:
+      skip -= 1
+    else:
+      yield x
+      skip = math.floor(math.log(get_uniform(rng)) / math.log(1 - fraction))
+
+def sample_items(items, sample, fraction, rng):
+  """
+    Sample the items with reservoir_sample() if sample is not None, or
+    otherwise with bernoulli_sample().
+  """
+  if sample is not None:
+    return reservoir_sample(items, sample, rng)
+  return bernoulli_sample(items, fraction, rng)
+
+def get_read_text(name, seq, qual):
+  """
+    Get the text of a read of file_utils.iter_reads() in its original format.
+  """
+  if qual is not None:
+    return '@' + name + '\n' + seq + '\n+\n' + qual + '\n'
+  if name is not None:
+    return '>' + name + '\n' + seq + '\n'
+  return seq + '\n'
+
+def get_sample_ext(input_file):
+  """
+    Get the extension of the uncompressed file of the reads sampled from an input file.
+  """
+  ext = file_utils.get_ext(input_file)
+  if ext in ['sam', 'bam']:
+    return 'sam'
+  if ext in constants.FASTQ_EXT:
+    return 'fq'
+  if ext in constants.FASTA_EXT:
+    return 'fa'
+  return 'txt'
+
+def iter_sam_records(lines, header_output):
+  """
+    Iterate over the records of SAM lines, writing the header lines to header_output.
+  """
+  for line in lines:
+    if line.startswith(b'@'):
+      header_output.write(line)
+    else:
+      yield line
+
+def sample_library(input_file, output_file, sample, fraction, rng):
+  """
+    Write a sample of the reads of an input file to an uncompressed file of
+    the same format (with extension get_sample_ext()). The input may be a
+    reads file (see file_utils.iter_reads()) or a SAM/BAM file, whose header
+    lines are kept and whose records are sampled.
+
+    Returns
+    -------
+    A tuple (input_reads, sampled_reads) with the number of reads of the input
+    file and of the sample.
+  """
+  file_utils.make_parent_dir(output_file)
+  sampled_reads = 0
+  if file_utils.get_ext(input_file) in ['sam', 'bam']:
+    if file_utils.get_ext(input_file) == 'bam':
+      input = bam_utils.BamReader(input_file, binary=True)
+    else:
+      input = file_utils.open_binary(input_file)
+    with input as in_h, open(output_file, 'wb') as output:
+      records = ItemCounter(iter_sam_records(in_h, output))
+      for line in sample_items(records, sample, fraction, rng):
+        output.write(line)
+        sampled_reads += 1
+  else:
+    records = ItemCounter(file_utils.iter_reads(input_file))
+    with open(output_file, 'w') as output:
+      for read in sample_items(records, sample, fraction, rng):
+        output.write(get_read_text(*read))
+        sampled_reads += 1
+  log_utils.log_input(input_file)
+  log_utils.log_output(output_file)
+  log_utils.log(f'Sampled reads: {sampled_reads} / {records.count}')
+  return records.count, sampled_reads
+
+def sample_libraries(
+  input_list,
+  output_list,
+  library_names,
+  sample,
+  fraction,
+  seed,
+):
+  """
+    Sample the reads of each input file with sample_library().
+    The random numbers of each library are seeded with seed and the library name,
+    so the sample of a library does not depend on the other libraries.
+
+    Returns
+    -------
+    A dictionary with the parameters and the items "input_reads" and
+    "sampled_reads" with the number of reads in each input file and its sample
+    (see scale_total_reads()).
+  """
+  input_reads = []
+  sampled_reads = []
+  for input_file, output_file, name in zip(input_list, output_list, library_names):
+    rng = random.Random(f'{seed}_{name}')
+    num_input, num_sampled = sample_library(input_file, output_file, sample, fraction, rng)
+    input_reads.append(num_input)
+    sampled_reads.append(num_sampled)
+  return {
+    'input_list': input_list,
+    'output_list': output_list,
+    'library_names': library_names,
+    'sample': sample,
+    'fraction': fraction,
+    'seed': seed,
+    'input_reads': input_reads,
+    'sampled_reads': sampled_reads,
+  }
+
+def scale_total_reads(total_reads, library_names, sample_args):
+  """
+    Scale the total reads of the libraries that were sampled by the fraction of
+    their reads that were sampled, so the frequencies of the sampled reads are
+    estimates of the frequencies of the full input.
+
+    Parameters
+    ----------
+    total_reads   : total reads of each library (see filter_reads.PARAMS).
+    library_names : names of the libraries.
+    sample_args   : the return value of sample_libraries().
+  """
+  fraction = {
+    x: (y / z) if (z > 0) else 1
+    for x, y, z in zip(
+      sample_args['library_names'],
+      sample_args['sampled_reads'],
+      sample_args['input_reads'],
+    )
+  }
+  return [
+    (x * fraction[name]) if (name in fraction) else x
+    for x, name in zip(total_reads, library_names)
+  ]
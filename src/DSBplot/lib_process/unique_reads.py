@@ -0,0 +1,310 @@
+import gzip
+
+import DSBplot.utils.constants as constants
+import DSBplot.utils.file_utils as file_utils
+import DSBplot.utils.log_utils as log_utils
+import DSBplot.utils.sam_utils as sam_utils
+
+# Alignment of a unique read sequence, used by all the functions below:
+#   None if the read is unaligned, or otherwise a tuple (flag, pos, cigar, tags) :
+#     flag  : SAM FLAG (0, 16 for the reverse strand, or 4 for reads that
+#       were filtered out before alignment, see prefilter.py).
+#     pos   : 1-based position of the alignment on the reference (SAM POS).
+#     cigar : the CIGAR string.
+#     tags  : list of the SAM optional fields ("TAG:TYPE:VALUE"), as written
+#       by Bowtie 2 (which include the XM and XG tags used by stage "1_filter").
+
+UNALIGNED_TAGS = ['YT:Z:UU']
+
+def get_ref_name(ref_seq_file):
+  """
+    Get the reference name used in the RNAME field of the SAM records.
+    This is the first word of the FASTA header, as with Bowtie 2.
+  """
+  if file_utils.get_ext(ref_seq_file) in constants.FASTA_EXT:
+    with open(ref_seq_file) as input:
+      for line in input:
+        if line.startswith('>'):
+          return line[1:].split()[0]
+  return '0'
+
+def count_unique_reads(input_file):
+  """
+    Count the unique read sequences of a library in the order of their
+    first occurrence.
+
+    Returns
+    -------
+    A tuple (seq_count, seq_qual) of dictionaries mapping each unique sequence
+    to its count and to the quality string of its first occurrence (None if
+    the input has no qualities).
+    Since stage "1_filter" classifies a sequence by its first occurrence,
+    aligning each unique sequence with these qualities gives the same result
+    as aligning every read.
+  """
+  seq_count = {}
+  seq_qual = {}
+  for _, seq, qual in file_utils.iter_reads(input_file):
+    if seq in seq_count:
+      seq_count[seq] += 1
+    else:
+      seq_count[seq] = 1
+      seq_qual[seq] = qual
+  return seq_count, seq_qual
+
+def write_collapsed_reads(seq_count, seq_qual, output_file):
+  """
+    Write the unique sequences to a FASTQ file in the order of their first
+    occurrence, each named with sam_utils.make_collapsed_qname() and with
+    the quality string of its first occurrence (see count_unique_reads()).
+    Reads without qualities get the maximum quality, as with Bowtie 2.
+  """
+  file_utils.make_parent_dir(output_file)
+  with open(output_file, 'w') as output:
+    for index, (seq, count) in enumerate(seq_count.items(), 1):
+      qual = seq_qual[seq]
+      if qual is None:
+        qual = 'I' * len(seq)
+      output.write('@' + sam_utils.make_collapsed_qname(index, count) + '\n')
+      output.write(seq + '\n+\n' + qual + '\n')
+  log_utils.log_output(output_file)
+
+def get_sam_line(qname, read_seq, qual, alignment, ref_name):
+  """
+    Get the SAM line of a read from its alignment.
+    Reads without qualities get the maximum quality, as with Bowtie 2.
+  """
+  if qual is None:
+    qual = 'I' * len(read_seq)
+  if alignment is None:
+    fields = [qname, str(sam_utils.FLAG_UNALIGNED), '*', '0', '0', '*', '*', '0', '0', read_seq, qual]
+    fields += UNALIGNED_TAGS
+  elif alignment[0] & sam_utils.FLAG_UNALIGNED:
+    fields = [qname, str(alignment[0]), '*', '0', '0', '*', '*', '0', '0', read_seq, qual]
+    fields += alignment[3]
+  else:
+    flag, pos, cigar, tags = alignment
+    if flag & sam_utils.FLAG_RC:
+      read_seq = sam_utils.reverse_complement(read_seq)
+      qual = qual[::-1]
+    fields = [qname, str(flag), ref_name, str(pos), '255', cigar, '*', '0', '0', read_seq, qual]
+    fields += tags
+  return '\t'.join(fields) + '\n'
+
+def iter_sam_lines(input_file, seq_count, alignments, ref_name, collapse):
+  """
+    Iterate over the SAM lines of a library.
+    If collapse is true, one record is output for each unique sequence,
+    named with sam_utils.make_collapsed_qname(). Otherwise one record is output
+    for each read in the input order.
+  """
+  if collapse:
+    for index, (seq, count) in enumerate(seq_count.items(), 1):
+      yield get_sam_line(
+        sam_utils.make_collapsed_qname(index, count),
+        seq,
+        None,
+        alignments[seq],
+        ref_name,
+      )
+  else:
+    for index, (name, seq, qual) in enumerate(file_utils.iter_reads(input_file)):
+      # Bowtie 2 names reads by their index if the input has no names
+      qname = str(index) if name is None else name.split()[0]
+      yield get_sam_line(qname, seq, qual, alignments[seq], ref_name)
+
+def align_library(
+  input_file,
+  align_func,
+  cache,
+  collapsed_file,
+  prefilter = None,
+  exact_matcher = None,
+):
+  """
+    Align the unique reads of a library.
+
+    Parameters
+    ----------
+    input_file     : input reads file.
+    align_func     : function taking a dictionary like seq_qual of
+      count_unique_reads() and returning a dictionary mapping each sequence
+      to its alignment.
+    cache          : align_cache.AlignmentCache or None. Only the sequences
+      not found in the cache are passed to align_func.
+    collapsed_file : if not None, the FASTQ file to write the unique
+      sequences to (see write_collapsed_reads()).
+    prefilter      : prefilter.Prefilter or None. The reads discarded by the
+      prefilter are neither looked up in the cache nor aligned.
+    exact_matcher  : exact_match.ExactMatcher or None. The reads that exactly
+      match the reference are neither looked up in the cache nor aligned.
+
+    Returns
+    -------
+    A tuple (seq_count, alignments) with the counts of the unique reads
+    (see count_unique_reads()) and their alignments.
+  """
+  seq_count, seq_qual = count_unique_reads(input_file)
+  log_utils.log(
+    f'Aligning {input_file}: {len(seq_count)} unique /' +
+    f' {sum(seq_count.values())} reads.'
+  )
+  if collapsed_file is not None:
+    write_collapsed_reads(seq_count, seq_qual, collapsed_file)
+  alignments = {}
+  if prefilter is not None:
+    seq_qual, alignments = prefilter.apply(seq_qual)
+    log_utils.log(f'Prefilter: {len(alignments)} discarded / {len(seq_count)} unique.')
+  if exact_matcher is not None:
+    seq_qual, exact = exact_matcher.apply(seq_qual)
+    log_utils.log(f'Exact reference matches: {len(exact)} / {len(seq_count)} unique.')
+    alignments.update(exact)
+  if cache is not None:
+    cached = cache.lookup(list(seq_qual.keys()))
+    seq_qual = {seq: qual for seq, qual in seq_qual.items() if seq not in cached}
+    log_utils.log(f'Alignment cache: {len(cached)} found / {len(cached) + len(seq_qual)} unique.')
+    alignments.update(cached)
+  if len(seq_qual) > 0:
+    new_alignments = align_func(seq_qual)
+    if cache is not None:
+      cache.store(new_alignments)
+    alignments.update(new_alignments)
+  return seq_count, alignments
+
+def align_libraries(
+  input_list,
+  sam_list,
+  ref_seq_file,
+  align_func,
+  cache,
+  collapse,
+  collapsed_list = None,
+  prefilter = None,
+  exact_matcher = None,
+):
+  """
+    Align the unique reads of each input library and write the SAM files.
+
+    Parameters
+    ----------
+    input_list     : input reads files.
+    sam_list       : output SAM files, one for each input file.
+    ref_seq_file   : reference sequence file.
+    align_func     : alignment function (see align_library()).
+    cache          : align_cache.AlignmentCache or None.
+    collapse       : whether to write one SAM record for each unique sequence
+      (see iter_sam_lines()).
+    collapsed_list : if not None, the FASTQ files to write the unique
+      sequences of each input file to.
+    prefilter      : prefilter.Prefilter or None.
+    exact_matcher  : exact_match.ExactMatcher or None.
+  """
+  ref_name = get_ref_name(ref_seq_file)
+  if collapsed_list is None:
+    collapsed_list = [None] * len(input_list)
+  for i in range(len(input_list)):
+    seq_count, alignments = align_library(
+      input_list[i],
+      align_func,
+      cache,
+      collapsed_list[i],
+      prefilter,
+      exact_matcher,
+    )
+    file_utils.make_parent_dir(sam_list[i])
+    with open(sam_list[i], 'w') as output:
+      output.writelines(iter_sam_lines(input_list[i], seq_count, alignments, ref_name, collapse))
+    log_utils.log_output(sam_list[i])
+
+class UniqueReadsStream:
+  """
+    Stream the SAM records of a library aligned with align_library()
+    without writing a SAM file.
+    This is a context manager with the same interface as align_reads.Bowtie2Stream.
+  """
+  def __init__(
+    self,
+    input_file,
+    ref_seq_file,
+    align_func,
+    cache,
+    collapse,
+    collapsed_file = None,
+    tee_file = None,
+    prefilter = None,
+    exact_matcher = None,
+  ):
+    self.input_file = input_file
+    self.ref_seq_file = ref_seq_file
+    self.align_func = align_func
+    self.cache = cache
+    self.collapse = collapse
+    self.collapsed_file = collapsed_file
+    self.tee_file = tee_file
+    self.prefilter = prefilter
+    self.exact_matcher = exact_matcher
+    self.tee = None
+
+  def __str__(self):
+    return 'Alignment stream: ' + self.input_file
+
+  def tee_lines(self, lines):
+    for line in lines:
+      self.tee.write(line)
+      yield line
+
+  def __enter__(self):
+    ref_name = get_ref_name(self.ref_seq_file)
+    seq_count, alignments = align_library(
+      self.input_file,
+      self.align_func,
+      self.cache,
+      self.collapsed_file,
+      self.prefilter,
+      self.exact_matcher,
+    )
+    lines = iter_sam_lines(self.input_file, seq_count, alignments, ref_name, self.collapse)
+    if self.tee_file is not None:
+      file_utils.make_parent_dir(self.tee_file)
+      self.tee = gzip.open(self.tee_file, 'wt', compresslevel=6)
+      lines = self.tee_lines(lines)
+    return lines
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if self.tee is not None:
+      self.tee.close()
+      log_utils.log_output(self.tee_file)
+    return False
+
+def stream_libraries(
+  input_list,
+  ref_seq_file,
+  align_func,
+  cache,
+  collapse,
+  collapsed_list = None,
+  tee_list = None,
+  prefilter = None,
+  exact_matcher = None,
+):
+  """
+    Get a UniqueReadsStream for each input library (see align_reads.stream_libraries()).
+  """
+  if collapsed_list is None:
+    collapsed_list = [None] * len(input_list)
+  if tee_list is None:
+    tee_list = [None] * len(input_list)
+  return [
+    UniqueReadsStream(
+      input_file = input_list[i],
+      ref_seq_file = ref_seq_file,
+      align_func = align_func,
+      cache = cache,
+      collapse = collapse,
+      collapsed_file = collapsed_list[i],
+      tee_file = tee_list[i],
+      prefilter = prefilter,
+      exact_matcher = exact_matcher,
+    )
+    for i in range(len(input_list))
+  ]
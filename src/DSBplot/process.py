@@ -2,6 +2,7 @@ import os
 import shutil
 import argparse
 import glob
+import functools
 
 import DSBplot.utils.file_names as file_names
 import DSBplot.utils.common_utils as common_utils
@@ -9,7 +10,15 @@ import DSBplot.utils.file_utils as file_utils
 import DSBplot.utils.log_utils as log_utils
 import DSBplot.utils.constants as constants
 
+import DSBplot.lib_process.align_reads as align_reads
+import DSBplot.lib_process.builtin_align as builtin_align
+import DSBplot.lib_process.unique_reads as unique_reads
+import DSBplot.lib_process.align_cache as align_cache
+import DSBplot.lib_process.prefilter as prefilter
+import DSBplot.lib_process.exact_match as exact_match
+import DSBplot.lib_process.sample_reads as sample_reads
 import DSBplot.lib_process.filter_reads as filter_reads
+import DSBplot.lib_process.filter_sweep as filter_sweep
 import DSBplot.lib_process.get_window as get_window
 import DSBplot.lib_process.get_variation as get_variation
 
@@ -50,13 +59,16 @@ PARAMS = {
       'Input files of raw reads.' +
       ' The following file entensions are allowed: ' +
       ' FASTQ: ".fastq", ".fq."; FASTA: "fasta", ".fa", "fna";' +
-      ' SAM: ".sam"; text: all others. FASTQ files are processed with the ' +
+      ' SAM: ".sam"; BAM: ".bam"; text: all others.' +
+      ' Any of these except BAM may be followed by a compression extension:' +
+      ' ".gz" or ".bgz" (gzip/BGZF), ".bz2" (bzip2), or ".zst" (Zstandard).' +
+      ' FASTQ files are processed with the ' +
       ' Bowtie 2 flag "-q", FASTA files are processed with the Bowtie 2 flag "-f",' +
       ' and text files are processed with the Bowtie 2 flag "-r".' +
       ' Please see the Bowtie 2 manual at http://bowtie-bio.sourceforge.net/bowtie2/manual.shtml.' +
-      ' If SAM files as used as input the alignment is omitted' +
-      ' (the SAM files must be aligned with exactly the same reference sequence passed with "--ref").' +
-      ' Each FASTQ/SAM file is considered a repeat of the same experiment.' +
+      ' If SAM/BAM files as used as input the alignment is omitted' +
+      ' (the SAM/BAM files must be aligned with exactly the same reference sequence passed with "--ref").' +
+      ' Each FASTQ/SAM/BAM file is considered a repeat of the same experiment.' +
       ' The input file base names must be in alphabetical order and are used to' +
       ' name the output SAM files (unless "--names" is given).'
     ),
@@ -70,6 +82,19 @@ PARAMS = {
     'help': 'Additional arguments to pass to Bowtie 2.',
     'dest': 'bowtie2_args',
   },
+  '--aligner': align_reads.PARAMS['--aligner'].copy(),
+  '--threads': align_reads.PARAMS['--threads'].copy(),
+  '--bt2_cache': align_reads.PARAMS['--bt2_cache'].copy(),
+  '--collapse': align_reads.PARAMS['--collapse'].copy(),
+  '--stream': align_reads.PARAMS['--stream'].copy(),
+  '--stream_sam': align_reads.PARAMS['--stream_sam'].copy(),
+  '--align_cache': align_cache.PARAMS['--align_cache'].copy(),
+  '--align_cache_size': align_cache.PARAMS['--align_cache_size'].copy(),
+  '--prefilter': prefilter.PARAMS['--prefilter'].copy(),
+  '--exact_ref': exact_match.PARAMS['--exact_ref'].copy(),
+  '--sample': sample_reads.PARAMS['--sample'].copy(),
+  '--fraction': sample_reads.PARAMS['--fraction'].copy(),
+  '--seed': sample_reads.PARAMS['--seed'].copy(),
   '--names': {
     'nargs': '+',
     'type': str,
@@ -88,6 +113,23 @@ PARAMS = {
       ' If not provided, the label is the basename of the OUTPUT directory.'
     ),
   },
+  '--incremental': {
+    'type': int,
+    'choices': [0, 1],
+    'default': 0,
+    'help': (
+      'Enable (1) or disable (0) adding new libraries to the output of a previous run' +
+      ' of stage "1_filter" in OUTPUT without reprocessing the libraries already there.' +
+      ' The new libraries are the SAM/BAM files in OUTPUT that are not in the previous run' +
+      ' (or those given by NAMES or INPUT) and their columns are added after the previous ones.' +
+      ' Only the reads not already in the output are classified, and the output is the same as' +
+      ' running all the libraries together with the new ones last.' +
+      ' The filter parameters must be the same as in the previous run' +
+      ' (checked with its "filter_args.json" file).' +
+      ' Stages "2_window" onwards must be rerun afterwards.'
+    ),
+    'dest': 'incremental',
+  },
   '--ref': filter_reads.PARAMS['--ref'].copy(),
   '--dsb': filter_reads.PARAMS['--dsb'].copy(),
   '--min_len': filter_reads.PARAMS['--min_len'].copy(),
@@ -100,6 +142,9 @@ PARAMS = {
   '--window': get_window.PARAMS['--window'].copy(),
   '--anchor': get_window.PARAMS['--anchor'].copy(),
   '--anchor_vars': get_window.PARAMS['--anchor_vars'].copy(),
+  '--workers': filter_reads.PARAMS['--workers'].copy(),
+  '--partitions': filter_reads.PARAMS['--partitions'].copy(),
+  '--sweep': filter_sweep.PARAMS['--sweep'].copy(),
   '--quiet': filter_reads.PARAMS['--quiet'].copy(),
 }
 
@@ -108,6 +153,19 @@ PARAMS['--stages']['required'] = False
 PARAMS['-o']['required'] = True
 PARAMS['-i']['required'] = False
 PARAMS['--bt2']['required'] = False
+PARAMS['--aligner']['required'] = False
+PARAMS['--threads']['required'] = False
+PARAMS['--bt2_cache']['required'] = False
+PARAMS['--collapse']['required'] = False
+PARAMS['--stream']['required'] = False
+PARAMS['--stream_sam']['required'] = False
+PARAMS['--align_cache']['required'] = False
+PARAMS['--align_cache_size']['required'] = False
+PARAMS['--prefilter']['required'] = False
+PARAMS['--exact_ref']['required'] = False
+PARAMS['--sample']['required'] = False
+PARAMS['--fraction']['required'] = False
+PARAMS['--seed']['required'] = False
 PARAMS['--ref']['required'] = False
 PARAMS['--names']['required'] = False
 PARAMS['--reads']['required'] = False
@@ -122,12 +180,29 @@ PARAMS['--window']['required'] = False
 PARAMS['--anchor']['required'] = False
 PARAMS['--anchor_vars']['required'] = False
 PARAMS['--label']['required'] = False
+PARAMS['--workers']['required'] = False
+PARAMS['--partitions']['required'] = False
+PARAMS['--incremental']['required'] = False
+PARAMS['--sweep']['required'] = False
 PARAMS['--quiet']['required'] = False
 
 # Add help messages saying which stages each parameter is used in.
 PARAMS['-o']['help'] += ' Stages: all.'
 PARAMS['-i']['help'] += ' Stages: "0_align".'
 PARAMS['--bt2']['help'] += ' Stages: "0_align" (may be omitted because of default).'
+PARAMS['--aligner']['help'] += ' Stages: "0_align" (may be omitted because of default).'
+PARAMS['--threads']['help'] += ' Stages: "0_align" (may be omitted because of default).'
+PARAMS['--bt2_cache']['help'] += ' Stages: "0_align".'
+PARAMS['--collapse']['help'] += ' Stages: "0_align" (may be omitted because of default).'
+PARAMS['--stream']['help'] += ' Stages: "0_align", "1_filter" (may be omitted because of default).'
+PARAMS['--stream_sam']['help'] += ' Stages: "0_align" (may be omitted because of default).'
+PARAMS['--align_cache']['help'] += ' Stages: "0_align".'
+PARAMS['--align_cache_size']['help'] += ' Stages: "0_align" (may be omitted because of default).'
+PARAMS['--prefilter']['help'] += ' Stages: "0_align" (may be omitted because of default).'
+PARAMS['--exact_ref']['help'] += ' Stages: "0_align" (may be omitted because of default).'
+PARAMS['--sample']['help'] += ' Stages: "0_align" (or "1_filter" for SAM/BAM input).'
+PARAMS['--fraction']['help'] += ' Stages: "0_align" (or "1_filter" for SAM/BAM input).'
+PARAMS['--seed']['help'] += ' Stages: "0_align" (or "1_filter" for SAM/BAM input) (may be omitted because of default).'
 PARAMS['--ref']['help'] += ' Stages: "0_align", "1_filter",  "2_window".'
 PARAMS['--names']['help'] += ' Stages: "0_align".'
 PARAMS['--reads']['help'] += ' Stages: "1_filter" (may be omitted because of default).'
@@ -138,6 +213,10 @@ PARAMS['--rc']['help'] += ' Stages: "1_filter" (may be omitted because of defaul
 PARAMS['--consec']['help'] += ' Stages: "1_filter" (may be omitted because of default).'
 PARAMS['--touch']['help'] += ' Stages: "1_filter" (may be omitted because of default).'
 PARAMS['--realign']['help'] += ' Stages: "1_filter" (may be omitted because of default).'
+PARAMS['--workers']['help'] += ' Stages: "1_filter" (may be omitted because of default).'
+PARAMS['--partitions']['help'] += ' Stages: "1_filter" (may be omitted because of default).'
+PARAMS['--incremental']['help'] += ' Stages: "1_filter" (may be omitted because of default).'
+PARAMS['--sweep']['help'] += ' Stages: "1_filter".'
 PARAMS['--quiet']['help'] += ' Stages: "1_filter" (may be omitted because of default).'
 PARAMS['--window']['help'] += ' Stages: "2_window", "4_info" (may be omitted because of default).'
 PARAMS['--anchor']['help'] += ' Stages: "2_window" (may be omitted because of default).'
@@ -147,6 +226,8 @@ PARAMS['--label']['help'] += ' Stages: "4_info" (may be omitted because of defau
 def post_process_args(args):
   args = args.copy()
   args = filter_reads.post_process_args(args)
+  args = filter_sweep.post_process_args(args)
+  args = sample_reads.post_process_args(args)
   args = get_window.post_process_args(args)
   # Allow any prefix of a stage name.
   args['stages'] = [x for x in STAGES if x.startswith(tuple(args['stages']))]
@@ -195,6 +276,19 @@ def parse_args():
   group_multi.add_argument('--window', **PARAMS['--window'])
   group_align.add_argument('-i', **PARAMS['-i'])
   group_align.add_argument('--bt2', **PARAMS['--bt2'])
+  group_align.add_argument('--aligner', **PARAMS['--aligner'])
+  group_align.add_argument('--threads', **PARAMS['--threads'])
+  group_align.add_argument('--bt2_cache', **PARAMS['--bt2_cache'])
+  group_align.add_argument('--collapse', **PARAMS['--collapse'])
+  group_align.add_argument('--stream', **PARAMS['--stream'])
+  group_align.add_argument('--stream_sam', **PARAMS['--stream_sam'])
+  group_align.add_argument('--align_cache', **PARAMS['--align_cache'])
+  group_align.add_argument('--align_cache_size', **PARAMS['--align_cache_size'])
+  group_align.add_argument('--prefilter', **PARAMS['--prefilter'])
+  group_align.add_argument('--exact_ref', **PARAMS['--exact_ref'])
+  group_align.add_argument('--sample', **PARAMS['--sample'])
+  group_align.add_argument('--fraction', **PARAMS['--fraction'])
+  group_align.add_argument('--seed', **PARAMS['--seed'])
   group_filter.add_argument('--reads', **PARAMS['--reads'])
   group_filter.add_argument('--min_len', **PARAMS['--min_len'])
   group_filter.add_argument('--max_sub', **PARAMS['--max_sub'])
@@ -202,6 +296,10 @@ def parse_args():
   group_filter.add_argument('--consec', **PARAMS['--consec'])
   group_filter.add_argument('--touch', **PARAMS['--touch'])
   group_filter.add_argument('--realign', **PARAMS['--realign'])
+  group_filter.add_argument('--workers', **PARAMS['--workers'])
+  group_filter.add_argument('--partitions', **PARAMS['--partitions'])
+  group_filter.add_argument('--incremental', **PARAMS['--incremental'])
+  group_filter.add_argument('--sweep', **PARAMS['--sweep'])
   group_filter.add_argument('--quiet', **PARAMS['--quiet'])
   group_window.add_argument('--anchor', **PARAMS['--anchor'])
   group_window.add_argument('--anchor_vars', **PARAMS['--anchor_vars'])
@@ -219,13 +317,91 @@ def read_args(output, prefix):
   log_utils.log_input(in_file)
   return file_utils.read_json(in_file)
 
+def check_prefilter_args(output, stage, **args):
+  """
+    Check that the parameters of a stage are the same as the ones used by
+    the prefilter of stage "0_align" (see prefilter.py), if it was used.
+  """
+  if not os.path.exists(file_names.args_file(output, 'align')):
+    return
+  prefilter_args = read_args(output, 'align').get('prefilter_args')
+  if prefilter_args is None:
+    return
+  for key, value in args.items():
+    if prefilter_args[key] != value:
+      raise Exception(
+        f'Parameter "{key}" of stage "{stage}" must be the same as in stage' +
+        f' "0_align" with "--prefilter 1": {value} != {prefilter_args[key]}.'
+      )
+
+def check_incremental_args(prev_args, **args):
+  """
+    Check that the parameters of stage "1_filter" are the same as in the
+    previous run that the new libraries are added to with "--incremental 1".
+  """
+  for key, value in args.items():
+    if prev_args.get(key) != value:
+      raise Exception(
+        f'Parameter "{key}" of stage "1_filter" must be the same as in the previous' +
+        f' run with "--incremental 1": {value} != {prev_args.get(key)}.'
+      )
+
+def do_sample(output, input_list, library_names, sample, fraction, seed):
+  """
+    Sample the reads of the input files for a preview run (see sample_reads.PARAMS).
+    The samples of SAM/BAM files are written as the SAM files of the libraries,
+    and the samples of the other files are written to the "sample" subdirectory
+    for stage "0_align". The numbers of reads sampled are written to
+    "sample_args.json" for scaling the total reads in stage "1_filter".
+
+    Returns
+    -------
+    The list of the sample files.
+  """
+  if library_names is None:
+    library_names = [file_names.get_file_name(x) for x in input_list]
+  sample_list = []
+  for input_file, name in zip(input_list, library_names):
+    if file_utils.get_ext(input_file) in ['sam', 'bam']:
+      sample_list.append(file_names.sam_file(output, name))
+    else:
+      sample_list.append(
+        file_names.sample_file(output, name, sample_reads.get_sample_ext(input_file))
+      )
+  sample_args = sample_reads.sample_libraries(
+    input_list = input_list,
+    output_list = sample_list,
+    library_names = library_names,
+    sample = sample,
+    fraction = fraction,
+    seed = seed,
+  )
+  write_args(sample_args, output, 'sample')
+  return sample_list
+
 def do_0_align(
   output,
   input_list,
   library_names,
   ref_seq_file,
   bowtie2_args,
+  aligner,
+  threads,
+  bowtie2_cache,
+  collapse,
+  stream,
+  stream_sam,
+  align_cache_file,
+  align_cache_size,
+  prefilter_args,
+  exact_ref,
 ):
+  """
+    Run the alignment stage.
+    If stream is true the alignment is not run, and instead a list of
+    align_reads.Bowtie2Stream (or unique_reads.UniqueReadsStream) objects is
+    returned for stage "1_filter" to consume. Otherwise, None is returned.
+  """
   if input_list is None:
     raise Exception('INPUT must be provided for stage "0_align".')
   if ref_seq_file is None:
@@ -238,34 +414,133 @@ def do_0_align(
     'library_names': library_names,
     'ref_seq_file': ref_seq_file,
     'bowtie2_args': bowtie2_args,
+    'aligner': aligner,
+    'threads': threads,
+    'bowtie2_cache': bowtie2_cache,
+    'collapse': collapse,
+    'stream': stream,
+    'stream_sam': stream_sam,
+    'align_cache_file': align_cache_file,
+    'align_cache_size': align_cache_size,
+    'prefilter_args': prefilter_args,
+    'exact_ref': exact_ref,
   }
-  bowtie2_args = ' '.join(bowtie2_args)
-  bowtie2_index_file = file_names.bowtie2_index(output)
-  # Existing Bowtie 2 index files must be overwritten.
-  # For some reason, Bowtie 2 does not overwrite the index file if it already exists.
-  file_utils.make_parent_dir(bowtie2_index_file, overwrite=True)
-  log_utils.log_output('Bowtie2 index file: ' + bowtie2_index_file)
-  if os.system(f'bowtie2-build-s {ref_seq_file} {bowtie2_index_file} --quiet') != 0:
-    raise Exception('Bowtie 2 build failed.')
-
-  for i in range(len(input_list)):
-    sam_file = file_names.sam_file(output, library_names[i])
-    file_utils.make_parent_dir(sam_file)
-    input_ext = os.path.splitext(input_list[i])[1]
-    if input_ext in ['.fastq', '.fq']:
-      flags = '-q'
-    elif input_ext in ['.fasta', '.fa', '.fna']:
-      flags = '-f'
+  if stream and stream_sam:
+    tee_list = [file_names.sam_gz_file(output, x) for x in library_names]
+  else:
+    tee_list = None
+  if collapse:
+    collapsed_list = [file_names.collapsed_reads(output, x) for x in library_names]
+  else:
+    collapsed_list = None
+  sam_list = [file_names.sam_file(output, x) for x in library_names]
+
+  if (
+    (aligner == 'builtin') or
+    (align_cache_file is not None) or
+    (prefilter_args is not None) or
+    exact_ref
+  ):
+    # Align the unique reads of each library
+    ref_seq = file_utils.read_seq(ref_seq_file)
+    if prefilter_args is not None:
+      read_prefilter = prefilter.Prefilter(ref_seq=ref_seq, **prefilter_args)
+    else:
+      read_prefilter = None
+    if exact_ref:
+      exact_matcher = exact_match.ExactMatcher(ref_seq)
+    else:
+      exact_matcher = None
+    if aligner == 'builtin':
+      align_func = functools.partial(
+        builtin_align.align_unique_reads,
+        ref_seq,
+        threads = threads,
+      )
+      aligner_args = []
+    else:
+      bowtie2_index_file = align_reads.build_bowtie2_index(
+        ref_seq_file = ref_seq_file,
+        output = output,
+        bowtie2_cache = bowtie2_cache,
+      )
+      align_func = functools.partial(
+        align_reads.align_unique_reads,
+        bowtie2_index_file = bowtie2_index_file,
+        bowtie2_args = bowtie2_args,
+        threads = threads,
+      )
+      aligner_args = align_reads.remove_threads_args(
+        align_reads.split_bowtie2_args(bowtie2_args)
+      )
+    if align_cache_file is not None:
+      cache = align_cache.AlignmentCache(
+        align_cache_file,
+        align_cache.get_namespace(ref_seq, aligner, aligner_args),
+        align_cache_size,
+      )
     else:
-      flags = '-r'
-    bowtie2_command = (
-      f'bowtie2-align-s --no-hd {flags} {bowtie2_args}' +
-      f' -x {bowtie2_index_file} {input_list[i]} -S {sam_file} --quiet'
+      cache = None
+    if stream:
+      streams = unique_reads.stream_libraries(
+        input_list = input_list,
+        ref_seq_file = ref_seq_file,
+        align_func = align_func,
+        cache = cache,
+        collapse = collapse,
+        collapsed_list = collapsed_list,
+        tee_list = tee_list,
+        prefilter = read_prefilter,
+        exact_matcher = exact_matcher,
+      )
+      write_args(args, output, 'align')
+      return streams
+    unique_reads.align_libraries(
+      input_list = input_list,
+      sam_list = sam_list,
+      ref_seq_file = ref_seq_file,
+      align_func = align_func,
+      cache = cache,
+      collapse = collapse,
+      collapsed_list = collapsed_list,
+      prefilter = read_prefilter,
+      exact_matcher = exact_matcher,
+    )
+    if cache is not None:
+      cache.close()
+    write_args(args, output, 'align')
+    return None
+
+  bowtie2_index_file = align_reads.build_bowtie2_index(
+    ref_seq_file = ref_seq_file,
+    output = output,
+    bowtie2_cache = bowtie2_cache,
+  )
+
+  if stream:
+    streams = align_reads.stream_libraries(
+      input_list = input_list,
+      bowtie2_index_file = bowtie2_index_file,
+      bowtie2_args = bowtie2_args,
+      threads = threads,
+      collapsed_list = collapsed_list,
+      tee_list = tee_list,
     )
-    log_utils.log('Bowtie 2 command: ' + bowtie2_command)
-    if os.system(bowtie2_command) != 0:
-      raise Exception('Bowtie 2 alignment failed.')
+    write_args(args, output, 'align')
+    return streams
+
+  for sam_file in sam_list:
+    file_utils.make_parent_dir(sam_file)
+  align_reads.align_libraries(
+    input_list = input_list,
+    sam_list = sam_list,
+    bowtie2_index_file = bowtie2_index_file,
+    bowtie2_args = bowtie2_args,
+    threads = threads,
+    collapsed_list = collapsed_list,
+  )
   write_args(args, output, 'align')
+  return None
 
 def do_1_filter(
   output,
@@ -280,7 +555,22 @@ def do_1_filter(
   dsb_touch,
   realign,
   quiet,
+  collapsed,
+  workers,
+  partitions,
+  incremental = False,
+  sweep = None,
+  input_streams = None,
 ):
+  """
+    Run the filter stage.
+    If input_streams is not None, the reads are filtered from these streams
+    (see do_0_align()) instead of the SAM files in the output directory.
+    If incremental is true, the libraries are added to the output of the previous run.
+    If sweep is not None, the reads are also filtered with each combination
+    of the settings in sweep (see filter_sweep.parse_sweep()) and the output
+    of each combination is written to its subdirectory (see file_names.sweep()).
+  """
   if ref_seq_file is None:
     raise Exception('REF must be provided for stage "1_filter".')
   if dsb_pos is None:
@@ -288,13 +578,57 @@ def do_1_filter(
   if min_length is None:
     raise Exception('MIN_LEN must be provided for stage "1_filter".')
 
+  if sweep is not None:
+    if incremental:
+      raise Exception('SWEEP cannot be used with "--incremental 1".')
+    if partitions > 1:
+      raise Exception('SWEEP cannot be used with PARTITIONS > 1.')
+
+  prev_args = None
+  if incremental:
+    if not os.path.exists(file_names.args_file(output, 'filter')):
+      raise Exception('No previous output of stage "1_filter" to add to with "--incremental 1".')
+    prev_args = read_args(output, 'filter')
+    check_incremental_args(
+      prev_args,
+      dsb_pos = dsb_pos,
+      min_length = min_length,
+      max_subst = max_subst,
+      reverse_complement = reverse_complement,
+      consecutive = consecutive,
+      dsb_touch = dsb_touch,
+      realign = realign,
+    )
+    if file_utils.read_seq(ref_seq_file) != file_utils.read_seq(prev_args['ref_seq_file']):
+      raise Exception(
+        'The reference sequence of stage "1_filter" must be the same as in the' +
+        ' previous run with "--incremental 1".'
+      )
+
   if library_names is None:
-    # Infer names from the SAM files.
-    library_names = sorted([
+    # Infer names from the SAM/BAM files.
+    library_names = sorted(set(
       file_names.get_file_name(x)
-      for x in sorted(glob.glob(os.path.join(output, '*.sam')))
-    ])
-  input_list = [file_names.sam_file(output, x) for x in library_names]
+      for x in glob.glob(os.path.join(output, '*.[sb]am*'))
+      if file_utils.get_ext(x) in ['sam', 'bam']
+    ))
+    if prev_args is not None:
+      library_names = [x for x in library_names if x not in prev_args['library_names']]
+  if prev_args is not None:
+    if len(library_names) == 0:
+      raise Exception('No new libraries to add with "--incremental 1".')
+    for x in library_names:
+      if x in prev_args['library_names']:
+        raise Exception(f'Library "{x}" is already in the previous output of stage "1_filter".')
+  input_list = [file_names.find_sam_file(output, x) for x in library_names]
+
+  if (total_reads is not None) and os.path.exists(file_names.args_file(output, 'sample')):
+    # Preview run: the frequencies are relative to the sampled part of the total reads
+    total_reads = sample_reads.scale_total_reads(
+      total_reads,
+      library_names,
+      read_args(output, 'sample'),
+    )
 
   args = {
     'input_list': input_list,
@@ -314,9 +648,55 @@ def do_1_filter(
     'dsb_touch': dsb_touch,
     'realign': realign,
     'quiet': quiet,
+    'collapsed': collapsed,
+    'workers': workers,
+    'partitions': partitions,
   }
 
-  filter_reads.main(**args)
+  main_args = args.copy()
+  if input_streams is not None:
+    args['input_list'] = [str(x) for x in input_streams]
+    main_args['input_list'] = input_streams
+  if prev_args is not None:
+    main_args['prev_library_names'] = prev_args['library_names']
+    main_args['prev_total_reads'] = prev_args['total_reads']
+    # The args of the combined output
+    args['input_list'] = prev_args['input_list'] + args['input_list']
+    args['library_names'] = prev_args['library_names'] + library_names
+    if (prev_args['total_reads'] is not None) or (total_reads is not None):
+      args['total_reads'] = (
+        (prev_args['total_reads'] or [None] * len(prev_args['library_names'])) +
+        (total_reads or [None] * len(library_names))
+      )
+  if sweep is None:
+    main_args['metrics_file'] = file_names.filter_metrics(output)
+    filter_reads.main(**main_args)
+  else:
+    sweep_dirs = []
+    sweep_list = []
+    for name, settings in filter_sweep.get_sweep_settings(
+      sweep,
+      dsb_pos = dsb_pos,
+      min_length = min_length,
+      max_subst = max_subst,
+      consecutive = consecutive,
+      dsb_touch = dsb_touch,
+      realign = realign,
+    ):
+      sweep_dir = file_names.sweep(output, name)
+      sweep_dirs.append(sweep_dir)
+      sweep_list.append({
+        'output': [
+          file_names.filter(sweep_dir, 'accepted'),
+          file_names.filter(sweep_dir, 'rejected'),
+        ],
+        'debug_file': file_names.filter(sweep_dir, 'debug'),
+        **settings,
+      })
+    del main_args['partitions']
+    filter_sweep.main(sweep_list=sweep_list, **main_args)
+    for sweep_dir, sweep_args in zip(sweep_dirs, sweep_list):
+      write_args({**args, **sweep_args}, sweep_dir, 'filter')
   write_args(args, output, 'filter')
 
 def do_2_window(
@@ -406,6 +786,19 @@ def main(
   input_list,
   ref_seq_file,
   bowtie2_args,
+  aligner,
+  threads,
+  bowtie2_cache,
+  collapse,
+  stream,
+  stream_sam,
+  align_cache_file,
+  align_cache_size,
+  prefilter,
+  exact_ref,
+  sample,
+  fraction,
+  seed,
 
   library_names,
   total_reads,
@@ -416,6 +809,10 @@ def main(
   consecutive,
   dsb_touch,
   realign,
+  workers,
+  partitions,
+  incremental,
+  sweep,
   quiet,
 
   window_size,
@@ -431,19 +828,42 @@ def main(
 
   log_utils.blank_line()
 
-  # Check if any of the inputs are SAM files and if so, copy them to output
-  if (input_list is not None) and any((os.path.splitext(x)[1] == '.sam') for x in input_list):
-    log_utils.log('Got SAM input. Skipping alignment.')
-    if not all((os.path.splitext(x)[1] == '.sam') for x in input_list):
-      raise Exception('All of or none of the input files must be SAM files (".sam" extension).')
-    for i in range(len(input_list)):
-      file_in = input_list[i]
-      if library_names is not None:
-        file_out = file_names.sam_file(output, library_names[i])
-      else:
-        file_out = file_names.sam_file(output, file_names.get_file_name(file_in))
-      shutil.copy(file_in, file_out)
-      log_utils.log_output(file_in)
+  input_streams = None
+  if stream and ('0_align' in stages) and ('1_filter' not in stages):
+    raise Exception('Stages "0_align" and "1_filter" must be run together with "--stream 1".')
+
+  sampling = (sample is not None) or (fraction is not None)
+  if sampling and (input_list is None):
+    raise Exception('INPUT must be provided with "--sample" or "--fraction".')
+  if (input_list is not None) and (not sampling):
+    # The reads of a previous preview run are replaced
+    if os.path.exists(file_names.args_file(output, 'sample')):
+      os.remove(file_names.args_file(output, 'sample'))
+
+  # Check if any of the inputs are SAM/BAM files and if so, copy them to output
+  if (input_list is not None) and any((file_utils.get_ext(x) in ['sam', 'bam']) for x in input_list):
+    log_utils.log('Got SAM/BAM input. Skipping alignment.')
+    if not all((file_utils.get_ext(x) in ['sam', 'bam']) for x in input_list):
+      raise Exception('All of or none of the input files must be SAM/BAM files (".sam" or ".bam" extension).')
+    if sampling:
+      # The samples are written as the SAM files of the libraries
+      do_sample(output, input_list, library_names, sample, fraction, seed)
+    else:
+      for i in range(len(input_list)):
+        file_in = input_list[i]
+        if library_names is not None:
+          name = library_names[i]
+        else:
+          name = file_names.get_file_name(file_in)
+        if file_utils.get_ext(file_in) == 'bam':
+          file_out = file_names.bam_file(output, name)
+        else:
+          file_out = file_names.sam_file(output, name)
+        # Keep the compression of the input (e.g., ".sam.gz")
+        if file_utils.get_compression(file_in) is not None:
+          file_out += '.' + file_utils.get_compression(file_in)
+        shutil.copy(file_in, file_out)
+        log_utils.log_output(file_in)
     stages = [x for x in stages if (x != '0_align')]
     prev_args = {
       'output': output,
@@ -456,24 +876,57 @@ def main(
 
   if '0_align' in stages:
     log_utils.log('Running processing stage "0_align".')
+    if sampling:
+      input_list = do_sample(output, input_list, library_names, sample, fraction, seed)
     prev_args = {
       'output': output,
       'input_list': input_list,
       'library_names': library_names,
       'ref_seq_file': ref_seq_file,
       'bowtie2_args': bowtie2_args,
+      'aligner': aligner,
+      'threads': threads,
+      'bowtie2_cache': bowtie2_cache,
+      'collapse': collapse,
+      'stream': stream,
+      'stream_sam': stream_sam,
+      'align_cache_file': align_cache_file,
+      'align_cache_size': align_cache_size,
+      'prefilter_args': None,
+      'exact_ref': exact_ref,
     }
-    do_0_align(**prev_args)
+    if prefilter:
+      if dsb_pos is None:
+        raise Exception('DSB must be provided for stage "0_align" with "--prefilter 1".')
+      prev_args['prefilter_args'] = {
+        'dsb_pos': dsb_pos,
+        'min_length': min_length,
+        'reverse_complement': reverse_complement,
+        'window_size': window_size,
+        'anchor_size': anchor_size,
+        'anchor_substs': anchor_substs,
+        'anchor_indels': anchor_indels,
+      }
+    input_streams = do_0_align(**prev_args)
     log_utils.blank_line()
 
   if '1_filter' in stages:
     log_utils.log('Running processing stage "1_filter".')
+    collapsed = False
     if os.path.exists(file_names.args_file(output, 'align')):
       prev_args = read_args(output, 'align')
       if ref_seq_file is None:
         ref_seq_file = prev_args.get('ref_seq_file')
       if library_names is None:
         library_names = prev_args.get('library_names')
+      collapsed = bool(prev_args.get('collapse', 0))
+    check_prefilter_args(
+      output,
+      '1_filter',
+      dsb_pos = dsb_pos,
+      min_length = min_length,
+      reverse_complement = reverse_complement,
+    )
 
     do_1_filter(
       output = output,
@@ -488,6 +941,12 @@ def main(
       dsb_touch = dsb_touch,
       realign = realign,
       quiet = quiet,
+      collapsed = collapsed,
+      workers = workers,
+      partitions = partitions,
+      incremental = incremental,
+      sweep = sweep,
+      input_streams = input_streams,
     )
     log_utils.blank_line()
 
@@ -498,6 +957,15 @@ def main(
       ref_seq_file = prev_args.get('ref_seq_file')
     if dsb_pos is None:
       dsb_pos = prev_args.get('dsb_pos')
+    check_prefilter_args(
+      output,
+      '2_window',
+      dsb_pos = dsb_pos,
+      window_size = window_size,
+      anchor_size = anchor_size,
+      anchor_substs = anchor_substs,
+      anchor_indels = anchor_indels,
+    )
     do_2_window(
       output = output,
       ref_seq_file = ref_seq_file,
@@ -1,5 +1,14 @@
+import numpy as np
+
 import DSBplot.utils.cigar_utils as cigar_utils
 
+# The batch functions below process many alignments at once.
+# A batch of strings is stored as a uint8 array of their concatenated
+# characters and an array of the len(strings) + 1 offsets of the strings
+# in it (see join_seqs()).
+GAP = ord('-')
+VAR_TYPES = ['sub', 'ins', 'del'] # see get_variation_info_batch()
+
 def get_alignment(ref_seq, read_seq, ref_pos, cigar):
   """
     Get the alignment represented by the CIGAR string in "alignment matrix" format.
@@ -197,4 +206,170 @@ def get_insertion_str(ref_align: str, read_align:str):
   return ''.join(read_align[i] for i in range(len(ref_align)) if ref_align[i] == '-')
 
 def get_first_deletion_pos(align_str: str):
-  return 1 + align_str.index('-')
\ No newline at end of file
+  return 1 + align_str.index('-')
+
+def get_offsets(lengths):
+  """
+    Get the offsets of a batch of strings from their lengths.
+    Also used to get the cumulative sums of an array with a leading 0.
+  """
+  offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+  np.cumsum(lengths, out=offsets[1:])
+  return offsets
+
+def join_seqs(seqs):
+  """
+    Concatenate a batch of strings into a uint8 array.
+
+    Returns
+    -------
+    A tuple (array, offsets) : the characters of all the strings and the offsets
+    of the strings. String i is array[offsets[i] : offsets[i + 1]].
+  """
+  offsets = get_offsets(np.fromiter(map(len, seqs), dtype=np.int64, count=len(seqs)))
+  return np.frombuffer(''.join(seqs).encode('ascii'), dtype=np.uint8), offsets
+
+def split_seqs(array, offsets):
+  """
+    Inverse of join_seqs().
+  """
+  seqs = array.tobytes().decode('ascii')
+  offsets = offsets.tolist()
+  return [seqs[offsets[i] : offsets[i + 1]] for i in range(len(offsets) - 1)]
+
+def get_batch_sum(values, offsets):
+  """
+    Get the sum of the values of each string of a batch.
+  """
+  return np.diff(get_offsets(values)[offsets])
+
+def get_batch_cumsum(values, offsets):
+  """
+    Get the cumulative sum of the values before each position of each string of a batch.
+  """
+  total = get_offsets(values)
+  return total[:-1] - np.repeat(total[offsets[:-1]], np.diff(offsets))
+
+def get_alignment_batch(ref_seq, read_seqs, cigars):
+  """
+    Batch version of get_alignment() for alignments starting at position 1
+    of the reference.
+
+    Parameters
+    ----------
+    ref_seq   : the reference nucleotide sequence.
+    read_seqs : list of the read nucleotide sequences.
+    cigars    : list of the CIGAR strings of the reads.
+
+    Returns
+    -------
+    A tuple (ref_align, read_align, offsets), with the ref and read alignment
+    strings of the batch as arrays (see join_seqs()).
+  """
+  ops, op_counts, num_ops = cigar_utils.parse_cigars(cigars)
+  offsets = get_offsets(op_counts)[get_offsets(num_ops)]
+  align_lengths = np.diff(offsets)
+
+  align_ops = np.repeat(ops, op_counts)
+  ref_used = align_ops != cigar_utils.CIGAR_OPS.index('I')
+  read_used = align_ops != cigar_utils.CIGAR_OPS.index('D')
+  ref_index = get_batch_cumsum(ref_used, offsets)[ref_used]
+  read_index = get_batch_cumsum(read_used, offsets)[read_used]
+
+  ref_array = np.frombuffer(ref_seq.encode('ascii'), dtype=np.uint8)
+  read_array, read_offsets = join_seqs(read_seqs)
+  read_lengths = np.repeat(np.diff(read_offsets), align_lengths)[read_used]
+  if (ref_index >= len(ref_array)).any():
+    raise Exception('CIGAR is longer than the reference sequence')
+  if (read_index >= read_lengths).any():
+    raise Exception('CIGAR is longer than the read sequence')
+
+  ref_align = np.full(len(align_ops), GAP, dtype=np.uint8)
+  ref_align[ref_used] = ref_array[ref_index]
+  read_align = np.full(len(align_ops), GAP, dtype=np.uint8)
+  read_align[read_used] = read_array[np.repeat(read_offsets[:-1], align_lengths)[read_used] + read_index]
+  return ref_align, read_align, offsets
+
+def join_alignments(ref_aligns, read_aligns):
+  """
+    Join a batch of ref and read alignment strings with join_seqs().
+
+    Returns
+    -------
+    A tuple (ref_align, read_align, offsets) as returned by get_alignment_batch().
+  """
+  ref_align, offsets = join_seqs(ref_aligns)
+  read_align, read_offsets = join_seqs(read_aligns)
+  if not np.array_equal(offsets, read_offsets):
+    raise Exception("Alignment strings must be the same length")
+  return ref_align, read_align, offsets
+
+def get_variation_masks(ref_align, read_align):
+  """
+    Get the boolean arrays of the insertion, deletion, and substitution
+    positions of a batch of alignments (see count_variations()).
+  """
+  if len(ref_align) != len(read_align):
+    raise Exception("Alignment strings must be the same length")
+  diff = ref_align != read_align
+  ins = diff & (ref_align == GAP)
+  dels = diff & (read_align == GAP)
+  sub = diff & ~ins & ~dels
+  return ins, dels, sub
+
+def count_variations_batch(ref_align, read_align, offsets):
+  """
+    Batch version of count_variations().
+
+    Returns
+    -------
+    A tuple (num_ins, num_del, num_subst) of arrays with the counts of each alignment.
+  """
+  ins, dels, sub = get_variation_masks(ref_align, read_align)
+  return (
+    get_batch_sum(ins, offsets),
+    get_batch_sum(dels, offsets),
+    get_batch_sum(sub, offsets),
+  )
+
+def get_var_pos_batch(ref_align, read_align, offsets):
+  """
+    Batch version of get_var_pos().
+
+    Returns
+    -------
+    A tuple (ins_pos, del_pos, sub_pos) of lists with the list of
+    positions of each alignment.
+  """
+  ref_pos = get_batch_cumsum(ref_align != GAP, offsets) + 1
+  var_pos = []
+  for mask, shift in zip(get_variation_masks(ref_align, read_align), [-1, 0, 0]):
+    pos = (ref_pos[mask] + shift).tolist()
+    pos_offsets = get_offsets(mask)[offsets].tolist()
+    var_pos.append([pos[pos_offsets[i] : pos_offsets[i + 1]] for i in range(len(offsets) - 1)])
+  return tuple(var_pos)
+
+def get_variation_info_batch(ref_align, read_align, offsets):
+  """
+    Batch version of get_variation_info().
+
+    Returns
+    -------
+    A tuple (index, var_pos, var_type, var_letter) of arrays with an element
+    for each variation of all the alignments, in order. index is the index of
+    the alignment of the variation in the batch and the rest is as in
+    get_variation_info().
+  """
+  ref_pos = get_batch_cumsum(ref_align != GAP, offsets) + 1
+  ins, dels, sub = get_variation_masks(ref_align, read_align)
+  var = np.flatnonzero(ins | dels | sub)
+  var_code = np.full(len(var), VAR_TYPES.index('sub'))
+  var_code[ins[var]] = VAR_TYPES.index('ins')
+  var_code[dels[var]] = VAR_TYPES.index('del')
+  var_letter = np.stack([ref_align[var], read_align[var]], axis=1).view('S2').ravel().astype(str)
+  return (
+    np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))[var],
+    ref_pos[var] - ins[var],
+    np.array(VAR_TYPES)[var_code],
+    var_letter,
+  )
@@ -0,0 +1,259 @@
+import os
+import zlib
+import struct
+import concurrent.futures
+
+BAM_MAGIC = b'BAM\x01'
+BGZF_HEADER_SIZE = 12 # Fixed part of the gzip header of a BGZF block
+BGZF_BATCH_SIZE = 64 # Number of BGZF blocks decompressed together
+BGZF_THREADS = min(4, os.cpu_count() or 1) # Threads for decompressing BGZF blocks
+
+CIGAR_OPS = 'MIDNSHP=X'
+SEQ_NUCLEOTIDES = '=ACMGRSVTWYHKDBN'
+# Maps each byte of the packed 4-bit SEQ field to its two nucleotides
+SEQ_PAIRS = [
+  SEQ_NUCLEOTIDES[x >> 4] + SEQ_NUCLEOTIDES[x & 0xF]
+  for x in range(256)
+]
+QUAL_TABLE = bytes((x + 33) & 0xFF for x in range(256)) # Phred to ASCII
+
+# Struct formats of the fixed-size auxiliary field types
+AUX_FORMATS = {
+  'c': '<b',
+  'C': '<B',
+  's': '<h',
+  'S': '<H',
+  'i': '<i',
+  'I': '<I',
+  'f': '<f',
+}
+
+def read_bgzf_block(input, file):
+  """
+    Read the compressed data of the next BGZF block.
+
+    Returns
+    -------
+    The raw deflate data of the block or None at the end of the file.
+  """
+  header = input.read(BGZF_HEADER_SIZE)
+  if len(header) == 0:
+    return None
+  if (len(header) < BGZF_HEADER_SIZE) or (header[:4] != b'\x1f\x8b\x08\x04'):
+    raise Exception(f'Invalid BGZF block in BAM file {file}.')
+  xlen = struct.unpack('<H', header[10:12])[0]
+  extra = input.read(xlen)
+  block_size = None
+  i = 0
+  while i + 4 <= len(extra):
+    subfield_len = struct.unpack('<H', extra[i + 2 : i + 4])[0]
+    if extra[i : i + 2] == b'BC':
+      block_size = struct.unpack('<H', extra[i + 4 : i + 6])[0] + 1
+    i += 4 + subfield_len
+  if block_size is None:
+    raise Exception(f'Missing BGZF block size in BAM file {file}.')
+  data = input.read(block_size - BGZF_HEADER_SIZE - xlen)
+  if len(data) != (block_size - BGZF_HEADER_SIZE - xlen):
+    raise Exception(f'Truncated BGZF block in BAM file {file}.')
+  return data[:-8] # Remove CRC32 and ISIZE
+
+def inflate_block(data):
+  return zlib.decompress(data, -15)
+
+def iter_bgzf_data(input, file, threads=BGZF_THREADS):
+  """
+    Iterate over the decompressed data of the BGZF blocks of a file.
+    Batches of blocks are decompressed in parallel (zlib releases the GIL),
+    but the data is yielded in file order.
+
+    Parameters
+    ----------
+    input   : the file opened in binary mode.
+    file    : the file name (for error messages).
+    threads : number of threads used to decompress the blocks.
+  """
+  with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, threads)) as executor:
+    done = False
+    while not done:
+      batch = []
+      while len(batch) < BGZF_BATCH_SIZE:
+        block = read_bgzf_block(input, file)
+        if block is None:
+          done = True
+          break
+        batch.append(block)
+      for data in executor.map(inflate_block, batch):
+        yield data
+
+class BgzfBuffer:
+  """
+    Buffer over the decompressed BGZF data for reading fixed-size chunks
+    that may span multiple blocks.
+  """
+  def __init__(self, data_iter):
+    self.data_iter = data_iter
+    self.buffer = bytearray()
+    self.offset = 0
+
+  def read(self, size):
+    while len(self.buffer) - self.offset < size:
+      data = next(self.data_iter, None)
+      if data is None:
+        break
+      if self.offset > 0:
+        del self.buffer[:self.offset]
+        self.offset = 0
+      self.buffer += data
+    chunk = bytes(self.buffer[self.offset : self.offset + size])
+    self.offset += len(chunk)
+    return chunk
+
+def parse_aux_fields(data):
+  """
+    Parse the auxiliary (optional) fields of a BAM record into the
+    SAM text form "TAG:TYPE:VALUE".
+  """
+  fields = []
+  i = 0
+  while i < len(data):
+    tag = data[i : i + 2].decode('ascii')
+    value_type = chr(data[i + 2])
+    i += 3
+    if value_type == 'A':
+      fields.append(f'{tag}:A:{chr(data[i])}')
+      i += 1
+    elif value_type in AUX_FORMATS:
+      value_format = AUX_FORMATS[value_type]
+      value = struct.unpack_from(value_format, data, i)[0]
+      i += struct.calcsize(value_format)
+      fields.append(f'{tag}:{"f" if value_type == "f" else "i"}:{value}')
+    elif value_type in 'ZH':
+      end = data.index(b'\x00', i)
+      fields.append(f'{tag}:{value_type}:{data[i:end].decode("ascii")}')
+      i = end + 1
+    elif value_type == 'B':
+      sub_type = chr(data[i])
+      count = struct.unpack_from('<i', data, i + 1)[0]
+      i += 5
+      value_format = '<' + str(count) + AUX_FORMATS[sub_type][1]
+      values = struct.unpack_from(value_format, data, i)
+      i += struct.calcsize(value_format)
+      fields.append(f'{tag}:B:{sub_type}' + ''.join(',' + str(x) for x in values))
+    else:
+      raise Exception('Unknown BAM auxiliary field type: ' + value_type)
+  return fields
+
+def parse_record(data, ref_names):
+  """
+    Convert a BAM alignment record (without the leading block_size) into
+    the tab-separated fields of the equivalent SAM line.
+  """
+  (
+    ref_id, pos, l_read_name, mapq, _, n_cigar_op,
+    flag, l_seq, next_ref_id, next_pos, tlen,
+  ) = struct.unpack_from('<iiBBHHHiiii', data, 0)
+  i = 32
+  qname = data[i : i + l_read_name - 1].decode('ascii')
+  i += l_read_name
+  cigar_ops = struct.unpack_from('<' + str(n_cigar_op) + 'I', data, i)
+  i += 4 * n_cigar_op
+  cigar = ''.join(str(x >> 4) + CIGAR_OPS[x & 0xF] for x in cigar_ops)
+  seq_bytes = data[i : i + (l_seq + 1) // 2]
+  i += (l_seq + 1) // 2
+  seq = ''.join([SEQ_PAIRS[x] for x in seq_bytes])[:l_seq]
+  qual_bytes = data[i : i + l_seq]
+  i += l_seq
+  if (l_seq == 0) or (qual_bytes[0] == 0xFF):
+    qual = '*'
+  else:
+    qual = qual_bytes.translate(QUAL_TABLE).decode('ascii')
+  if next_ref_id < 0:
+    rnext = '*'
+  elif next_ref_id == ref_id:
+    rnext = '='
+  else:
+    rnext = ref_names[next_ref_id]
+  return [
+    qname,
+    str(flag),
+    ref_names[ref_id] if ref_id >= 0 else '*',
+    str(pos + 1),
+    str(mapq),
+    cigar if cigar != '' else '*',
+    rnext,
+    str(next_pos + 1),
+    str(tlen),
+    seq if seq != '' else '*',
+    qual,
+  ] + parse_aux_fields(data[i:])
+
+def iter_sam_lines(input, file, threads=BGZF_THREADS, binary=False):
+  """
+    Iterate over the lines of the SAM file equivalent to a BAM file.
+    The header lines are yielded first, followed by one line for each
+    alignment record. Each line ends with a newline.
+
+    Parameters
+    ----------
+    input   : the BAM file opened in binary mode.
+    file    : the BAM file name (for error messages).
+    threads : number of threads used to decompress the BGZF blocks.
+    binary  : if true, the lines are yielded as bytes.
+
+    Notes
+    -----
+    BAM file format : https://samtools.github.io/hts-specs/SAMv1.pdf (section 4)
+  """
+  input = BgzfBuffer(iter_bgzf_data(input, file, threads))
+  if input.read(4) != BAM_MAGIC:
+    raise Exception(f'Not a BAM file: {file}')
+  l_text = struct.unpack('<i', input.read(4))[0]
+  text = input.read(l_text).rstrip(b'\x00').decode('ascii')
+  for line in text.splitlines():
+    if line != '':
+      yield (line + '\n').encode() if binary else (line + '\n')
+  n_ref = struct.unpack('<i', input.read(4))[0]
+  ref_names = []
+  for _ in range(n_ref):
+    l_name = struct.unpack('<i', input.read(4))[0]
+    ref_names.append(input.read(l_name)[:-1].decode('ascii'))
+    input.read(4) # l_ref
+  while True:
+    block_size = input.read(4)
+    if len(block_size) == 0:
+      break
+    block_size = struct.unpack('<i', block_size)[0]
+    data = input.read(block_size)
+    if len(data) != block_size:
+      raise Exception(f'Truncated record in BAM file {file}.')
+    line = '\t'.join(parse_record(data, ref_names)) + '\n'
+    yield line.encode() if binary else line
+
+class BamReader:
+  """
+    Context manager for iterating over the SAM lines of a BAM file
+    (see iter_sam_lines()). The number of compressed bytes read so far
+    can be obtained with offset().
+  """
+  def __init__(self, file, threads=BGZF_THREADS, binary=False):
+    self.file = file
+    self.threads = threads
+    self.binary = binary
+    self.input = None
+    self.lines = None
+
+  def __iter__(self):
+    return self.lines
+
+  def offset(self):
+    return self.input.tell()
+
+  def __enter__(self):
+    self.input = open(self.file, 'rb')
+    self.lines = iter_sam_lines(self.input, self.file, self.threads, self.binary)
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.lines.close()
+    self.input.close()
+    return False
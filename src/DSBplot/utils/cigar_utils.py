@@ -1,3 +1,10 @@
+import re
+import numpy as np
+
+CIGAR_OPS = 'MID' # CIGAR operations of Bowtie 2, coded by their index in parse_cigars()
+CIGAR_RE = re.compile(r'(?:[0-9]+[MID])*')
+CIGAR_OP_CODES = str.maketrans({x: chr(i) for i, x in enumerate(CIGAR_OPS)})
+
 def parse_cigar(cigar):
   """
     Parse a CIGAR string into runs of variations.
@@ -38,3 +45,36 @@ def parse_cigar(cigar):
     else:
       raise Exception('Malformed CIGAR: ' + str(cigar))
   return variations
+
+def parse_cigars(cigars):
+  """
+    Parse a batch of CIGAR strings (see parse_cigar()) into arrays.
+
+    Parameters
+    ----------
+    cigars : list of CIGAR strings.
+
+    Returns
+    -------
+    A tuple (ops, counts, num_ops) of arrays :
+      ops     : the code of each operation of all the CIGARs, in order
+        (the index of the operation in CIGAR_OPS).
+      counts  : the count of each operation.
+      num_ops : the number of operations of each CIGAR.
+  """
+  cigar_all = ''.join(cigars)
+  if CIGAR_RE.fullmatch(cigar_all) is None:
+    for cigar in cigars:
+      parse_cigar(cigar) # raise the exception of the malformed CIGAR
+  num_ops = np.fromiter(
+    (x.count('M') + x.count('I') + x.count('D') for x in cigars),
+    dtype = np.int64,
+    count = len(cigars),
+  )
+  # Each CIGAR ends with an operation so the concatenation splits into the same operations
+  ops = np.frombuffer(
+    re.sub('[0-9]+', '', cigar_all).translate(CIGAR_OP_CODES).encode('ascii'),
+    dtype = np.uint8,
+  )
+  counts = np.array(re.split('[MID]', cigar_all)[:-1], dtype=np.int64)
+  return ops, counts, num_ops
@@ -2,6 +2,7 @@ import numpy as np
 
 FASTA_EXT = ['fasta', 'fa', 'fna']
 FASTQ_EXT = ['fastq', 'fq']
+COMPRESSION_EXT = ['gz', 'bgz', 'bz2', 'zst']
 
 SUBST_TYPES = ['withoutSubst', 'withSubst'] # Must keep in this order!
 
@@ -13,6 +13,27 @@ def args_file(dir, prefix):
 def sam_file(dir, name):
   return make_file_name(dir, name, ext='sam')
 
+def bam_file(dir, name):
+  return make_file_name(dir, name, ext='bam')
+
+def find_sam_file(dir, name):
+  """
+    Get the SAM file of the library in the directory, which may be
+    compressed (e.g., "<name>.sam.gz") or a BAM file ("<name>.bam").
+    If no such file exists, the name of the uncompressed SAM file is returned.
+  """
+  for ext in ['sam'] + ['sam.' + x for x in constants.COMPRESSION_EXT] + ['bam']:
+    file = make_file_name(dir, name, ext=ext)
+    if os.path.exists(file):
+      return file
+  return sam_file(dir, name)
+
+def sam_gz_file(dir, name):
+  return make_file_name(dir, name, ext='sam.gz')
+
+def collapsed_reads(dir, name):
+  return os.path.join(dir, 'collapsed', name + '.fq')
+
 def ref_seq_file(dir):
   return os.path.join(dir, 'ref_seq.fasta')
 
@@ -29,8 +50,20 @@ def data_info(dir):
 def bowtie2_index(dir):
   return os.path.join(dir, 'bowtie2', 'index')
 
+def bowtie2_index_cache(cache_dir, key):
+  return os.path.join(cache_dir, key, 'index')
+
 def filter(dir, suffix):
   return os.path.join(dir, 'filter_' + suffix + '.csv')
 
+def filter_metrics(dir):
+  return make_file_name(dir, 'filter', 'metrics', ext='json')
+
+def sample_file(dir, name, ext):
+  return make_file_name(os.path.join(dir, 'sample'), name, ext=ext)
+
+def sweep(dir, name):
+  return os.path.join(dir, 'sweep', name)
+
 def get_file_name(full_path):
   return os.path.basename(full_path).split('.')[0]
\ No newline at end of file
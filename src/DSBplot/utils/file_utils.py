@@ -4,6 +4,10 @@ import os
 import pandas as pd
 import re
 import json
+import io
+import gzip
+import bz2
+import subprocess
 
 import DSBplot.utils.constants as constants
 
@@ -27,6 +31,7 @@ def write_csv(data, file, **args):
       na_rep = 'NA',
       quoting = csv.QUOTE_NONNUMERIC,
       index = args.get('index', False),
+      header = args.get('header', True),
       lineterminator = '\n', # new argument name
     )
   except:
@@ -35,6 +40,7 @@ def write_csv(data, file, **args):
       na_rep = 'NA',
       quoting = csv.QUOTE_NONNUMERIC,
       index = args.get('index', False),
+      header = args.get('header', True),
       line_terminator = '\n', # old argument name
     )
 
@@ -50,10 +56,234 @@ def read_json(file):
   with open(file) as input:
     return json.load(input)
 
-def count_lines(file):
-  """Get the number of lines in the file."""
-  with open(file) as input:
-    return sum(1 for _ in input)
+def get_compression(file):
+  """
+    Get the compression extension of the file (one of constants.COMPRESSION_EXT)
+    or None if the file is not compressed.
+  """
+  ext = os.path.splitext(file)[1].replace('.', '')
+  if ext in constants.COMPRESSION_EXT:
+    return ext
+  return None
+
+def get_ext(file):
+  """
+    Get the extension of the file without the leading ".",
+    ignoring any compression extension (e.g., "reads.fq.gz" -> "fq").
+  """
+  if get_compression(file) is not None:
+    file = os.path.splitext(file)[0]
+  return os.path.splitext(file)[1].replace('.', '')
+
+READ_BUFFER_SIZE = 1 << 20 # Buffer size for reading large files
+
+# Commands for decompressing to the standard output, in order of preference.
+# External commands are used when available so that decompression runs in
+# parallel with parsing (and with multiple threads for pigz).
+DECOMPRESS_COMMANDS = {
+  'gz': [['pigz', '-dc'], ['gzip', '-dc']],
+  'bgz': [['pigz', '-dc'], ['gzip', '-dc']],
+  'bz2': [['pbzip2', '-dc'], ['bzip2', '-dc']],
+  'zst': [['zstd', '-dcq']],
+}
+
+class DecompressReader:
+  """
+    Text reader over the standard output of a decompression command.
+    May be used as a context manager and iterated line by line.
+    If the output is read to the end, closing the reader checks that
+    the command succeeded.
+    The compressed file is opened here and passed as the standard input of
+    the command, so the number of compressed bytes it has consumed can be
+    obtained with offset().
+    If binary is true, the lines are bytes instead of strings.
+  """
+  def __init__(self, command, file, binary=False):
+    self.file = file
+    self.eof = False
+    self.input = open(file, 'rb', buffering=0)
+    self.process = subprocess.Popen(
+      command,
+      stdin = self.input,
+      stdout = subprocess.PIPE,
+      text = not binary,
+      bufsize = READ_BUFFER_SIZE,
+    )
+
+  def __iter__(self):
+    for line in self.process.stdout:
+      yield line
+    self.eof = True
+
+  def readline(self):
+    line = self.process.stdout.readline()
+    if len(line) == 0:
+      self.eof = True
+    return line
+
+  def offset(self):
+    # The command shares the file position of the input
+    return os.lseek(self.input.fileno(), 0, os.SEEK_CUR)
+
+  def close(self):
+    if not self.eof:
+      # Stopped reading early
+      self.process.kill()
+    self.process.stdout.close()
+    return_code = self.process.wait()
+    self.input.close()
+    if self.eof and (return_code != 0):
+      raise Exception(f'Decompression failed: {self.file}')
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    if exc_type is not None:
+      self.eof = False
+    self.close()
+    return False
+
+class CompressedReader:
+  """
+    Text reader over a file decompressed in Python with open_func
+    (e.g., gzip.open). Like DecompressReader, the number of compressed bytes
+    consumed can be obtained with offset().
+    If binary is true, the lines are bytes instead of strings.
+  """
+  def __init__(self, open_func, file, binary=False):
+    self.input = open(file, 'rb')
+    self.text = open_func(self.input, 'rb' if binary else 'rt')
+
+  def __iter__(self):
+    return iter(self.text)
+
+  def readline(self):
+    return self.text.readline()
+
+  def offset(self):
+    return self.input.tell()
+
+  def close(self):
+    self.text.close()
+    self.input.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+    return False
+
+def open_text(file):
+  """
+    Open a text file for reading, transparently decompressing gzip/BGZF
+    (".gz", ".bgz"), bzip2 (".bz2"), and Zstandard (".zst") files.
+    An external decompression command is used if one is available,
+    otherwise the decompression is done in Python. Reading Zstandard files
+    without the "zstd" command requires the optional "zstandard" package.
+    The position in the file can be obtained with get_offset().
+  """
+  return open_lines(file, binary=False)
+
+def open_binary(file):
+  """
+    Same as open_text() but the lines are read as bytes, which avoids
+    decoding them. Uncompressed files are read with a large buffer.
+  """
+  return open_lines(file, binary=True)
+
+def open_lines(file, binary):
+  """
+    Open a possibly compressed file for reading line by line
+    (see open_text() and open_binary()).
+  """
+  compression = get_compression(file)
+  if compression is None:
+    if binary:
+      return open(file, 'rb', buffering=READ_BUFFER_SIZE)
+    return open(file, 'r')
+  for command in DECOMPRESS_COMMANDS[compression]:
+    if shutil.which(command[0]) is not None:
+      return DecompressReader(command, file, binary)
+  if compression in ['gz', 'bgz']:
+    return CompressedReader(gzip.open, file, binary)
+  elif compression == 'bz2':
+    return CompressedReader(bz2.open, file, binary)
+  elif compression == 'zst':
+    try:
+      import zstandard
+    except ImportError:
+      raise Exception(
+        f'Reading {file} requires the "zstd" command or the "zstandard" Python package.'
+      )
+    return CompressedReader(zstandard.open, file, binary)
+  else:
+    raise Exception('Unknown compression: ' + str(compression))
+
+def get_offset(input):
+  """
+    Get the number of bytes of the file (compressed bytes if the file is
+    compressed) read so far by a reader, or None if unknown.
+    The reader may be returned by open_text() or have an offset() method
+    (e.g., bam_utils.BamReader). Since readers read ahead, the offset may be
+    slightly past the last line returned.
+  """
+  if hasattr(input, 'offset'):
+    return input.offset()
+  if isinstance(input, io.TextIOWrapper):
+    return input.buffer.tell()
+  if isinstance(input, io.BufferedReader):
+    return input.tell()
+  return None
+
+def iter_reads(file):
+  """
+    Iterate over the reads in a FASTQ, FASTA, or text file.
+    The format is determined by the file extension in the same way as for
+    the Bowtie 2 alignment: FASTQ (".fastq", ".fq"), FASTA (".fasta", ".fa",
+    ".fna"), and text (all others) with one read sequence per line.
+    The file may be compressed (see open_text()).
+
+    Yields
+    ------
+    Tuples (name, seq, qual) for each read. The name is None for text files
+    and the qual is None for FASTA and text files.
+  """
+  ext = get_ext(file)
+  with open_text(file) as input:
+    if ext in constants.FASTQ_EXT:
+      while True:
+        name = input.readline()
+        if name == '':
+          break
+        seq = input.readline().rstrip()
+        input.readline() # "+" line
+        qual = input.readline().rstrip()
+        if not name.startswith('@'):
+          raise Exception(f'Expected the read header "@" in FASTQ file {file}.')
+        yield name[1:].rstrip(), seq, qual
+    elif ext in constants.FASTA_EXT:
+      name = None
+      seq = None
+      for line in input:
+        line = line.rstrip()
+        if line.startswith('>'):
+          if seq is not None:
+            yield name, seq, None
+          name = line[1:]
+          seq = ''
+        elif line != '':
+          if seq is None:
+            raise Exception(f'Expected the sequence header ">" in FASTA file {file}.')
+          seq += line
+      if seq is not None:
+        yield name, seq, None
+    else:
+      for line in input:
+        line = line.strip()
+        if line != '':
+          yield None, line, None
 
 def copy(file_src, file_dst):
   make_parent_dir(file_dst)
@@ -40,10 +40,13 @@ def get_node_data(data):
   dels = []
   indel = []
 
-  for row in data.to_dict('records'):
-    num_ins, num_del, num_subst = (
-      alignment_utils.count_variations(row['ref_align'], row['read_align'])
-    )
+  ref_align, read_align, offsets = alignment_utils.join_alignments(
+    list(data['ref_align']),
+    list(data['read_align']),
+  )
+  for num_ins, num_del, num_subst in zip(*[
+    x.tolist() for x in alignment_utils.count_variations_batch(ref_align, read_align, offsets)
+  ]):
     if num_ins + num_del + num_subst == 0:
       var = 'none'
     elif num_del + num_subst == 0:
@@ -1,4 +1,6 @@
+import time
 import datetime
+import contextlib
   
 def log(s):
   print(datetime.datetime.now().strftime("%H:%M:%S: ") + str(s))
@@ -10,4 +12,164 @@ def log_output(s):
   log('(output) ' + str(s))
 
 def blank_line():
-  print()
\ No newline at end of file
+  print()
+
+class ProgressLogger:
+  """
+    Log the progress of reading an input line by line.
+    If the total size of the input and a function giving the number of
+    bytes read so far are known, the percentage done and the estimated
+    time remaining are logged as well.
+  """
+  def __init__(self, name, get_offset=None, total_size=None, interval=100000):
+    self.name = name
+    self.get_offset = get_offset
+    self.total_size = total_size
+    self.interval = interval
+    self.start_time = time.time()
+
+  def update(self, line_num):
+    if (line_num % self.interval) != 1:
+      return
+    message = f'Progress: {self.name}: {line_num} lines'
+    offset = None if (self.get_offset is None) else self.get_offset()
+    if (offset is not None) and self.total_size:
+      fraction = min(offset / self.total_size, 1)
+      message += f' ({fraction:.1%}'
+      if fraction > 0:
+        remaining = (time.time() - self.start_time) * (1 - fraction) / fraction
+        message += ', ETA ' + str(datetime.timedelta(seconds=round(remaining)))
+      message += ')'
+    log(message)
+
+class PathTimer:
+  """
+    Accumulate the wall time and CPU time (of this process) spent in named
+    code paths. The paths are nested with start() and stop(): the time spent
+    in a path started inside another is only counted for the inner one.
+    The number of calls of each path and a count of the items processed
+    (e.g., reads) are kept as well.
+    The paths are usually timed with path(), and NULL_PATH_TIMER is used
+    instead of a PathTimer when the times are not needed.
+  """
+  enabled = True
+
+  def __init__(self):
+    self.wall_time = {}
+    self.cpu_time = {}
+    self.calls = {}
+    self.items = {}
+    self.stack = []
+    self.last_wall = None
+    self.last_cpu = None
+
+  def add_path(self, path):
+    if path not in self.calls:
+      self.wall_time[path] = 0.0
+      self.cpu_time[path] = 0.0
+      self.calls[path] = 0
+      self.items[path] = 0
+
+  def charge(self):
+    """
+      Add the time since the last start() or stop() to the innermost path.
+    """
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    if len(self.stack) > 0:
+      path = self.stack[-1]
+      self.wall_time[path] += wall - self.last_wall
+      self.cpu_time[path] += cpu - self.last_cpu
+    self.last_wall = wall
+    self.last_cpu = cpu
+
+  def start(self, path):
+    self.charge()
+    self.add_path(path)
+    self.calls[path] += 1
+    self.stack.append(path)
+
+  def stop(self, items=0):
+    """
+      Stop the innermost path, adding items to its count of items.
+    """
+    self.charge()
+    self.items[self.stack.pop()] += items
+
+  def path(self, path, items=0):
+    """
+      Context manager timing a path with start() and stop(items).
+    """
+    return TimedPath(self, path, items)
+
+  def add_items(self, path, items):
+    self.add_path(path)
+    self.items[path] += items
+
+  def add(self, other):
+    """
+      Add the times and counts of another PathTimer (e.g., from a worker process).
+    """
+    for path in other.calls:
+      self.add_path(path)
+      self.wall_time[path] += other.wall_time[path]
+      self.cpu_time[path] += other.cpu_time[path]
+      self.calls[path] += other.calls[path]
+      self.items[path] += other.items[path]
+
+  def to_dict(self, paths=None):
+    """
+      Get a dictionary mapping each path (those of paths in order, or all of
+      them in order of first use) to a dictionary with its "wall_time" and
+      "cpu_time" in seconds, "calls", and "items".
+    """
+    if paths is None:
+      paths = list(self.calls)
+    return {
+      x: {
+        'wall_time': self.wall_time.get(x, 0.0),
+        'cpu_time': self.cpu_time.get(x, 0.0),
+        'calls': self.calls.get(x, 0),
+        'items': self.items.get(x, 0),
+      }
+      for x in paths
+    }
+
+class TimedPath:
+  """
+    Context manager of PathTimer.path().
+  """
+  def __init__(self, timer, path, items):
+    self.timer = timer
+    self.path = path
+    self.items = items
+
+  def __enter__(self):
+    self.timer.start(self.path)
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.timer.stop(self.items)
+
+class NullPathTimer:
+  """
+    PathTimer that times nothing, for when the times are not needed.
+  """
+  enabled = False
+
+  def path(self, path, items=0):
+    return NULL_PATH
+
+  def add_items(self, path, items):
+    pass
+
+  def add(self, other):
+    pass
+
+NULL_PATH = contextlib.nullcontext()
+NULL_PATH_TIMER = NullPathTimer()
+
+def get_path_timer(enabled):
+  """
+    Get a new PathTimer if enabled is true, or NULL_PATH_TIMER otherwise.
+  """
+  return PathTimer() if enabled else NULL_PATH_TIMER
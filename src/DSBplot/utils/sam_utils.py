@@ -1,6 +1,13 @@
 FLAG_UNALIGNED = 4 # Unaligned/unmapped flag
 FLAG_RC = 16 # Reverse-complement flag
 
+COLLAPSED_QNAME_SEP = ':' # Separates the index and count in QNAMEs of collapsed reads
+# Values of the YF tag (reason a read was filtered out before alignment).
+# "LN" is also used by Bowtie 2 for reads that are too short.
+FILTER_TAG_LENGTH = 'LN' # Too short
+FILTER_TAG_ANCHOR = 'AN' # Missing the anchor k-mers (see prefilter.py)
+COMPLEMENT = str.maketrans('ACGTNacgtn', 'TGCANtgcan')
+
 SAM_MANDATORY_FIELDS = [
   'QNAME',
   'FLAG',
@@ -51,4 +58,86 @@ def parse_sam_fields(fields):
     if len(field) != 3:
       raise Exception('Incorrect number of subfields: ' + str(field))
     optional[field[0]] = {'TYPE': field[1], 'VALUE': field[2]}
-  return mandatory, optional
\ No newline at end of file
+  return mandatory, optional
+
+def get_tag_value(tags, prefix):
+  """
+  Get the value of an optional field from the tab-separated optional fields
+  of a SAM line, without decoding them.
+
+  Parameters
+  ----------
+  tags   : the optional fields as bytes (e.g., b"AS:i:-5\tXM:i:1").
+  prefix : the tag and type of the field (e.g., b"XM:i:").
+
+  Returns
+  -------
+  The value as bytes or None if the field is missing.
+  """
+  i = tags.find(prefix)
+  while (i > 0) and (tags[i - 1] != ord('\t')): # prefix inside another value
+    i = tags.find(prefix, i + 1)
+  if i < 0:
+    return None
+  end = tags.find(b'\t', i)
+  if end < 0:
+    end = len(tags)
+  return tags[i + len(prefix) : end]
+
+def parse_filter_fields(line):
+  """
+  Get the fields of a SAM line needed by stage "1_filter".
+  This is a fast alternative to parse_sam_fields() for SAM lines as bytes:
+  the line is only split up to the SEQ field and nothing is decoded or
+  converted. The optional fields are only parsed by parse_filter_tags()
+  when needed.
+
+  Parameters
+  ----------
+  line : one line of a SAM file as bytes.
+
+  Returns
+  -------
+  A tuple (qname, flag, pos, cigar, seq, rest) of bytes, where rest is the
+  remainder of the line after SEQ (QUAL and the optional fields).
+  """
+  fields = line.split(b'\t', 10)
+  if len(fields) < (len(SAM_MANDATORY_FIELDS) - 1):
+    raise Exception('Not enough fields for SAM format')
+  return fields[0], fields[1], fields[3], fields[5], fields[9], fields[10]
+
+def parse_filter_tags(rest):
+  """
+  Get the values of the XM, XG, and YF optional fields from the remainder
+  of a SAM line returned by parse_filter_fields().
+
+  Returns
+  -------
+  A tuple (xm, xg, yf) of strings, with None for missing fields.
+  """
+  tags = rest.partition(b'\t')[2].rstrip()
+  values = [get_tag_value(tags, x) for x in [b'XM:i:', b'XG:i:', b'YF:Z:']]
+  return tuple(None if (x is None) else x.decode() for x in values)
+
+def make_collapsed_qname(index, count):
+  """
+  Get the QNAME of a record representing a collapsed (deduplicated) read.
+  The QNAME has the form "<index>:<count>" where index is the 1-based
+  order of first occurrence of the read sequence in the library and count is the
+  number of times the sequence occurs.
+  """
+  return str(index) + COLLAPSED_QNAME_SEP + str(count)
+
+def get_collapsed_count(qname):
+  """
+  Get the number of reads represented by the QNAME of a collapsed read.
+  See make_collapsed_qname().
+  """
+  return int(qname.rsplit(COLLAPSED_QNAME_SEP, 1)[1])
+
+def reverse_complement(seq):
+  """
+  Get the reverse complement of a read sequence, as stored in the SEQ field
+  of reverse-strand records. Letters other than A, C, G, T, and N are kept.
+  """
+  return seq.translate(COMPLEMENT)[::-1]
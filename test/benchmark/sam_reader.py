@@ -0,0 +1,106 @@
+"""
+  Benchmark of the per-record cost of reading the SAM fields used by
+  stage "1_filter": sam_utils.parse_sam_fields() on decoded lines versus
+  sam_utils.parse_filter_fields() on lines read as bytes. The optional fields
+  are parsed for every record in both cases, although stage "1_filter"
+  only parses them for the first record of each sequence.
+
+  Usage: python test/benchmark/sam_reader.py [FILE.sam ...] [--repeats N]
+  Without files, the SAM files of the integration test are used.
+"""
+import os
+import sys
+import glob
+import time
+import argparse
+
+import DSBplot.utils.file_utils as file_utils
+import DSBplot.utils.sam_utils as sam_utils
+
+def get_default_files():
+  return sorted(glob.glob(
+    os.path.join(os.path.dirname(__file__), os.pardir, 'integration', 'input', 'sam', '*.sam')
+  ))
+
+def read_dict(file):
+  """
+    Read the fields used by stage "1_filter" with sam_utils.parse_sam_fields().
+    Returns the number of records.
+  """
+  num_lines = 0
+  with file_utils.open_text(file) as input:
+    for line in input:
+      if line.startswith('@'):
+        continue
+      mandatory, optional = sam_utils.parse_sam_fields(line.rstrip().split('\t'))
+      mandatory['SEQ'], mandatory['CIGAR'], int(mandatory['FLAG']), int(mandatory['POS'])
+      optional['XM']['VALUE'] if ('XM' in optional) else None
+      optional['XG']['VALUE'] if ('XG' in optional) else None
+      num_lines += 1
+  return num_lines
+
+def read_bytes(file):
+  """
+    Read the fields used by stage "1_filter" with sam_utils.parse_filter_fields().
+    Returns the number of records.
+  """
+  num_lines = 0
+  with file_utils.open_binary(file) as input:
+    for line in input:
+      if line.startswith(b'@'):
+        continue
+      _, flag, pos, _, _, rest = sam_utils.parse_filter_fields(line)
+      int(flag), int(pos)
+      sam_utils.parse_filter_tags(rest)
+      num_lines += 1
+  return num_lines
+
+READERS = {
+  'parse_sam_fields': read_dict,
+  'parse_filter_fields': read_bytes,
+}
+
+def benchmark(func, file_list, repeats):
+  """
+    Run func on all the files repeats times.
+
+    Returns
+    -------
+    A tuple (num_lines, elapsed) of the number of records read in one
+    repeat and the best wall time of a repeat in seconds.
+  """
+  best = None
+  for _ in range(repeats):
+    start = time.perf_counter()
+    num_lines = sum(func(file) for file in file_list)
+    elapsed = time.perf_counter() - start
+    best = elapsed if (best is None) else min(best, elapsed)
+  return num_lines, best
+
+def main(file_list = None, repeats = 5):
+  """
+    Print the per-record time of each reader in READERS.
+
+    Returns
+    -------
+    A dictionary mapping the name of each reader to its time per record in nanoseconds.
+  """
+  if not file_list:
+    file_list = get_default_files()
+  result = {}
+  for name, func in READERS.items():
+    num_lines, elapsed = benchmark(func, file_list, repeats)
+    result[name] = 1e9 * elapsed / num_lines
+    print(f'{name}: {num_lines} records, {result[name]:.0f} ns/record')
+  return result
+
+def parse_args():
+  parser = argparse.ArgumentParser(
+    description = 'Benchmark the per-record cost of reading SAM files in stage "1_filter".'
+  )
+  parser.add_argument('file_list', nargs='*', help='SAM files (default: the integration test SAM files).')
+  parser.add_argument('--repeats', type=int, default=5, help='Number of repeats (the best is reported).')
+  return vars(parser.parse_args())
+
+if __name__ == '__main__':
+  main(**parse_args())
@@ -1,7 +1,13 @@
 import os
+import csv
+import json
+import itertools
 import shutil
 import unittest
 
+import DSBplot.lib_process.filter_reads as filter_reads
+import DSBplot.lib_process.filter_sweep as filter_sweep
+
 class TestProcess(unittest.TestCase):
   def get_check_files():
     """
@@ -114,5 +120,313 @@ class TestProcess(unittest.TestCase):
       print('Testing file: ' + file)
       self.check_equality(os.path.join(output, file), os.path.join(output_expected, file))
 
+  def get_input_sam():
+    return [
+      os.path.join(os.path.dirname(__file__), 'input', 'sam', 'Sense_R1_1.sam'),
+      os.path.join(os.path.dirname(__file__), 'input', 'sam', 'Sense_R1_2.sam'),
+      os.path.join(os.path.dirname(__file__), 'input', 'sam', 'Sense_R1_3.sam'),
+      os.path.join(os.path.dirname(__file__), 'input', 'sam', 'Sense_R1_4.sam'),
+    ]
+
+  def get_ref():
+    return os.path.join(os.path.dirname(__file__), 'input', 'ref_seq', '2DSB_Sense_R1.fa')
+
+  def get_output(name):
+    """
+    Get a cleared output directory for a test. The directory is named
+    "Sense_R1" like the expected output, since the name is in "data_info.json".
+    """
+    output = os.path.join(os.path.dirname(__file__), 'output', name)
+    if os.path.exists(output):
+      shutil.rmtree(os.path.dirname(output))
+    return os.path.join(output, 'Sense_R1')
+
+  def run_commands(self, commands):
+    for command in commands:
+      print('Testing command: ' + command)
+      self.assertEqual(os.system(command), 0, 'Command failed.')
+
+  def check_output(self, output, files=None):
+    """
+    Check the output files against the expected output.
+    """
+    output_expected = os.path.join(os.path.dirname(__file__), 'output_expected', 'Sense_R1')
+    if files is None:
+      files = TestProcess.get_check_files()
+    for file in files:
+      print('Testing file: ' + file)
+      self.check_equality(os.path.join(output, file), os.path.join(output_expected, file))
+
+  def check_filter_option(self, name, options):
+    """
+    Test the SAM input with extra options of stage "1_filter", which should
+    not change the output.
+    """
+    output = TestProcess.get_output(name)
+    self.run_commands([
+      'DSBplot-process -o {} -i {} {} {} {} --ref {} --dsb 67 --reads 3000 3000 3000 3000 {}'
+      .format(output, *TestProcess.get_input_sam(), TestProcess.get_ref(), options)
+    ])
+    self.check_output(output)
+    shutil.rmtree(os.path.dirname(output))
+
+  def test_filter_bam(self):
+    """
+    Test stage "1_filter" with BAM input. The BAM test file was made from the
+    SAM test file of the same library and should give the same output.
+    """
+    output = TestProcess.get_output('Sense_R1_bam')
+    commands = []
+    for ext in ['sam', 'bam']:
+      commands.append(
+        'python -m DSBplot.lib_process.filter_reads -i {} -o {} {} --ref {} --dsb 67 --quiet'
+        .format(
+          os.path.join(os.path.dirname(__file__), 'input', ext, 'Sense_R1_1.' + ext),
+          os.path.join(output, f'accepted_{ext}.csv'),
+          os.path.join(output, f'rejected_{ext}.csv'),
+          TestProcess.get_ref(),
+        )
+      )
+    self.run_commands(commands)
+    for kind in ['accepted', 'rejected']:
+      self.check_equality(
+        os.path.join(output, f'{kind}_sam.csv'),
+        os.path.join(output, f'{kind}_bam.csv'),
+      )
+    shutil.rmtree(os.path.dirname(output))
+
+  def test_filter_workers(self):
+    """
+    Test stage "1_filter" with worker processes. The test SAM files are too
+    small to be split, so the libraries are also concatenated into one SAM file
+    that is split into shards, and compared with a single process.
+    """
+    self.check_filter_option('Sense_R1_workers', '--workers 3')
+
+    output = TestProcess.get_output('Sense_R1_workers_shards')
+    os.makedirs(output)
+    input = os.path.join(output, 'Sense_R1.sam')
+    with open(input, 'w') as out:
+      for file in TestProcess.get_input_sam():
+        with open(file) as in_h:
+          out.write(in_h.read())
+    commands = []
+    for workers in [1, 3]:
+      commands.append(
+        'python -m DSBplot.lib_process.filter_reads -i {} -o {} {} --ref {} --dsb 67 --workers {} --quiet'
+        .format(
+          input,
+          os.path.join(output, f'accepted_{workers}.csv'),
+          os.path.join(output, f'rejected_{workers}.csv'),
+          TestProcess.get_ref(),
+          workers,
+        )
+      )
+    self.run_commands(commands)
+    for kind in ['accepted', 'rejected']:
+      self.check_equality(
+        os.path.join(output, f'{kind}_1.csv'),
+        os.path.join(output, f'{kind}_3.csv'),
+      )
+    shutil.rmtree(os.path.dirname(output))
+
+  def test_filter_partitions(self):
+    """
+    Test stage "1_filter" out of core with partitions.
+    """
+    self.check_filter_option('Sense_R1_partitions', '--partitions 3')
+    self.check_filter_option('Sense_R1_partitions_workers', '--partitions 3 --workers 3')
+
+  def test_filter_partitions_new_dir(self):
+    """
+    Test stage "1_filter" with partitions writing to a directory that does
+    not exist yet (the partition files are written next to the output).
+    The filter is called directly, since the command line arguments make
+    the output directory.
+    """
+    output = TestProcess.get_output('Sense_R1_partitions_new_dir')
+    for partitions in [0, 3]:
+      filter_reads.main(
+        input_list = TestProcess.get_input_sam(),
+        output = [
+          os.path.join(output, str(partitions), 'accepted.csv'),
+          os.path.join(output, str(partitions), 'rejected.csv'),
+        ],
+        debug_file = None,
+        ref_seq_file = TestProcess.get_ref(),
+        library_names = None,
+        total_reads = None,
+        dsb_pos = 67,
+        min_length = 68,
+        max_subst = filter_reads.MAX_SUBST_INF,
+        reverse_complement = False,
+        consecutive = True,
+        dsb_touch = True,
+        realign = True,
+        quiet = True,
+        partitions = partitions,
+      )
+    for kind in ['accepted', 'rejected']:
+      self.check_equality(
+        os.path.join(output, '0', f'{kind}.csv'),
+        os.path.join(output, '3', f'{kind}.csv'),
+      )
+    shutil.rmtree(os.path.dirname(output))
+
+  def test_filter_incremental(self):
+    """
+    Test stage "1_filter" with the libraries added over two runs.
+    """
+    input_sam = TestProcess.get_input_sam()
+    ref = TestProcess.get_ref()
+    output = TestProcess.get_output('Sense_R1_incremental')
+    self.run_commands([
+      'DSBplot-process -o {} -i {} {} --ref {} --dsb 67 --reads 3000 3000 --stages 0_align 1_filter'
+      .format(output, *input_sam[:2], ref),
+      'DSBplot-process -o {} -i {} {} {} {} --ref {} --dsb 67 --reads 3000 3000 3000 3000 --incremental 1'
+      .format(output, *input_sam, ref),
+    ])
+    self.check_output(output)
+    shutil.rmtree(os.path.dirname(output))
+
+  def test_filter_sweep(self):
+    """
+    Test stage "1_filter" with a parameter sweep. The output and the sweep
+    combination with the default settings should be the same as without it.
+    """
+    output = TestProcess.get_output('Sense_R1_sweep')
+    sweep_dir = os.path.join(output, 'sweep', 'min_len_68_max_sub_-1_consec_1_touch_1_realign_1')
+    self.run_commands([
+      'DSBplot-process -o {} -i {} {} {} {} --ref {} --dsb 67 --reads 3000 3000 3000 3000 --sweep max_sub=-1,2 consec=0,1'
+      .format(output, *TestProcess.get_input_sam(), TestProcess.get_ref()),
+      'DSBplot-process -o {} --stages 2_window 3_variation 4_info'.format(sweep_dir),
+    ])
+    self.check_output(output)
+    # The sweep directory only has the output of stages "1_filter" onwards,
+    # and the name in "data_info.json" is that of the directory.
+    self.check_output(
+      sweep_dir,
+      [x for x in TestProcess.get_check_files() if x not in ['data_info.json', 'ref_seq.fasta']],
+    )
+    for file in ['filter_accepted.csv', 'filter_rejected.csv']:
+      self.check_equality(os.path.join(output, file), os.path.join(sweep_dir, file))
+    shutil.rmtree(os.path.dirname(output))
+
+  def test_filter_sweep_settings(self):
+    """
+    Test that each combination of settings of filter_sweep.do_sweep() has the
+    same output as a separate run of filter_reads.main() with the settings.
+    """
+    output = TestProcess.get_output('Sense_R1_sweep_settings')
+    settings_list = []
+    for min_length, max_subst, consecutive, dsb_touch, realign in itertools.product(
+      [68, 90],
+      [filter_reads.MAX_SUBST_INF, 1],
+      [False, True],
+      [False, True],
+      [False, True],
+    ):
+      dir = os.path.join(
+        output,
+        f'{min_length}_{max_subst}_{int(consecutive)}_{int(dsb_touch)}_{int(realign)}',
+      )
+      settings_list.append({
+        'output': os.path.join(dir, 'sweep_accepted.csv'),
+        'output_rejected': os.path.join(dir, 'sweep_rejected.csv'),
+        'debug_file': os.path.join(dir, 'sweep_debug.csv'),
+        'min_length': min_length,
+        'max_subst': max_subst,
+        'consecutive': consecutive,
+        'dsb_touch': dsb_touch,
+        'realign': realign,
+      })
+    filter_sweep.do_sweep(
+      input_list = TestProcess.get_input_sam(),
+      library_names = None,
+      total_reads = [3000, 3000, 3000, 3000],
+      ref_seq_file = TestProcess.get_ref(),
+      dsb_pos = 67,
+      reverse_complement = False,
+      quiet = True,
+      settings_list = settings_list,
+    )
+    for settings in settings_list:
+      dir = os.path.dirname(settings['output'])
+      filter_reads.main(
+        input_list = TestProcess.get_input_sam(),
+        output = [
+          os.path.join(dir, 'filter_accepted.csv'),
+          os.path.join(dir, 'filter_rejected.csv'),
+        ],
+        debug_file = os.path.join(dir, 'filter_debug.csv'),
+        ref_seq_file = TestProcess.get_ref(),
+        library_names = None,
+        total_reads = [3000, 3000, 3000, 3000],
+        dsb_pos = 67,
+        min_length = settings['min_length'],
+        max_subst = settings['max_subst'],
+        reverse_complement = False,
+        consecutive = settings['consecutive'],
+        dsb_touch = settings['dsb_touch'],
+        realign = settings['realign'],
+        quiet = True,
+      )
+      for kind in ['accepted', 'rejected', 'debug']:
+        self.check_equality(
+          os.path.join(dir, f'sweep_{kind}.csv'),
+          os.path.join(dir, f'filter_{kind}.csv'),
+        )
+    shutil.rmtree(os.path.dirname(output))
+
+  def test_sample(self):
+    """
+    Test the preview mode with "--sample". The sample of each library should
+    be the same for the same seed and in input order, and the frequencies
+    should be relative to the total reads scaled by the sampled fraction.
+    """
+    input_sam = TestProcess.get_input_sam()
+    output = TestProcess.get_output('Sense_R1_sample')
+    sample = 1000
+    total_reads = 6000
+    command = (
+      'DSBplot-process -o {} -i {} {} {} {} --ref {} --dsb 67 --reads {} {} {} {}' +
+      ' --sample {} --seed 1 --stages 0_align 1_filter'
+    ).format(output, *input_sam, TestProcess.get_ref(), *([total_reads] * 4), sample)
+    self.run_commands([command])
+    sample_lines = []
+    for file in input_sam:
+      with open(os.path.join(output, os.path.basename(file))) as input:
+        sample_lines.append(input.readlines())
+    self.run_commands([command])
+    for file, lines in zip(input_sam, sample_lines):
+      with open(os.path.join(output, os.path.basename(file))) as input:
+        self.assertEqual(input.readlines(), lines)
+      # The sampled lines are a subsequence of the input lines
+      with open(file) as input:
+        input_lines = iter(input.readlines())
+      self.assertEqual(len(lines), sample)
+      self.assertTrue(all(any(x == y for y in input_lines) for x in lines))
+
+    with open(os.path.join(output, 'sample_args.json')) as input:
+      sample_args = json.load(input)
+    self.assertEqual(sample_args['input_reads'], [3000] * 4)
+    self.assertEqual(sample_args['sampled_reads'], [sample] * 4)
+    library_names = [os.path.splitext(os.path.basename(x))[0] for x in input_sam]
+    counts = {x: 0 for x in library_names}
+    for file in ['filter_accepted.csv', 'filter_rejected.csv']:
+      with open(os.path.join(output, file)) as input:
+        rows = list(csv.DictReader(input))
+      self.assertGreater(len(rows), 0)
+      for row in rows:
+        for name in library_names:
+          counts[name] += int(row['count_' + name])
+          self.assertAlmostEqual(
+            float(row['freq_' + name]),
+            int(row['count_' + name]) / (total_reads * sample / 3000),
+          )
+    # Every sampled read is either accepted or rejected
+    self.assertEqual(counts, {x: sample for x in library_names})
+    shutil.rmtree(os.path.dirname(output))
+
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,124 @@
+import os
+import struct
+import unittest
+
+import DSBplot.utils.bam_utils as bam_utils
+
+class TestBamUtils(unittest.TestCase):
+  def get_input(ext):
+    """
+    The BAM test file was made from the SAM test file of the same library.
+    """
+    return os.path.join(
+      os.path.dirname(__file__),
+      os.pardir,
+      'integration',
+      'input',
+      ext,
+      'Sense_R1_1.' + ext,
+    )
+
+  def test_bam_reader(self):
+    """
+    Test that the lines of the BAM file are the header and the lines of the SAM file.
+    """
+    with open(TestBamUtils.get_input('sam')) as input:
+      sam_lines = input.readlines()
+    header = ['@HD\tVN:1.0\tSO:unsorted\n', '@SQ\tSN:2DSB_R1_sense\tLN:113\n']
+    for threads in [1, 4]:
+      with bam_utils.BamReader(TestBamUtils.get_input('bam'), threads=threads) as input:
+        self.assertEqual(list(input), header + sam_lines)
+    with bam_utils.BamReader(TestBamUtils.get_input('bam'), binary=True) as input:
+      self.assertEqual(list(input), [x.encode() for x in header + sam_lines])
+
+  def test_block_boundaries(self):
+    """
+    Test that the BAM test file has records that span BGZF blocks,
+    so that test_bam_reader() reads records across block boundaries.
+    """
+    with open(TestBamUtils.get_input('bam'), 'rb') as input:
+      blocks = list(bam_utils.iter_bgzf_data(input, TestBamUtils.get_input('bam')))
+    self.assertGreater(len(blocks), 2)
+    data = b''.join(blocks)
+    # Skip the header to get the start of each record
+    i = 8 + struct.unpack_from('<i', data, 4)[0]
+    n_ref = struct.unpack_from('<i', data, i)[0]
+    i += 4
+    for _ in range(n_ref):
+      i += 8 + struct.unpack_from('<i', data, i)[0]
+    record_starts = set()
+    while i < len(data):
+      record_starts.add(i)
+      i += 4 + struct.unpack_from('<i', data, i)[0]
+    block_starts = set()
+    i = 0
+    for block in blocks:
+      i += len(block)
+      block_starts.add(i)
+    self.assertFalse(block_starts <= record_starts)
+
+  def test_bgzf_buffer(self):
+    """
+    Test reading chunks that span several blocks, including empty blocks.
+    """
+    buffer = bam_utils.BgzfBuffer(iter([b'ab', b'', b'cde', b'f']))
+    self.assertEqual(buffer.read(3), b'abc')
+    self.assertEqual(buffer.read(0), b'')
+    self.assertEqual(buffer.read(1), b'd')
+    self.assertEqual(buffer.read(4), b'ef')
+    self.assertEqual(buffer.read(4), b'')
+
+  def test_parse_aux_fields(self):
+    """
+    Test the auxiliary fields of every type.
+    """
+    data = (
+      b'XAAx' +
+      b'Xcc' + struct.pack('<b', -5) +
+      b'XCC' + struct.pack('<B', 200) +
+      b'Xss' + struct.pack('<h', -300) +
+      b'XSS' + struct.pack('<H', 60000) +
+      b'Xii' + struct.pack('<i', -70000) +
+      b'XII' + struct.pack('<I', 3000000000) +
+      b'Xff' + struct.pack('<f', 0.5) +
+      b'XZZhello world\x00' +
+      b'XHH1AE301\x00' +
+      b'XBBs' + struct.pack('<ihhh', 3, 1, -2, 3)
+    )
+    self.assertEqual(
+      bam_utils.parse_aux_fields(data),
+      [
+        'XA:A:x',
+        'Xc:i:-5',
+        'XC:i:200',
+        'Xs:i:-300',
+        'XS:i:60000',
+        'Xi:i:-70000',
+        'XI:i:3000000000',
+        'Xf:f:0.5',
+        'XZ:Z:hello world',
+        'XH:H:1AE301',
+        'XB:B:s,1,-2,3',
+      ],
+    )
+    with self.assertRaises(Exception):
+      bam_utils.parse_aux_fields(b'XQQ')
+
+  def test_parse_record(self):
+    """
+    Test a record with an odd-length SEQ, no QUAL, and a mate on another reference.
+    """
+    cigar = [(2 << 4) | 0, (1 << 4) | 1, (3 << 4) | 2, (2 << 4) | 4] # 2M1I3D2S
+    data = struct.pack('<iiBBHHHiiii', 0, 9, 5, 30, 0, len(cigar), 16, 5, 1, 99, -7)
+    data += b'read\x00'
+    data += struct.pack('<4I', *cigar)
+    data += bytes([0x12, 0x48, 0xF0]) # ACGTN
+    data += b'\xff' * 5
+    data += b'NMC\x04'
+    self.assertEqual(
+      bam_utils.parse_record(data, ['ref_1', 'ref_2']),
+      ['read', '16', 'ref_1', '10', '30', '2M1I3D2S', 'ref_2', '100', '-7', 'ACGTN', '*', 'NM:i:4'],
+    )
+
+if __name__ == '__main__':
+  unittest.main()
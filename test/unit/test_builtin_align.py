@@ -0,0 +1,220 @@
+import re
+import unittest
+
+import numpy as np
+
+import DSBplot.lib_process.builtin_align as builtin_align
+import DSBplot.utils.sam_utils as sam_utils
+
+NUM_CASES = 400
+
+def get_penalties(read, qual):
+  """
+    Mismatch penalty of each read position (see builtin_align.get_mismatch_penalties()).
+  """
+  if qual is None:
+    return [builtin_align.MISMATCH_PENALTY_MAX] * len(read)
+  return [int(x) for x in builtin_align.get_mismatch_penalties([qual])[0]]
+
+def get_sub_score(read_nt, ref_nt, penalty):
+  if read_nt == ref_nt:
+    return 0
+  if (read_nt == 'N') or (ref_nt == 'N'):
+    return -builtin_align.N_PENALTY
+  return -penalty
+
+def align_reference(ref, read, qual):
+  """
+    Best score of an alignment that is global on the read and local on the
+    reference, by a direct (unvectorized) affine gap dynamic programming.
+  """
+  penalties = get_penalties(read, qual)
+  gap_open = builtin_align.GAP_OPEN_PENALTY + builtin_align.GAP_EXTEND_PENALTY
+  gap_extend = builtin_align.GAP_EXTEND_PENALTY
+  neg_inf = float('-inf')
+  h = [[0] * (len(ref) + 1)] + [[neg_inf] * (len(ref) + 1) for _ in read]
+  e = [[neg_inf] * (len(ref) + 1) for _ in range(len(read) + 1)]
+  f = [[neg_inf] * (len(ref) + 1) for _ in range(len(read) + 1)]
+  for i in range(1, len(read) + 1):
+    for j in range(len(ref) + 1):
+      f[i][j] = max(h[i - 1][j] - gap_open, f[i - 1][j] - gap_extend)
+      h[i][j] = f[i][j]
+      if j > 0:
+        e[i][j] = max(h[i][j - 1] - gap_open, e[i][j - 1] - gap_extend)
+        h[i][j] = max(
+          h[i][j],
+          e[i][j],
+          h[i - 1][j - 1] + get_sub_score(read[i - 1], ref[j - 1], penalties[i - 1]),
+        )
+  return max(h[len(read)][1:])
+
+def score_cigar(test, ref, read, qual, pos, cigar):
+  """
+    Score an alignment from its CIGAR string and check that it is consistent.
+
+    Returns
+    -------
+    A tuple (score, num_sub, num_indel).
+  """
+  penalties = get_penalties(read, qual)
+  ops = re.findall(r'(\d+)([MID])', cigar)
+  test.assertEqual(''.join(x + y for x, y in ops), cigar)
+  test.assertEqual(sum(int(x) for x, y in ops if y in 'MI'), len(read))
+  score = 0
+  num_sub = 0
+  num_indel = 0
+  ref_i = pos - 1
+  read_i = 0
+  for count, op in ops:
+    count = int(count)
+    if op == 'M':
+      for _ in range(count):
+        score += get_sub_score(read[read_i], ref[ref_i], penalties[read_i])
+        num_sub += read[read_i] != ref[ref_i]
+        read_i += 1
+        ref_i += 1
+    else:
+      score -= builtin_align.GAP_OPEN_PENALTY + builtin_align.GAP_EXTEND_PENALTY * count
+      num_indel += count
+      if op == 'I':
+        read_i += count
+      else:
+        ref_i += count
+  test.assertGreaterEqual(pos, 1)
+  test.assertLessEqual(ref_i, len(ref))
+  return score, num_sub, num_indel
+
+def random_seq(rng, length, letters='ACGT'):
+  return ''.join(rng.choice(list(letters), size=length))
+
+def mutate(rng, seq):
+  """
+    Random substitutions, insertions, deletions, and Ns.
+  """
+  seq = list(seq)
+  for _ in range(rng.integers(0, 4)):
+    i = int(rng.integers(0, len(seq)))
+    kind = rng.integers(0, 4)
+    if kind == 0:
+      seq[i] = random_seq(rng, 1)
+    elif kind == 1:
+      seq.insert(i, random_seq(rng, int(rng.integers(1, 4))))
+    elif kind == 2:
+      del seq[i : i + int(rng.integers(1, 4))]
+    else:
+      seq[i] = 'N'
+  return ''.join(seq)
+
+def random_qual(rng, length):
+  return ''.join(chr(33 + int(x)) for x in rng.integers(2, 42, size=length))
+
+class TestBuiltinAlign(unittest.TestCase):
+  def check_batch(self, ref, read_list, qual_list):
+    results = builtin_align.align_batch(
+      ref,
+      read_list,
+      None if all(x is None for x in qual_list) else qual_list,
+    )
+    self.assertEqual(len(results), len(read_list))
+    for read, qual, (score, pos, cigar, num_sub, num_indel) in zip(read_list, qual_list, results):
+      msg = f'ref={ref} read={read} qual={qual} pos={pos} cigar={cigar}'
+      self.assertEqual(score, align_reference(ref, read, qual), msg)
+      self.assertEqual(score_cigar(self, ref, read, qual, pos, cigar), (score, num_sub, num_indel), msg)
+
+  def test_align_batch(self):
+    """
+    Test the scores of align_batch() against a direct dynamic programming,
+    and the CIGAR, position, XM (num_sub), and XG (num_indel) against the score.
+    """
+    rng = np.random.default_rng(0)
+    num_cases = 0
+    while num_cases < NUM_CASES:
+      ref = random_seq(rng, int(rng.integers(20, 40)))
+      read_length = int(rng.integers(5, 25))
+      read_list = []
+      qual_list = []
+      for _ in range(int(rng.integers(1, 8))):
+        if rng.random() < 0.2:
+          read = random_seq(rng, read_length, 'ACGTN')
+        else:
+          start = int(rng.integers(0, len(ref) - 4))
+          read = mutate(rng, ref[start : start + read_length + 3])
+          if len(read) < read_length:
+            read += random_seq(rng, read_length - len(read))
+          read = read[:read_length]
+        read_list.append(read)
+        qual_list.append(random_qual(rng, read_length) if rng.random() < 0.5 else None)
+      self.check_batch(ref, read_list, qual_list)
+      num_cases += len(read_list)
+
+  def test_align_batch_gaps(self):
+    """
+    Test alignments that need an insertion or deletion, and reads longer than the reference.
+    """
+    ref = 'ACGTTGCAAGGCTTACCGATGCATTAGC'
+    read_list = [
+      ref[2:12] + ref[16:26], # Deletion
+      ref[2:12] + 'GGGG' + ref[12:18], # Insertion
+      ref + 'ACGT', # Longer than the reference
+    ]
+    for read in read_list:
+      self.check_batch(ref, [read], [None])
+    # The deletion may be placed anywhere in an equivalent repeat
+    score, pos, cigar, num_sub, num_indel = builtin_align.align_batch(ref, [ref[2:12] + ref[16:26]])[0]
+    self.assertEqual((score, pos, num_sub, num_indel), (-17, 3, 0, 4))
+    self.assertRegex(cigar, r'^\d+M4D\d+M$')
+
+  def test_align_batch_both_strands(self):
+    """
+    Test the choice of the strand and the alignment records.
+    """
+    ref = 'ACGTTGCAAGGCTTACCGATGCATTAGCCTAGGA'
+    forward = ref[3:23]
+    reverse = sam_utils.reverse_complement(ref[10:30])
+    palindrome = 'AAGCTT'
+    ref_palindrome = 'CCCC' + palindrome + 'GGGG'
+    unaligned = 'T' * 20
+    alignments = builtin_align.align_batch_both_strands(
+      ref,
+      [forward, reverse, unaligned],
+      [None, random_qual(np.random.default_rng(1), 20), None],
+    )
+    self.assertEqual(alignments[0][:3], (0, 4, '20M'))
+    self.assertEqual(alignments[1][:3], (sam_utils.FLAG_RC, 11, '20M'))
+    self.assertIn('AS:i:0', alignments[1][3])
+    self.assertIsNone(alignments[2])
+    # Ties go to the forward strand
+    alignments = builtin_align.align_batch_both_strands(ref_palindrome, [palindrome], [None])
+    self.assertEqual(alignments[0][:3], (0, 5, '6M'))
+
+    # The strand with the better reference score is chosen
+    rng = np.random.default_rng(2)
+    for _ in range(50):
+      start = int(rng.integers(0, len(ref) - 15))
+      read = mutate(rng, ref[start : start + 15])
+      if rng.random() < 0.5:
+        read = sam_utils.reverse_complement(read)
+      qual = random_qual(rng, len(read))
+      alignment = builtin_align.align_batch_both_strands(ref, [read], [qual])[0]
+      forward_score = align_reference(ref, read, qual)
+      reverse_score = align_reference(ref, sam_utils.reverse_complement(read), qual[::-1])
+      best_score = max(forward_score, reverse_score)
+      if best_score < builtin_align.get_min_score(len(read)):
+        self.assertIsNone(alignment)
+        continue
+      flag, pos, cigar, tags = alignment
+      self.assertEqual(flag, sam_utils.FLAG_RC if reverse_score > forward_score else 0)
+      self.assertIn(f'AS:i:{best_score}', tags)
+      if flag == sam_utils.FLAG_RC:
+        score, num_sub, num_indel = score_cigar(
+          self, ref, sam_utils.reverse_complement(read), qual[::-1], pos, cigar
+        )
+      else:
+        score, num_sub, num_indel = score_cigar(self, ref, read, qual, pos, cigar)
+      self.assertEqual(score, best_score)
+      self.assertIn(f'XM:i:{num_sub}', tags)
+      self.assertIn(f'XG:i:{num_indel}', tags)
+      self.assertIn(f'NM:i:{num_sub + num_indel}', tags)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,64 @@
+import random
+import unittest
+
+import DSBplot.lib_process.sample_reads as sample_reads
+
+class TestSampleReads(unittest.TestCase):
+  def test_reservoir_sample(self):
+    """
+    Test that reservoir_sample() gives the same sample for the same seed,
+    in input order, and that every item is sampled equally often.
+    """
+    self.assertEqual(
+      sample_reads.reservoir_sample(range(1000), 10, random.Random('0_lib')),
+      [110, 161, 172, 285, 303, 540, 581, 627, 731, 858],
+    )
+    for seed in range(20):
+      sample = sample_reads.reservoir_sample(range(1000), 50, random.Random(seed))
+      self.assertEqual(sample, sample_reads.reservoir_sample(range(1000), 50, random.Random(seed)))
+      self.assertEqual(len(sample), 50)
+      self.assertEqual(len(set(sample)), 50)
+      self.assertEqual(sample, sorted(sample))
+    self.assertEqual(sample_reads.reservoir_sample(range(5), 10, random.Random(0)), list(range(5)))
+    self.assertEqual(sample_reads.reservoir_sample(range(5), 5, random.Random(0)), list(range(5)))
+
+    num_trials = 4000
+    counts = [0] * 20
+    rng = random.Random(0)
+    for _ in range(num_trials):
+      for x in sample_reads.reservoir_sample(range(20), 5, rng):
+        counts[x] += 1
+    for x in counts:
+      self.assertAlmostEqual(x / num_trials, 5 / 20, delta=0.05)
+
+  def test_bernoulli_sample(self):
+    """
+    Test that bernoulli_sample() gives the same sample for the same seed,
+    in input order, with about the expected fraction of items.
+    """
+    self.assertEqual(
+      list(sample_reads.bernoulli_sample(range(100), 0.1, random.Random('0_lib'))),
+      [0, 21, 41, 45, 47, 49, 56, 72, 79, 98],
+    )
+    sample = list(sample_reads.bernoulli_sample(range(100000), 0.2, random.Random(1)))
+    self.assertEqual(sample, list(sample_reads.bernoulli_sample(range(100000), 0.2, random.Random(1))))
+    self.assertEqual(sample, sorted(set(sample)))
+    self.assertAlmostEqual(len(sample) / 100000, 0.2, delta=0.01)
+    self.assertEqual(list(sample_reads.bernoulli_sample(range(10), 1, random.Random(0))), list(range(10)))
+
+  def test_scale_total_reads(self):
+    """
+    Test that only the sampled libraries are scaled, by their sampled fraction.
+    """
+    sample_args = {
+      'library_names': ['a', 'b', 'c'],
+      'input_reads': [3000, 500, 0],
+      'sampled_reads': [1000, 500, 0],
+    }
+    self.assertEqual(
+      sample_reads.scale_total_reads([6000, 1000, 10, 7], ['a', 'b', 'c', 'd'], sample_args),
+      [2000, 1000, 10, 7],
+    )
+
+if __name__ == '__main__':
+  unittest.main()